@@ -0,0 +1,64 @@
+'''
+    usage:
+        python benchmarks/bench_fit.py [OUTPUT_JSON [BASELINE_JSON [THRESHOLD]]]
+
+    benchmarks a full fit() on the CUP dataset (over a matrix of hidden_layer_sizes and batch_size) and on the MONK's problems 1, 2 and 3.
+    every fit runs exactly a fixed number of epochs (the convergence criterion never stops it earlier), so the timings are comparable
+    between versions that change the weights only by floating point rounding. The epochs per second are reported too.
+
+    the results are written into OUTPUT_JSON (default benchmarks/results/fit_<date>.json) and, if given, compared with the ones in BASELINE_JSON:
+    the cases slower by more than THRESHOLD (default 0.1, i.e. 10%) are reported as regressions.
+'''
+
+from common import case_name, main
+
+from neural_network import MLPRegressor, MLPClassifier
+from utility import ReadData, readMonk
+
+CUP_EPOCHS = 20
+CUP_HIDDEN_LAYER_SIZES = [(20,), (50, 50)]
+CUP_BATCH_SIZES = [1, 32]
+MONK_EPOCHS = 100
+
+def _report ( epochs ):
+    '''
+        private helper.
+        returns the report function of a case that trains for the given number of epochs
+    '''
+    return lambda model, timing: {"epochs_per_second": epochs / timing["min"]}
+
+def _cup_case ( hidden_layer_sizes, batch_size ):
+    def setup ():
+        X, y, _, _ = ReadData ("cup/ML-CUP19-TR.csv", 1)
+        # hyper-parameters of test_single_model_with_reporting.py
+        def fit ():
+            model = MLPRegressor (hidden_layer_sizes=hidden_layer_sizes, activation="logistic", alpha=0.0006, batch_size=batch_size, learning_rate="adaptive",
+                                  learning_rate_init=0.055, momentum=0.8, max_iter=CUP_EPOCHS, n_iter_no_change=CUP_EPOCHS+1, random_state=0)
+            model.fit (X, y)
+            return model
+        return fit
+    return {"name": case_name ("fit", "cup", hidden=hidden_layer_sizes, batch=batch_size), "repeat": 3, "number": 1,
+            "params": {"hidden_layer_sizes": hidden_layer_sizes, "batch_size": batch_size, "epochs": CUP_EPOCHS}, "setup": setup, "report": _report (CUP_EPOCHS)}
+
+def _monk_case ( monk_no ):
+    def setup ():
+        X, y, _, _ = readMonk ("monks/monks-{}.train".format(monk_no))
+        # hyper-parameters of test_single_model_monk_with_reporting.py
+        def fit ():
+            model = MLPClassifier (hidden_layer_sizes=(15,), activation="relu", output_activation="logistic", alpha=0., learning_rate_init=0.8, momentum=0.8,
+                                   weights_init_value=0.1, max_iter=MONK_EPOCHS, n_iter_no_change=MONK_EPOCHS+1, random_state=0)
+            model.fit (X, y)
+            return model
+        return fit
+    return {"name": case_name ("fit", "monks", problem=monk_no), "repeat": 3, "number": 1,
+            "params": {"problem": monk_no, "epochs": MONK_EPOCHS}, "setup": setup, "report": _report (MONK_EPOCHS)}
+
+def cases ():
+    for hidden_layer_sizes in CUP_HIDDEN_LAYER_SIZES:
+        for batch_size in CUP_BATCH_SIZES:
+            yield _cup_case (hidden_layer_sizes, batch_size)
+    for monk_no in [1, 2, 3]:
+        yield _monk_case (monk_no)
+
+if __name__ == "__main__":
+    main (cases (), "fit", __doc__)
@@ -0,0 +1,59 @@
+'''
+    usage:
+        python benchmarks/bench_functions.py [OUTPUT_JSON [BASELINE_JSON [THRESHOLD]]]
+
+    benchmarks the activation functions (and their derivatives, both from the input and from the output of the activation),
+    the loss functions, their derivatives and the fused losses and derivatives of functions.py, computed into preallocated outputs as during the training.
+
+    the results are written into OUTPUT_JSON (default benchmarks/results/functions_<date>.json) and, if given, compared with the ones in BASELINE_JSON:
+    the cases slower by more than THRESHOLD (default 0.1, i.e. 10%) are reported as regressions.
+'''
+
+from common import case_name, main
+
+import numpy as np
+
+from functions import activation_functions, activation_functions_derivatives, activation_functions_output_derivatives, loss_functions, loss_functions_and_derivatives, loss_functions_derivatives
+
+# (n_samples, n_units) of the arrays: a minibatch of a hidden layer, an epoch of CUP through a hidden layer
+ACTIVATION_SHAPES = [(32, 50), (1024, 100)]
+# (n_samples, n_outputs) of the arrays: a minibatch and an epoch of CUP
+LOSS_SHAPES = [(32, 2), (1024, 2)]
+
+def _activation_case ( group, name, function, shape ):
+    def setup ():
+        x = np.random.default_rng (0).standard_normal (shape)
+        out = np.empty_like (x)
+        return lambda: function (x, out=out)
+    return {"name": case_name (group, name, shape=shape), "params": {"function": name, "shape": list(shape)}, "setup": setup}
+
+def _loss_case ( kernel, name, shape ):
+    def setup ():
+        generator = np.random.default_rng (0)
+        # targets and predictions in (0,1), valid for all the losses
+        true_output = (generator.random (shape) > 0.5).astype (float)
+        predicted_output = generator.uniform (0.05, 0.95, shape)
+        if kernel == "loss":
+            return lambda: loss_functions[name] (true_output, predicted_output, reduction="sum")
+        out = np.empty_like (predicted_output)
+        if kernel == "loss_and_derivative":
+            return lambda: loss_functions_and_derivatives[name] (true_output, predicted_output, reduction="sum", out=out)
+        return lambda: loss_functions_derivatives[name] (true_output, predicted_output, out=out)
+    return {"name": case_name ("functions", kernel, loss=name, shape=shape), "params": {"function": name, "kernel": kernel, "shape": list(shape)}, "setup": setup}
+
+def cases ():
+    for shape in ACTIVATION_SHAPES:
+        for name, function in activation_functions.items ():
+            yield _activation_case ("functions", "activation_" + name, function, shape)
+        for name, function in activation_functions_derivatives.items ():
+            yield _activation_case ("functions", "derivative_" + name, function, shape)
+        for name, function in activation_functions_output_derivatives.items ():
+            yield _activation_case ("functions", "output_derivative_" + name, function, shape)
+
+    for shape in LOSS_SHAPES:
+        for name in loss_functions:
+            for kernel in ["loss", "loss_derivative", "loss_and_derivative"]:
+                yield _loss_case (kernel, name, shape)
+
+if __name__ == "__main__":
+    main (cases (), "functions", __doc__)
@@ -0,0 +1,252 @@
+'''
+    usage:
+        python benchmarks/bench_model_selection.py [OUTPUT_JSON [BASELINE_JSON [THRESHOLD]]]
+
+    end-to-end throughput of the model selection: the same seeded random search over the hyper-parameters space of grid_s.py
+    on a subset of the CUP development set, run in each search mode:
+        serial              GridSearchCV with FOLDS-fold cross validation, one configuration after another
+        parallel            GridSearchCV with the configurations cross validated by a pool of processes (n_jobs=-1)
+        successive_halving  SuccessiveHalvingSearch on a hold out split (multi-fidelity: most configurations are trained for few epochs)
+        hyperband           HyperbandSearch on a hold out split (draws its own configurations from the same space and seed)
+
+    every mode runs in a new process (so that its peak memory is measured alone) inside a temporary directory (its .gsv files are discarded)
+    and reports on the same axis:
+        configs_per_hour    configurations evaluated (successfully or not) per hour of wall time
+        epochs_per_second   training epochs (over all the folds and workers) per second of wall time
+        time_split          seconds spent in fit (fit() and the epochs of fit_iterator()), in predict, writing the .gsv files
+                            and in the rest of the search (cross validation splits, copies of the models, losses, bookkeeping);
+                            for the parallel mode fit and predict are summed over the worker processes, so they are not a split of the wall time
+        peak_rss_mb         peak resident memory of the main process and of the largest worker process
+
+    the results are written into OUTPUT_JSON (default benchmarks/results/model_selection_<date>.json) and, if given, compared with the ones in BASELINE_JSON
+    by the wall time per configuration: the modes slower by more than THRESHOLD (default 0.1, i.e. 10%) are reported as regressions.
+'''
+
+import os
+import sys
+import json
+import time
+import random
+import tempfile
+import functools
+import subprocess
+import multiprocessing
+from datetime import datetime
+
+from common import DEFAULT_THRESHOLD, RESULTS_DIRECTORY, case_name, compare, load_results, save_results
+
+import numpy as np
+
+import utility
+from neural_network import BaseNeuralNetwork, MLPRegressor
+from functions import _euclidean_loss
+from utility import ReadData, GridSearchCV, SuccessiveHalvingSearch, HyperbandSearch, getRandomParams
+from grid_s import search_space
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows: the peak memory is not reported
+    resource = None
+
+MODES = ["serial", "parallel", "successive_halving", "hyperband"]
+
+SEED = 0
+N_SAMPLES = 400
+N_CONFIGURATIONS = 12
+FOLDS = 3
+# maximum number of epochs of a configuration (grid_s.py uses 500: the benchmark is shorter, the cost per epoch is the same)
+MAX_EPOCHS = 27
+# successive halving and hyperband: configurations kept at each rung 1/ETA, first rung of successive halving MAX_EPOCHS / ETA**2 epochs
+ETA = 3
+
+class _Counters:
+    '''
+        private class.
+        time spent in fit, predict and writing the .gsv files, number of epochs and of configurations (and failed ones) of a search.
+        The counters are in shared memory: the worker processes forked by the parallel search add to the same ones.
+    '''
+
+    FIELDS = ["fit", "predict", "gsv_io", "epochs", "configurations", "failed"]
+
+    def __init__ ( self ):
+        self._values = multiprocessing.Array ("d", len(self.FIELDS))
+
+    def add ( self, field, value ):
+        with self._values.get_lock ():
+            self._values[self.FIELDS.index (field)] += value
+
+    def values ( self ):
+        with self._values.get_lock ():
+            return dict (zip (self.FIELDS, self._values[:]))
+
+def _timed ( counters, field, function ):
+    '''
+        private helper.
+        returns a wrapper of function that adds its duration to the counter field
+    '''
+    @functools.wraps (function)
+    def wrapper ( *args, **kwargs ):
+        start = time.perf_counter ()
+        try:
+            return function (*args, **kwargs)
+        finally:
+            counters.add (field, time.perf_counter () - start)
+    return wrapper
+
+def _timed_iterator ( counters, fit_iterator ):
+    '''
+        private helper.
+        returns a wrapper of fit_iterator whose generators add the duration of each epoch to the fit counter
+    '''
+    @functools.wraps (fit_iterator)
+    def wrapper ( self, X, y ):
+        iterator = fit_iterator (self, X, y)
+        try:
+            while True:
+                start = time.perf_counter ()
+                try:
+                    value = next (iterator)
+                finally:
+                    counters.add ("fit", time.perf_counter () - start)
+                yield value
+        except StopIteration:
+            return
+        finally:
+            iterator.close ()
+    return wrapper
+
+def _instrument ( counters ):
+    '''
+        private helper.
+        wraps the methods and functions of the search whose time (or calls) are counted
+    '''
+    def do_epoch ( original ):
+        @functools.wraps (original)
+        def wrapper ( *args, **kwargs ):
+            counters.add ("epochs", 1)
+            return original (*args, **kwargs)
+        return wrapper
+
+    def write_result ( original ):
+        @functools.wraps (original)
+        def wrapper ( outt, filename, p, outcome, *args, **kwargs ):
+            counters.add ("configurations", 1)
+            counters.add ("failed", 0 if outcome[0] else 1)
+            return original (outt, filename, p, outcome, *args, **kwargs)
+        return wrapper
+
+    BaseNeuralNetwork.fit = _timed (counters, "fit", BaseNeuralNetwork.fit)
+    BaseNeuralNetwork.fit_iterator = _timed_iterator (counters, BaseNeuralNetwork.fit_iterator)
+    BaseNeuralNetwork.predict = _timed (counters, "predict", BaseNeuralNetwork.predict)
+    BaseNeuralNetwork._do_epoch = do_epoch (BaseNeuralNetwork._do_epoch)
+    utility._write_grid_search_result = _timed (counters, "gsv_io", write_result (utility._write_grid_search_result))
+    utility._write_best_result = _timed (counters, "gsv_io", utility._write_best_result)
+
+def _peak_rss_mb ( children=False ):
+    '''
+        private helper.
+        returns the peak resident memory in MB of this process, or of its largest terminated child process if children is set
+    '''
+    if resource is None:
+        return None
+    peak = resource.getrusage (resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (2**20 if sys.platform == "darwin" else 2**10)
+
+def run_mode ( mode ):
+    '''
+        runs the search in the given mode in this process: returns the dictionary of its measures (see the documentation of this file)
+    '''
+    counters = _Counters ()
+    _instrument (counters)
+    # no progress bars of the cross validations
+    utility._DISABLE_TQDM = True
+
+    data, labels, _, _ = ReadData ("cup/ML-CUP19-TR.csv", 0.90)
+    data, labels = data[:N_SAMPLES], labels[:N_SAMPLES]
+
+    # the same configurations (and weights initializations) in every mode
+    np.random.seed (SEED)
+    random.seed (SEED)
+    params = search_space (len(data))
+    randparams = [getRandomParams (params)[0] for i in range (N_CONFIGURATIONS)]
+    model = MLPRegressor (n_iter_no_change=10, max_iter=MAX_EPOCHS, random_state=SEED)
+
+    start = time.perf_counter ()
+    if mode == "serial":
+        GridSearchCV (model, randparams, data, labels, _euclidean_loss, FOLDS, write_best=False)
+    elif mode == "parallel":
+        GridSearchCV (model, randparams, data, labels, _euclidean_loss, FOLDS, write_best=False, n_jobs=-1)
+    elif mode == "successive_halving":
+        SuccessiveHalvingSearch (model, randparams, data, labels, _euclidean_loss, min_epochs=MAX_EPOCHS // ETA**2, max_epochs=MAX_EPOCHS, eta=ETA, random_state=SEED, write_best=False)
+    elif mode == "hyperband":
+        HyperbandSearch (model, params, data, labels, _euclidean_loss, max_epochs=MAX_EPOCHS, eta=ETA, random_state=SEED, write_best=False)
+    else:
+        raise ValueError ("search mode {} not implemented".format(mode))
+    wall = time.perf_counter () - start
+
+    values = counters.values ()
+    # the worker processes inherit the instrumented methods only if they are forked
+    instrumented = mode != "parallel" or multiprocessing.get_start_method () == "fork"
+    time_split = None
+    if instrumented:
+        time_split = {"fit": values["fit"], "predict": values["predict"], "gsv_io": values["gsv_io"]}
+        if mode != "parallel":
+            time_split["other"] = wall - sum (time_split.values ())
+
+    return {
+        "wall_seconds": wall,
+        "configurations": int (values["configurations"]),
+        "failed": int (values["failed"]),
+        "configs_per_hour": values["configurations"] / wall * 3600,
+        "epochs": int (values["epochs"]) if instrumented else None,
+        "epochs_per_second": values["epochs"] / wall if instrumented else None,
+        "time_split": time_split,
+        "peak_rss_mb": {"main": _peak_rss_mb (), "workers": _peak_rss_mb (children=True) if mode == "parallel" else None},
+    }
+
+def _run_mode_process ( mode ):
+    '''
+        private helper.
+        runs the search in the given mode in a new process, inside a temporary directory: returns its measures
+    '''
+    with tempfile.TemporaryDirectory () as directory:
+        completed = subprocess.run ([sys.executable, os.path.realpath (__file__), "--mode", mode], cwd=directory, stdout=subprocess.PIPE, check=True, text=True)
+    # the measures are the last line of the output
+    return json.loads (completed.stdout.strip ().splitlines ()[-1])
+
+def main ():
+    if len(sys.argv) > 1 and sys.argv[1] in ("-h", "--help"):
+        print (__doc__)
+        exit ()
+    if len(sys.argv) > 2 and sys.argv[1] == "--mode":
+        print (json.dumps (run_mode (sys.argv[2])))
+        return
+
+    output = sys.argv[1] if len(sys.argv) > 1 else os.path.join (RESULTS_DIRECTORY, "model_selection_{}.json".format(datetime.today ().isoformat ().replace (':', '_')))
+    baseline = sys.argv[2] if len(sys.argv) > 2 else None
+    threshold = float (sys.argv[3]) if len(sys.argv) > 3 else DEFAULT_THRESHOLD
+
+    settings = {"n_samples": N_SAMPLES, "n_configurations": N_CONFIGURATIONS, "folds": FOLDS, "max_epochs": MAX_EPOCHS, "eta": ETA, "seed": SEED}
+    results = {}
+    for mode in MODES:
+        measures = _run_mode_process (mode)
+        # the wall time per configuration is the timing compared with the baseline
+        seconds_per_configuration = measures["wall_seconds"] / max (1, measures["configurations"])
+        result = {"params": dict (settings, mode=mode), "min": seconds_per_configuration, "median": seconds_per_configuration, "repeat": 1, "number": 1}
+        result.update (measures)
+        results[case_name ("model_selection", mode, samples=N_SAMPLES, max_epochs=MAX_EPOCHS)] = result
+        print ("{:<20} {:>8.0f} configs/hour {:>10.1f} epochs/s  peak RSS {} MB  time split {}".format(mode, measures["configs_per_hour"], measures["epochs_per_second"] or float ("nan"),
+               measures["peak_rss_mb"], {k: round (v, 2) for k, v in (measures["time_split"] or {}).items ()}), flush=True)
+
+    save_results (output, results)
+    print ("results written into", output)
+
+    if baseline is not None:
+        print ("\n{:<70} {:>12} {:>12} {:>8}".format("case", "baseline us", "current us", "change"))
+        if compare (results, load_results (baseline)["results"], threshold):
+            exit (1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+'''
+    usage:
+        python benchmarks/bench_network.py [OUTPUT_JSON [BASELINE_JSON [THRESHOLD]]]
+
+    benchmarks the kernels of the training and of the inference of a network on the CUP dataset,
+    over a matrix of hidden_layer_sizes and batch_size (see HIDDEN_LAYER_SIZES and BATCH_SIZES):
+     - the forward pass and the backpropagation of a minibatch (into the buffers of the training workspace)
+     - a training epoch (_do_epoch)
+     - predict and the compiled predictor (compile_predictor) on 1, 32 and 1024 samples
+
+    the results are written into OUTPUT_JSON (default benchmarks/results/network_<date>.json) and, if given, compared with the ones in BASELINE_JSON:
+    the cases slower by more than THRESHOLD (default 0.1, i.e. 10%) are reported as regressions.
+'''
+
+from common import case_name, main
+
+from neural_network import MLPRegressor
+from utility import ReadData
+
+HIDDEN_LAYER_SIZES = [(10,), (50, 50), (100, 100)]
+BATCH_SIZES = [1, 32, 256]
+PREDICT_SIZES = [1, 32, 1024]
+
+_cup = None
+
+def _cup_data ():
+    '''
+        private helper.
+        returns the CUP training set (read once)
+    '''
+    global _cup
+    if _cup is None:
+        data, labels, _, _ = ReadData ("cup/ML-CUP19-TR.csv", 1)
+        _cup = data, labels
+    return _cup
+
+def _prepared_network ( hidden_layer_sizes, batch_size ):
+    '''
+        private helper.
+        returns a network initialized for the training on CUP as fit() does (weights, batch size, workspace) and the training set
+    '''
+    X, y = _cup_data ()
+    model = MLPRegressor (hidden_layer_sizes=hidden_layer_sizes, activation="tanh", batch_size=batch_size, learning_rate_init=0.001, momentum=0.5, random_state=0)
+    X, y = model._check_fit_datasets (X, y)
+    model._initialize_fit (X, y)
+    model._set_batch_size (len(X))
+    model._init_workspace (X, y)
+    return model, X, y
+
+def _forward_pass_case ( hidden_layer_sizes, batch_size ):
+    def setup ():
+        model, X, _ = _prepared_network (hidden_layer_sizes, batch_size)
+        X = X[:batch_size]
+        return lambda: model._forward_pass (X, model._workspace)
+    return {"name": case_name ("network", "forward_pass", hidden=hidden_layer_sizes, batch=batch_size),
+            "params": {"hidden_layer_sizes": hidden_layer_sizes, "batch_size": batch_size}, "setup": setup}
+
+def _backpropagation_case ( hidden_layer_sizes, batch_size ):
+    def setup ():
+        model, X, y = _prepared_network (hidden_layer_sizes, batch_size)
+        layer_nets, layer_outputs = model._forward_pass (X[:batch_size], model._workspace)
+        return lambda: model._backpropagation (layer_nets, layer_outputs, y[:batch_size], model._workspace)
+    return {"name": case_name ("network", "backpropagation", hidden=hidden_layer_sizes, batch=batch_size),
+            "params": {"hidden_layer_sizes": hidden_layer_sizes, "batch_size": batch_size}, "setup": setup}
+
+def _epoch_case ( hidden_layer_sizes, batch_size ):
+    def setup ():
+        model, X, y = _prepared_network (hidden_layer_sizes, batch_size)
+        return lambda: model._do_epoch (X, y)
+    return {"name": case_name ("network", "do_epoch", hidden=hidden_layer_sizes, batch=batch_size),
+            "params": {"hidden_layer_sizes": hidden_layer_sizes, "batch_size": batch_size, "n_samples": len(_cup_data ()[0])}, "setup": setup}
+
+def _predict_case ( hidden_layer_sizes, n_samples, compiled ):
+    def setup ():
+        model, X, _ = _prepared_network (hidden_layer_sizes, 1)
+        X = X[:n_samples]
+        if not compiled:
+            return lambda: model.predict (X)
+        predictor = model.compile_predictor (max(PREDICT_SIZES))
+        if n_samples == 1:
+            return lambda: predictor.predict_one (X[0])
+        return lambda: predictor.predict (X)
+    kernel = "compiled_predict" if compiled else "predict"
+    return {"name": case_name ("network", kernel, hidden=hidden_layer_sizes, samples=n_samples),
+            "params": {"hidden_layer_sizes": hidden_layer_sizes, "n_samples": n_samples}, "setup": setup}
+
+def cases ():
+    for hidden_layer_sizes in HIDDEN_LAYER_SIZES:
+        for batch_size in BATCH_SIZES:
+            yield _forward_pass_case (hidden_layer_sizes, batch_size)
+            yield _backpropagation_case (hidden_layer_sizes, batch_size)
+        for batch_size in BATCH_SIZES:
+            yield _epoch_case (hidden_layer_sizes, batch_size)
+        for n_samples in PREDICT_SIZES:
+            yield _predict_case (hidden_layer_sizes, n_samples, compiled=False)
+            yield _predict_case (hidden_layer_sizes, n_samples, compiled=True)
+
+if __name__ == "__main__":
+    main (cases (), "network", __doc__)
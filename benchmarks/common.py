@@ -0,0 +1,181 @@
+'''
+    helpers shared by the benchmark scripts: timing of the cases, machine information, JSON results and comparison with a baseline.
+
+    every benchmark script defines cases(): a generator of dictionaries with
+        name        unique name of the case, e.g. "network/forward_pass[hidden=(50, 50),batch=32]"
+        params      json-serializable parameters of the case (stored with the results)
+        setup       function without arguments that prepares the data and returns the function to time (also without arguments)
+        repeat      (optional) number of timed repetitions, default 5
+        number      (optional) calls per repetition, by default enough calls to last at least MIN_TIME seconds
+        report      (optional) function of the value returned by the last timed call and of the timings: returns a dictionary of other results of the case
+'''
+
+import os
+import sys
+import json
+import math
+import time
+import platform
+import subprocess
+from datetime import datetime
+
+import numpy as np
+
+# the benchmarks import the modules in the root of the repository
+ROOT = os.path.dirname (os.path.dirname (os.path.realpath (__file__)))
+if ROOT not in sys.path:
+    sys.path.insert (0, ROOT)
+
+RESULTS_DIRECTORY = os.path.join (ROOT, "benchmarks", "results")
+
+# minimum duration in seconds of a timed repetition
+MIN_TIME = 0.05
+# relative slowdown over the baseline reported as a regression
+DEFAULT_THRESHOLD = 0.10
+
+def case_name ( group, kernel, **params ):
+    '''
+        returns the name of a case from its group, kernel and parameters, e.g. network/forward_pass[hidden=(50, 50),batch=32]
+    '''
+    return "{}/{}[{}]".format(group, kernel, ",".join ("{}={}".format(key, value) for key, value in params.items ()))
+
+def measure ( fn, repeat=5, number=None ):
+    '''
+        times fn: returns the dictionary of the timings of a single call in seconds (min, median, mean, std over the repetitions),
+        the number of calls per repetition and the value returned by the last call
+    '''
+    # warm-up call (also used to choose the number of calls per repetition)
+    start = time.perf_counter ()
+    value = fn ()
+    elapsed = time.perf_counter () - start
+    if number is None:
+        number = max (1, math.ceil (MIN_TIME / max (elapsed, 1e-9)))
+
+    timings = []
+    for _ in range (repeat):
+        start = time.perf_counter ()
+        for _ in range (number):
+            value = fn ()
+        timings.append ((time.perf_counter () - start) / number)
+    timings = np.array (timings)
+    return {"min": float (timings.min ()), "median": float (np.median (timings)), "mean": float (timings.mean ()), "std": float (timings.std ()),
+            "repeat": repeat, "number": number}, value
+
+def _git_commit ():
+    '''
+        private helper.
+        returns the current commit of the repository, None if it is not available
+    '''
+    try:
+        return subprocess.run (["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip ()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def _blas_info ():
+    '''
+        private helper.
+        returns the description of the BLAS/LAPACK libraries used by numpy, None if this numpy version does not provide it
+    '''
+    try:
+        config = np.show_config (mode="dicts")
+    except TypeError:
+        return None
+    return config.get ("Build Dependencies", config)
+
+def machine_info ():
+    '''
+        returns a dictionary that describes the machine and the software running the benchmarks
+    '''
+    return {
+        "platform": platform.platform (),
+        "machine": platform.machine (),
+        "processor": platform.processor (),
+        "cpu_count": os.cpu_count (),
+        "python": platform.python_version (),
+        "numpy": np.__version__,
+        "blas": _blas_info (),
+        "omp_num_threads": os.environ.get ("OMP_NUM_THREADS"),
+        "git_commit": _git_commit (),
+    }
+
+def run_cases ( cases, verbose=True ):
+    '''
+        runs the benchmark cases (see the documentation of this module): returns the dictionary name -> results of the case
+    '''
+    results = {}
+    for case in cases:
+        fn = case["setup"] ()
+        timing, value = measure (fn, case.get ("repeat", 5), case.get ("number"))
+        result = {"params": case.get ("params", {})}
+        result.update (timing)
+        if "report" in case:
+            result.update (case["report"] (value, timing))
+        results[case["name"]] = result
+        if verbose:
+            print ("{:<70} {:>12.3f} us".format(case["name"], timing["min"] * 1e6), flush=True)
+    return results
+
+def save_results ( fname, results ):
+    '''
+        writes the results of the cases into the json file fname, together with the date and the machine information
+    '''
+    directory = os.path.dirname (fname)
+    if directory:
+        os.makedirs (directory, exist_ok=True)
+    with open (fname, "w") as fout:
+        json.dump ({"date": datetime.today ().isoformat (), "machine": machine_info (), "results": results}, fout, indent=1)
+
+def load_results ( fname ):
+    '''
+        returns the content of a json file written by save_results
+    '''
+    with open (fname) as fin:
+        return json.load (fin)
+
+def compare ( results, baseline, threshold=DEFAULT_THRESHOLD, verbose=True ):
+    '''
+        compares the minimum time of the cases in results with the ones in baseline (dictionaries name -> results of the case):
+        returns the list of the regressions (name, baseline time, current time), i.e. the cases slower than the baseline by more than threshold (relative).
+        The minimum over the repetitions is the timing least affected by the other processes of the machine.
+    '''
+    regressions = []
+    for name in sorted (set (results) & set (baseline)):
+        before, after = baseline[name]["min"], results[name]["min"]
+        change = after / before - 1
+        if change > threshold:
+            flag = "REGRESSION"
+            regressions.append ((name, before, after))
+        elif change < -threshold:
+            flag = "improved"
+        else:
+            flag = ""
+        if verbose:
+            print ("{:<70} {:>12.3f} {:>12.3f} {:>+8.1%} {}".format(name, before * 1e6, after * 1e6, change, flag))
+    if verbose:
+        missing = sorted (set (baseline) - set (results))
+        if missing:
+            print ("{} cases of the baseline were not run".format(len(missing)))
+        print ("{} regressions over {:.0%}".format(len(regressions), threshold))
+    return regressions
+
+def main ( cases, script_name, usage ):
+    '''
+        command line of a benchmark script: runs the cases, saves the results and compares them with a baseline.
+        arguments: [OUTPUT_JSON [BASELINE_JSON [THRESHOLD]]], the exit code is 1 if there are regressions
+    '''
+    if len(sys.argv) > 1 and sys.argv[1] in ("-h", "--help"):
+        print (usage)
+        exit ()
+
+    output = sys.argv[1] if len(sys.argv) > 1 else os.path.join (RESULTS_DIRECTORY, "{}_{}.json".format(script_name, datetime.today ().isoformat ().replace (':', '_')))
+    baseline = sys.argv[2] if len(sys.argv) > 2 else None
+    threshold = float (sys.argv[3]) if len(sys.argv) > 3 else DEFAULT_THRESHOLD
+
+    results = run_cases (cases)
+    save_results (output, results)
+    print ("results written into", output)
+
+    if baseline is not None:
+        print ("\n{:<70} {:>12} {:>12} {:>8}".format("case", "baseline us", "current us", "change"))
+        if compare (results, load_results (baseline)["results"], threshold):
+            exit (1)
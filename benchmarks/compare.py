@@ -0,0 +1,33 @@
+'''
+    usage:
+        python benchmarks/compare.py RESULTS_JSON BASELINE_JSON [THRESHOLD]
+
+    compares two result files written by the benchmark scripts: prints the time of each case in both files and flags the cases
+    slower than the baseline by more than THRESHOLD (default 0.1, i.e. 10%). The exit code is 1 if there are regressions.
+'''
+
+import sys
+
+from common import DEFAULT_THRESHOLD, compare, load_results
+
+def main ():
+    if len(sys.argv) < 3:
+        print (__doc__)
+        exit ()
+
+    results = load_results (sys.argv[1])
+    baseline = load_results (sys.argv[2])
+    threshold = float (sys.argv[3]) if len(sys.argv) > 3 else DEFAULT_THRESHOLD
+
+    for name, content in [("baseline", baseline), ("results", results)]:
+        machine = content["machine"]
+        print ("{}: {} on {} ({} cpus), numpy {}, commit {}".format(name, content["date"], machine["platform"], machine["cpu_count"], machine["numpy"], machine["git_commit"]))
+    if baseline["machine"]["platform"] != results["machine"]["platform"] or baseline["machine"]["cpu_count"] != results["machine"]["cpu_count"]:
+        print ("warning: the results come from different machines")
+
+    print ("\n{:<70} {:>12} {:>12} {:>8}".format("case", "baseline us", "current us", "change"))
+    if compare (results["results"], baseline["results"], threshold):
+        exit (1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,24 @@
+'''
+    usage:
+        python benchmarks/run_all.py [OUTPUT_JSON [BASELINE_JSON [THRESHOLD]]]
+
+    runs all the benchmarks (bench_functions.py, bench_network.py, bench_fit.py) and writes their results into a single json file
+    (default benchmarks/results/all_<date>.json) together with the machine information.
+
+    to save a baseline run e.g. "python benchmarks/run_all.py benchmarks/results/baseline.json", then compare a later version with it:
+    "python benchmarks/run_all.py benchmarks/results/new.json benchmarks/results/baseline.json".
+    The cases slower than the baseline by more than THRESHOLD (default 0.1, i.e. 10%) are reported as regressions and the exit code is 1.
+
+    the end-to-end throughput of the model selection is measured separately by bench_model_selection.py (it takes longer).
+'''
+
+import itertools
+
+from common import main
+
+import bench_functions
+import bench_network
+import bench_fit
+
+if __name__ == "__main__":
+    main (itertools.chain (bench_functions.cases (), bench_network.cases (), bench_fit.cases ()), "all", __doc__)
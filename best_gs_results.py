@@ -1,9 +1,11 @@
 '''
     usage:
-        python best_gs_results.py [ N [format] ]
+        python best_gs_results.py [ N [format [folder [param=value ...] ] ] ]
     retrieves best N gridSearch results in the folder "model_selection_results" and output them using the specified format.
     N defaults to 10
     format defaults to "tsv". It can be either "tsv" (print tab-separated-value parameters) or "dict" (print python dict literal)
+    param=value pairs restrict the results to the ones with those parameters values, 
+    e.g. activation=tanh "hidden_layer_sizes=[50, 50]" early_stopping=false (values are parsed as json, otherwise taken as strings)
 '''
 
 import sys
@@ -24,9 +26,17 @@ def main ():
     if len(sys.argv) > 3:
         folder = sys.argv[3]
 
+    filters = {}
+    for arg in sys.argv[4:]:
+        key, value = arg.split ("=", 1)
+        try:
+            filters[key] = json.loads (value)
+        except ValueError:
+            filters[key] = value
+
     fileprefix = ""
 
-    results = getBestRes (fileprefix, folder, n_best)
+    results = getBestRes (fileprefix, folder, n_best, **filters)
 
     print ("TOP {} RESULTS IN FOLDER {}/{}* :".format(n_best, folder, fileprefix))
 
@@ -3,12 +3,99 @@ import os
 from datetime import datetime
 import itertools
 import json
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
 import numpy as np
 import tqdm
 
 from functions import *
 from utility import CreateLossPlot
+from model_stack import fit_stacked
+from neural_network import BaseNeuralNetwork, save_models, load_models
+
+def _fit_models ( models, X, y, stacked ):
+    '''
+        private helper, run by the worker processes of Ensembler.fit().
+        trains the models (copies of the constituent models received by the worker) and returns them to the parent process.
+    '''
+    if stacked:
+        fit_stacked (models, X, y)
+    else:
+        for model in models:
+            model.fit (X, y)
+    return models
+
+def _predict_model ( model, X, errstate=None ):
+    '''
+        private helper, run by the workers of Ensembler.predict().
+        returns the predictions of the model for the dataset X, using the numpy floating point error handling errstate (it is per-thread)
+    '''
+    with np.errstate (**(errstate or np.geterr())):
+        return model.predict (X)
+
+# maximum number of samples of a forward pass of a _FusedGroup
+_FUSED_CHUNK_SIZE = 128
+
+def _fused_group_key ( model ):
+    '''
+        private helper.
+        returns what must be the same for the networks predicted by the same _FusedGroup: layer sizes, activation functions, dtype and labels threshold
+    '''
+    return ( tuple(model._layer_sizes ()), model._hidden_activation, model._output_activation, model._params.dtype, model._threshold )
+
+class _FusedGroup:
+    '''
+        private class.
+        snapshot of the weights of K networks that share _fused_group_key, laid out for a single forward pass of all of them:
+        the first layers are concatenated side by side into one (n_features, K*m) matrix (the input is the same for all the networks),
+        the deeper layers are stacked into (K, n, m) tensors for a batched matrix product.
+    '''
+
+    def __init__ ( self, models, indexes ):
+        '''
+            :param: models networks of the group
+            :param: indexes positions of the networks among the constituents of the ensemble
+        '''
+        first = models[0]
+        self.indexes = indexes
+        self.n_models = len(models)
+        self.first_size = first._coefs[0].shape[1]
+        self.first_coef = np.concatenate ([model._coefs[0] for model in models], axis=1)
+        self.first_intercept = np.concatenate ([model._intercepts[0] for model in models])
+        self.coefs = [np.stack ([model._coefs[i] for model in models]) for i in range (1, len(first._coefs))]
+        self.intercepts = [np.stack ([model._intercepts[i] for model in models])[:, np.newaxis, :] for i in range (1, len(first._coefs))]
+        n_layers = len(first._coefs)
+        self.activations = [first._hidden_activation] * (n_layers - 1) + [first._output_activation]
+        self.threshold = first._threshold
+        self.n_outputs = first._weights[-1].shape[1]
+
+    def predict ( self, X ):
+        '''
+            returns the predictions of the networks of the group for the dataset X, of shape (K, n_samples, n_outputs)
+        '''
+        X = np.asarray (X, dtype=self.first_coef.dtype)
+        predictions = np.empty ( (self.n_models, len(X), self.n_outputs), dtype=X.dtype )
+        # chunks of samples small enough to keep the outputs of the layers of all the networks in cache
+        for start in range (0, len(X), _FUSED_CHUNK_SIZE):
+            predictions[:, start:start+_FUSED_CHUNK_SIZE] = self._pass (X[start:start+_FUSED_CHUNK_SIZE])
+        return predictions
+
+    def _pass ( self, X ):
+        '''
+            private method.
+            forward pass of all the networks of the group on the samples X
+        '''
+        out = np.matmul (X, self.first_coef)
+        out += self.first_intercept
+        self.activations[0] (out, out=out)
+        out = np.ascontiguousarray (out.reshape (len(X), self.n_models, self.first_size).transpose (1, 0, 2))
+        for coef, intercept, activation in zip (self.coefs, self.intercepts, self.activations[1:]):
+            out = np.matmul (out, coef)
+            out += intercept
+            activation (out, out=out)
+        if self.threshold is not None:
+            out = (out >= self.threshold).astype (out.dtype)
+        return out
 
 class Ensembler:
     '''
@@ -16,18 +103,49 @@ class Ensembler:
         the prediction for the ensemble are the average of the predictions of the constituent models.
     '''
 
-    def __init__ (self, base_models, models_names = None, verbose=False):
+    def __init__ (self, base_models, models_names = None, verbose=False, stacked=False, n_jobs=None, predict_backend="thread"):
         '''
             initializa the Enemble model given the base models and their names. If the names are not specified they default to "model0", "model1", ...
 
             the verbose flag shows a progress bar during the fit() operation
+            the stacked flag makes fit() train together the constituent models that have the same architecture (see model_stack.ModelStack)
+
+            with n_jobs > 1 (or -1 for all the cpus) fit() trains the constituent models on a pool of n_jobs processes (the models must be picklable),
+            predict() computes their predictions on a pool of threads or processes according to predict_backend ("thread" or "process").
+
+            with predict_backend="fused" the constituent networks with the same layer sizes, activation functions and dtype are predicted together
+            by a single batched forward pass (see _FusedGroup), the other models one by one. The fused weights are a snapshot taken by the first
+            prediction after fit(): call reset_fused_predictor() if the weights of the constituent models are changed in another way.
         '''
         self.models = base_models
         self.verbose = verbose
+        self.stacked = stacked
+        self.n_jobs = n_jobs
+        if predict_backend not in ("thread", "process", "fused"):
+            raise ValueError ("predict backend {} not implemented".format(predict_backend))
+        self.predict_backend = predict_backend
+        self._fused_groups = None
         self.names = models_names
         if models_names is None:
             self.names = ["model"+str(i) for i in range (len(self.models))]
     
+    def save ( self, fname ):
+        '''
+            saves the constituent models (they must be neural networks) and their names into the file fname, see neural_network.save_models
+        '''
+        save_models (fname, self.models, self.names)
+
+    @classmethod
+    def load ( cls, fname, mmap=True, **kwargs ):
+        '''
+            returns an ensemble of the models saved into the file fname by save(), see neural_network.load_models.
+            kwargs are the other arguments of the constructor (verbose, stacked, n_jobs, predict_backend).
+
+            e.g. ens = Ensembler.load ("ensemble.ann", n_jobs=4)
+        '''
+        models, names = load_models (fname, mmap)
+        return cls (models, names, **kwargs)
+
     def get_params ( self ):
         '''
             Returns a dictionary which keys are the model names and which values are their parameters.
@@ -75,7 +193,7 @@ class Ensembler:
         self._report_folder = "ensemble_reports/"+foldername
         os.makedirs (self._report_folder, exist_ok=True)
 
-        models_predictions = np.array ( [model.predict (X) for model in self.models] )
+        models_predictions = self._constituents_predictions (X)
         ensemble_predictions = np.mean (models_predictions, axis=0)
 
         report_fname = self._report_folder + "/scores.tsv"
@@ -101,12 +219,103 @@ class Ensembler:
             score = self._report_accuracy (y, ensemble_predictions)
             print ("{}\t{}".format("ensemble", score), file=report_fout)
 
+    def _is_parallel ( self ):
+        '''
+            private method.
+            returns True if the constituent models have to be trained and queried in parallel
+        '''
+        return self.n_jobs is not None and self.n_jobs != 1 and len(self.models) > 1
+
+    def _max_workers ( self ):
+        '''
+            private method.
+            returns the number of workers of the pools (None for the number of cpus)
+        '''
+        return None if self.n_jobs < 0 else min (self.n_jobs, len(self.models))
+
+    def reset_fused_predictor ( self ):
+        '''
+            drops the snapshot of the weights used by predict_backend="fused", it is taken again by the next prediction
+        '''
+        self._fused_groups = None
+
+    def _fused_predictions ( self, X ):
+        '''
+            private method.
+            returns the array of the predictions of each constituent model for the dataset X (as _constituents_predictions),
+            computing the ones of the networks of each group with a single forward pass
+        '''
+        if self._fused_groups is None:
+            groups = {}
+            for i, model in enumerate (self.models):
+                if isinstance (model, BaseNeuralNetwork):
+                    groups.setdefault (_fused_group_key (model), []).append (i)
+            self._fused_groups = [_FusedGroup ([self.models[i] for i in indexes], indexes) for indexes in groups.values ()]
+
+        predictions = [None] * len(self.models)
+        for group in self._fused_groups:
+            for i, group_predictions in zip (group.indexes, group.predict (X)):
+                predictions[i] = group_predictions
+        for i, model in enumerate (self.models):
+            if predictions[i] is None:
+                predictions[i] = model.predict (X)
+        return np.array (predictions)
+
+    def _constituents_predictions ( self, X ):
+        '''
+            private method.
+            returns the array of the predictions of each constituent model for the dataset X, of shape (n_models, n_samples, n_outputs)
+        '''
+        if self.predict_backend == "fused":
+            return self._fused_predictions (X)
+
+        if not self._is_parallel ():
+            return np.array ( [model.predict (X) for model in self.models] )
+
+        if self.predict_backend == "thread":
+            executor = ThreadPoolExecutor (max_workers=self._max_workers ())
+        else:
+            executor = ProcessPoolExecutor (max_workers=self._max_workers ())
+        with executor:
+            futures = [executor.submit (_predict_model, model, X, np.geterr()) for model in self.models]
+            return np.array ( [future.result () for future in futures] )
+
     def predict ( self, X ):
-        models_predictions = np.array ( [model.predict (X) for model in self.models] )
+        models_predictions = self._constituents_predictions (X)
         ensemble_predictions = np.mean (models_predictions, axis=0)
         return ensemble_predictions
-    
+
+    def _parallel_fit ( self, X, y ):
+        '''
+            private method.
+            trains the constituent models on a pool of processes. 
+            Every worker trains copies of some of the models and sends them back: 
+            their state (weights, fitted attributes...) is then copied into the constituent models of the ensemble.
+            With the stacked flag the models are split among the workers in n_jobs chunks, each one trained with fit_stacked().
+        '''
+        indexes = list (range (len(self.models)))
+        if self.stacked:
+            n_chunks = self._max_workers () or os.cpu_count ()
+            chunks = [indexes[i::n_chunks] for i in range (n_chunks) if indexes[i::n_chunks]]
+        else:
+            chunks = [[i] for i in indexes]
+
+        with ProcessPoolExecutor (max_workers=self._max_workers ()) as executor:
+            futures = {executor.submit (_fit_models, [self.models[i] for i in chunk], X, y, self.stacked): chunk for chunk in chunks}
+            for future in tqdm.tqdm (as_completed (futures), total=len(futures), desc="ensemble fit", disable=not self.verbose):
+                for i, trained_model in zip (futures[future], future.result ()):
+                    self.models[i].__dict__.update (trained_model.__dict__)
+
     def fit ( self, X, y ):
+        self.reset_fused_predictor ()
+        if self._is_parallel ():
+            self._parallel_fit (X, y)
+            return
+
+        if self.stacked:
+            fit_stacked (self.models, X, y)
+            return
+
         if self.verbose:
             iterator = tqdm.tqdm (self.models, desc="ensemble fit")
         else:
@@ -137,6 +346,7 @@ class Ensembler:
         
         assert loss in loss_functions, "loss function {} not implemented".format(loss)
         loss_fun = loss_functions[loss]
+        self.reset_fused_predictor ()
 
         generators = {name: model.fit_iterator(X,y) for name, model in zip (self.names, self.models)}       
         trained_models = {}
@@ -181,13 +391,11 @@ class Ensembler:
                 
                 models_predictions = np.array ( [model.predict (X) for model in self.models] )
                 ensemble_predictions = np.mean (models_predictions, axis=0)
-                losses_matrix = loss_fun (y, ensemble_predictions)
-                train_loss = np.average (np.sum(losses_matrix, axis=1))
+                train_loss = loss_fun (y, ensemble_predictions, reduction="sum") / len(ensemble_predictions)
 
                 models_predictions = np.array ( [model.predict (X_reporting) for model in self.models] )
                 ensemble_predictions = np.mean (models_predictions, axis=0)
-                losses_matrix = loss_fun (y_reporting, ensemble_predictions)
-                valid_loss = np.average (np.sum(losses_matrix, axis=1))
+                valid_loss = loss_fun (y_reporting, ensemble_predictions, reduction="sum") / len(ensemble_predictions)
 
                 print (str(epoch_no) + "\t" + str(train_loss) + "\t" + str(valid_loss), file=fout)
 
@@ -1,55 +1,86 @@
 
 import numpy as np
-import math
 
 ############################
 #   ACTIVATION FUNCTIONS   #
 ############################
 
-def _relu (x):
+# every activation function (and derivative) works on whole numpy arrays at once.
+# the optional parameter `out` is a preallocated array (same shape of x) that receives the result:
+# it can be x itself to compute the function in place.
+
+def _as_float_array (x):
+    '''
+        private helper.
+        converts x into a floating point array (integer inputs are promoted to float, floating point inputs keep their precision)
+    '''
+    x = np.asarray (x)
+    if x.dtype.kind != 'f':
+        x = x.astype (float)
+    return x
+
+def _prepare_output (x, out):
+    '''
+        private helper.
+        converts x into a floating point array and returns it together with the array where the result has to be written:
+        out if given, a new array shaped like x otherwise.
+    '''
+    x = _as_float_array (x)
+    if out is None:
+        out = np.empty_like (x)
+    return x, out
+
+def relu (x, out=None):
     '''
         REctified Linear Unit acivation function: relu(x) = max(0,x)
     '''
-    return max(0,x)
+    x, out = _prepare_output (x, out)
+    return np.maximum (x, 0., out=out)
 
-def _identity (x):
+def identity (x, out=None):
     '''
         identity function: identity(x) = x
     '''
-    return x
+    x, out = _prepare_output (x, out)
+    return np.positive (x, out=out)
 
-def _threshold (x):
+def threshold (x, out=None):
     '''
         threshold activation function: treshold(x) = 1 if x>0
                                        treshold(x) = 0 if x<=0
     '''
-    return 1 if x>0 else 0
+    x, out = _prepare_output (x, out)
+    return np.heaviside (x, 0., out=out)
 
-def _logistic (x):
+def logistic (x, out=None):
     '''
         logistic activation function: logistic(x) = 1 / (1 + exp(-x))
+
+        numerically stable implementation: exp is only evaluated on -|x| so it never overflows,
+        for negative x the equivalent form exp(x) / (1 + exp(x)) is used.
     '''
-    return 1 / ( 1 + math.exp(-x) )
+    x, out = _prepare_output (x, out)
+    negative = x < 0
+    e = np.exp (-np.abs (x))
+    np.divide (1., 1. + e, out=out)
+    return np.multiply (out, e, out=out, where=negative)
 
-def _tanh (x):
+def tanh (x, out=None):
     '''
         tanh activation function (returns hyperbolic tangent of the input) = tanh(x)
     '''
-    return math.tanh (x)
+    x, out = _prepare_output (x, out)
+    return np.tanh (x, out=out)
 
-def _zero_one_tanh (x):
+def zero_one_tanh (x, out=None):
     '''
         tanh activation function which output is from zero to one: _zero_one_tanh(x) = (1 + tanh(x))/2
     '''
-    return (1 + math.tanh (x))/2
-
-
-relu = np.vectorize (_relu, otypes=[float])
-identity = np.vectorize (_identity, otypes=[float])
-threshold = np.vectorize (_threshold, otypes=[float])
-logistic = np.vectorize (_logistic, otypes=[float])
-tanh = np.vectorize (_tanh, otypes=[float])
-zero_one_tanh = np.vectorize (_zero_one_tanh, otypes=[float])
+    x, out = _prepare_output (x, out)
+    np.tanh (x, out=out)
+    out += 1
+    out *= 0.5
+    return out
 
 activation_functions = {
     "relu": relu,
@@ -65,49 +96,52 @@ activation_functions = {
 #   ACTIVATION FUNCTIONS DERIVATIVES   #
 ########################################
 
-def _relu_derivative (x):
+def relu_derivative (x, out=None):
     '''
-        REctified Linear Unit activation function derivative: relu'(x) = 0 if x<0
-                                                              relu'(x) = 1 if x>=0
+        REctified Linear Unit activation function derivative: relu'(x) = 0 if x<=0
+                                                              relu'(x) = 1 if x>0
     '''
-    return 0 if x<=0 else 1
+    x, out = _prepare_output (x, out)
+    return np.heaviside (x, 0., out=out)
 
-def _identity_derivative (x):
+def identity_derivative (x, out=None):
     '''
         identity function derivative: identity'(x) = 1
     '''
-    return 1
+    x, out = _prepare_output (x, out)
+    out.fill (1)
+    return out
 
-def _threshold_derivative (x):
+def threshold_derivative (x, out=None):
     '''
         threshold activation function derivative: treshold'(x) = 0
     '''
-    return 0
+    x, out = _prepare_output (x, out)
+    out.fill (0)
+    return out
 
-def _logistic_derivative (x):
+def logistic_derivative (x, out=None):
     '''
         logistic activation function derivative: logistic'(x) = logistic(x) * ( 1 - logistic(x) )
     '''
-    return _logistic(x) * ( 1 - _logistic (x) )
+    out = logistic (x, out)
+    return np.multiply (out, 1 - out, out=out)
 
-def _tanh_derivative (x):
+def tanh_derivative (x, out=None):
     '''
         tanh activation function derivatives: tanh'(x) = 1 - (tanh(x))**2
     '''
-    return 1 - (math.tanh (x))**2
+    out = tanh (x, out)
+    np.square (out, out=out)
+    return np.subtract (1, out, out=out)
 
-def _zero_one_tanh_derivative (x):
+def zero_one_tanh_derivative (x, out=None):
     '''
         zero-one tanh activation function derivatives: tanh'(x) = 1/2 * ( 1 - (tanh(x))**2 )
     '''
-    return 1/2 * ( 1 - (math.tanh (x))**2 )
-
-relu_derivative = np.vectorize (_relu_derivative, otypes=[float])
-identity_derivative = np.vectorize (_identity_derivative, otypes=[float])
-threshold_derivative = np.vectorize (_threshold_derivative, otypes=[float])
-logistic_derivative = np.vectorize (_logistic_derivative, otypes=[float])
-tanh_derivative = np.vectorize (_tanh_derivative, otypes=[float])
-zero_one_tanh_derivative = np.vectorize (_zero_one_tanh_derivative, otypes=[float])
+    out = tanh_derivative (x, out)
+    out *= 0.5
+    return out
 
 activation_functions_derivatives = {
     "relu": relu_derivative,
@@ -118,17 +152,101 @@ activation_functions_derivatives = {
     "zero_one_tanh": zero_one_tanh_derivative
 }
 
+#######################################################
+#   ACTIVATION FUNCTIONS DERIVATIVES FROM THE OUTPUT  #
+#######################################################
+
+# the same derivatives of the previous section, but computed from the output o = f(x) of the activation function instead of its input x:
+# backpropagation reuses the outputs of the forward pass and avoids computing exp or tanh again.
+# here the out buffer cannot be o itself.
+
+def relu_output_derivative (o, out=None):
+    '''
+        REctified Linear Unit activation function derivative: relu'(x) = 0 if o<=0
+                                                              relu'(x) = 1 if o>0
+        o = relu(x) is positive iff x is positive, so the output works as the mask of the positive inputs.
+    '''
+    o, out = _prepare_output (o, out)
+    return np.heaviside (o, 0., out=out)
+
+def identity_output_derivative (o, out=None):
+    '''
+        identity function derivative: identity'(x) = 1
+    '''
+    return identity_derivative (o, out)
+
+def threshold_output_derivative (o, out=None):
+    '''
+        threshold activation function derivative: treshold'(x) = 0
+    '''
+    return threshold_derivative (o, out)
+
+def logistic_output_derivative (o, out=None):
+    '''
+        logistic activation function derivative: logistic'(x) = o * (1 - o) where o = logistic(x)
+    '''
+    o, out = _prepare_output (o, out)
+    np.subtract (1, o, out=out)
+    out *= o
+    return out
+
+def tanh_output_derivative (o, out=None):
+    '''
+        tanh activation function derivatives: tanh'(x) = 1 - o**2 where o = tanh(x)
+    '''
+    o, out = _prepare_output (o, out)
+    np.square (o, out=out)
+    return np.subtract (1, out, out=out)
+
+def zero_one_tanh_output_derivative (o, out=None):
+    '''
+        zero-one tanh activation function derivatives: tanh'(x) = 1/2 * ( 1 - (2*o - 1)**2 ) = 2 * o * (1 - o) where o = zero_one_tanh(x)
+    '''
+    out = logistic_output_derivative (o, out)
+    out *= 2
+    return out
+
+activation_functions_output_derivatives = {
+    "relu": relu_output_derivative,
+    "identity": identity_output_derivative,
+    "threshold": threshold_output_derivative,
+    "logistic": logistic_output_derivative,
+    "tanh": tanh_output_derivative,
+    "zero_one_tanh": zero_one_tanh_output_derivative
+}
+
 ######################
 #   LOSS FUNCTIONS   #
 ######################
 
-def _squaredLoss ( true_output, predicted_output ):
+# every loss function takes the arrays of true outputs T and predicted outputs P (same shape) and returns:
+#  - the matrix of the element-wise losses if reduction is None
+#  - the sum of all the element-wise losses if reduction is "sum": the matrix of the losses is never built.
+# the average loss over the samples of a dataset is then loss(T, P, reduction="sum") / n_samples.
+
+_LOG_LOSS_EPS = 1e-6
+
+def _check_reduction (reduction):
+    '''
+        private helper.
+        raises an error if the requested reduction is not implemented
+    '''
+    if reduction not in (None, "sum"):
+        raise ValueError ("loss reduction {} not implemented".format(reduction))
+
+def squaredLoss ( true_output, predicted_output, reduction=None ):
     '''
         squared loss: squaredLoss (t, p) = 1/2 * (t - p)^2 
     '''
-    return 1/2 * (true_output - predicted_output)**2
+    _check_reduction (reduction)
+    differences = np.subtract (_as_float_array (true_output), _as_float_array (predicted_output))
+    if reduction == "sum":
+        return 0.5 * np.vdot (differences, differences)
+    np.square (differences, out=differences)
+    differences *= 0.5
+    return differences
 
-def _binaryLogLoss ( true_output, predicted_output ):
+def binaryLogLoss ( true_output, predicted_output, reduction=None ):
     '''
         loss function for binary classification task: binaryLogLoss(t,p) = - (t * log(p) + (1-t) * log(1-p))
         t ∈ {0,1} is the true class.
@@ -139,15 +257,14 @@ def _binaryLogLoss ( true_output, predicted_output ):
         -log(1e-6)    if t==1-p instead of -log(0) that would be -∞
 
     '''
-    eps = 1e-6
-    if true_output>0.5:
-        return -math.log(max(predicted_output,eps))
-    else:
-        return -math.log(max(1-predicted_output,eps))
-
-
-squaredLoss = np.vectorize (_squaredLoss, otypes=[float])
-binaryLogLoss = np.vectorize (_binaryLogLoss, otypes=[float])
+    _check_reduction (reduction)
+    predicted_output = _as_float_array (predicted_output)
+    clipped = np.where (_as_float_array (true_output) > 0.5, predicted_output, 1 - predicted_output)
+    np.maximum (clipped, _LOG_LOSS_EPS, out=clipped)
+    np.log (clipped, out=clipped)
+    if reduction == "sum":
+        return -np.sum (clipped)
+    return np.negative (clipped, out=clipped)
 
 loss_functions = {
     "squared": squaredLoss,
@@ -158,13 +275,13 @@ loss_functions = {
 #   LOSS FUNCTIONS DERIVATIVES   #
 ##################################
 
-def _squaredLoss_derivative ( true_output, predicted_output ):
+def squaredLoss_derivative ( true_output, predicted_output, out=None ):
     '''
         squared loss derivative wrt predicted output p: squaredLoss' (t, p) = -(t - p)
     '''
-    return predicted_output - true_output
+    return np.subtract (_as_float_array (predicted_output), _as_float_array (true_output), out=out)
 
-def _binaryLogLoss_derivative ( true_output, predicted_output ):
+def binaryLogLoss_derivative ( true_output, predicted_output, out=None ):
     '''
         derivative of the loss function for binary classification task wrt predicted output p: 
         binaryLogLoss'(t,p) = - (t/p - (1-t)/(1-p))
@@ -179,20 +296,79 @@ def _binaryLogLoss_derivative ( true_output, predicted_output ):
           1/1e-6        if t==0 and p==1 instead of  1/0 that would be  ∞
 
     '''
-    eps = 1e-6
-    if true_output > 0.5:
-        return -1/max(predicted_output, eps)
-    else:
-        return 1/max(1-predicted_output, eps)
-
-squaredLoss_derivative = np.vectorize ( _squaredLoss_derivative, otypes=[float] )
-binaryLogLoss_derivative = np.vectorize ( _binaryLogLoss_derivative, otypes=[float] )
+    predicted_output, clipped = _prepare_output (predicted_output, out)
+    positive = _as_float_array (true_output) > 0.5
+    # predicted probability of the true class
+    np.subtract (1, predicted_output, out=clipped)
+    np.copyto (clipped, predicted_output, where=positive)
+    np.maximum (clipped, _LOG_LOSS_EPS, out=clipped)
+    derivatives = np.reciprocal (clipped, out=clipped)
+    return np.negative (derivatives, out=derivatives, where=positive)
 
 loss_functions_derivatives = {
     "squared": squaredLoss_derivative,
     "log_loss": binaryLogLoss_derivative
 }
 
+####################################
+#   FUSED LOSSES AND DERIVATIVES   #
+####################################
+
+# every fused function computes in one pass the losses (with the same reduction of the loss functions) and the derivatives wrt the predicted output
+# (written into out, if given, as the derivatives functions): the training uses them when it also needs the loss of each minibatch.
+
+def _squaredLoss_and_derivative ( true_output, predicted_output, reduction=None, out=None ):
+    '''
+        computes in one pass the squared loss and its derivative wrt predicted output p:
+        squaredLoss (t, p) = 1/2 * (t - p)^2
+        squaredLoss' (t, p) = -(t - p)
+        
+        returns the pair (losses, derivatives)
+    '''
+    _check_reduction (reduction)
+    derivatives = np.subtract (_as_float_array (predicted_output), _as_float_array (true_output), out=out)
+    if reduction == "sum":
+        losses = 0.5 * np.vdot (derivatives, derivatives)
+    else:
+        losses = np.square (derivatives)
+        losses *= 0.5
+    return losses, derivatives
+
+def _binaryLogLoss_and_derivative ( true_output, predicted_output, reduction=None, out=None ):
+    '''
+        computes in one pass the loss function for binary classification task and its derivative wrt predicted output p:
+        binaryLogLoss(t,p) = - (t * log(p) + (1-t) * log(1-p))
+        binaryLogLoss'(t,p) = - (t/p - (1-t)/(1-p))
+        
+        t ∈ {0,1} is the true class.
+        p ∈ [0,1] is the predicted probability for class 1.
+
+        the predicted probability of the true class (p if t==1, 1-p if t==0) is clipped to 1e-6 
+        so that the logarithm and its inverse never reach the extreme values -∞ and ∞.
+
+        returns the pair (losses, derivatives)
+    '''
+    _check_reduction (reduction)
+    predicted_output, clipped = _prepare_output (predicted_output, out)
+    positive = _as_float_array (true_output) > 0.5
+    # predicted probability of the true class
+    np.subtract (1, predicted_output, out=clipped)
+    np.copyto (clipped, predicted_output, where=positive)
+    np.maximum (clipped, _LOG_LOSS_EPS, out=clipped)
+    logs = np.log (clipped)
+    if reduction == "sum":
+        losses = -np.sum (logs)
+    else:
+        losses = np.negative (logs, out=logs)
+    derivatives = np.reciprocal (clipped, out=clipped)
+    np.negative (derivatives, out=derivatives, where=positive)
+    return losses, derivatives
+
+loss_functions_and_derivatives = {
+    "squared": _squaredLoss_and_derivative,
+    "log_loss": _binaryLogLoss_and_derivative
+}
+
 ##########################
 #   ACCURACY FUNCTIONS   #
 ##########################
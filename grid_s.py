@@ -6,7 +6,17 @@ from utility import ReadData
 from utility import GridSearchCV
 from utility import getRandomParams
 
-import tqdm
+
+def search_space(n_samples):
+    '''
+    returns the set of hyper-parameters values of the random search on a development set of n_samples samples
+    (the largest batch size is the whole development set)
+    '''
+    return [ {'hidden_layer_sizes': [(10,10), (20,), (50,) ,(100,), (50,50)] , 'alpha': [0., 0.05], 
+        'batch_size': [1, 5, 10, 50, 100, 'auto', 500, n_samples],
+         'learning_rate': ['constant', 'adaptive', 'linear'], 'learning_rate_init': [0.001, 0.1], 'momentum': [0., 0.9],
+        'early_stopping': [True, False], 'activation': ['relu', 'tanh', 'logistic'],
+        "weights_init_fun": ["random_uniform", "random_normal"], "weights_init_value": [0.2, 0.8] } ]
 
 def main():
     '''
@@ -15,6 +25,10 @@ def main():
     n_configurations = 10
     if len(sys.argv) > 1:
         n_configurations = int (sys.argv[1])
+    # number of worker processes (-1: all the cpus)
+    n_jobs = None
+    if len(sys.argv) > 2:
+        n_jobs = int (sys.argv[2])
 
     '''
     the development set is 90% of data of the cup dataset
@@ -31,14 +45,11 @@ def main():
     '''
     set of hyper-parameters values
     '''
-    params=[ {'hidden_layer_sizes': [(10,10), (20,), (50,) ,(100,), (50,50)] , 'alpha': [0., 0.05], 
-        'batch_size': [1, 5, 10, 50, 100, 'auto', 500, len(data)],
-         'learning_rate': ['constant', 'adaptive', 'linear'], 'learning_rate_init': [0.001, 0.1], 'momentum': [0., 0.9],
-        'early_stopping': [True, False], 'activation': ['relu', 'tanh', 'logistic'],
-        "weights_init_fun": ["random_uniform", "random_normal"], "weights_init_value": [0.2, 0.8] } ]
+    params = search_space(len(data))
 
-    for i in tqdm.tqdm (range (n_configurations), desc="configurations"):
-        randparams = getRandomParams(params)
-        ResList, minIdx = GridSearchCV(nn, randparams, data, labels, _euclidean_loss, 5, uniquefile=True, write_best=False)
+    # all the random configurations are drawn first and evaluated by a single grid search (in parallel with n_jobs)
+    randparams = [getRandomParams(params)[0] for i in range (n_configurations)]
+    ResList, minIdx = GridSearchCV(nn, randparams, data, labels, _euclidean_loss, 5, uniquefile=True, write_best=False, n_jobs=n_jobs)
 
-main()
+if __name__ == "__main__":
+    main()
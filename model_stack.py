@@ -0,0 +1,333 @@
+
+import numpy as np
+from sklearn.model_selection import train_test_split
+
+from neural_network import BaseNeuralNetwork, MLPClassifier, _Workspace, _split_parameters
+
+def _stack_key ( model ):
+    '''
+        private helper.
+        returns the hyper-parameters that must be the same for all the networks trained in the same stack:
+        architecture, activation and loss functions, minibatches, shuffling, validation split and floating point precision.
+        The other hyper-parameters (alpha, momentum, learning rate schedule, tol, n_iter_no_change, max_iter, checkpoint_interval, weights init., random_state) can differ.
+    '''
+    return ( type(model), tuple(model.hidden_layer_sizes), model.activation, model.out_activation_, model._loss_fun_name, model.batch_size,
+             model.shuffle, model.early_stopping, model.validation_fraction if model.early_stopping else None, np.dtype(model.dtype) )
+
+def _is_stackable ( model ):
+    '''
+        private helper.
+        returns True if the model can be trained inside a ModelStack: reports and debug output are only produced by fit(),
+        the training loss accumulated from the minibatches (loss_evaluation="accumulated") is not implemented by the stack
+    '''
+    if not isinstance (model, BaseNeuralNetwork):
+        return False
+    if model.loss_evaluation != "full" and not model.early_stopping:
+        return False
+    debug_flags = [model._do_reporting, model._debug_forward_pass, model._debug_backward_pass, model._debug_epochs, model._debug_early_stopping]
+    return not any (debug_flags)
+
+class ModelStack:
+    '''
+        trains at once a stack of K neural networks with the same architecture on the same dataset.
+
+        The weights of all the networks are held in a single (K, n_params) buffer and every forward pass, backpropagation and
+        weights update is a batched matrix operation over the K networks, so the per-minibatch overhead is paid once for the whole stack.
+
+        Each network keeps its own hyper-parameters (alpha, momentum, learning rate schedule, tol, n_iter_no_change, max_iter, checkpoint_interval),
+        its own random generator (used for the weights initialization and the shuffling) and its own convergence state:
+        it is trained for the same epochs and gets the same weights (up to floating point rounding) as with network.fit(X, y).
+        When a network converges it is removed from the stack and the training of the others goes on.
+
+        The only difference with fit() is that, with early_stopping, all the networks share the validation split of the first one.
+        Reports and debug output are not produced.
+
+        example usage:
+
+        .. code-block:: python
+
+            models = [MLPRegressor (hidden_layer_sizes=[50,50], alpha=alpha, random_state=i) for i, alpha in enumerate([0.001, 0.01, 0.1])]
+            ModelStack (models).fit (X, y)
+            predictions = models[0].predict (X_test)
+    '''
+
+    def __init__ ( self, models ):
+        '''
+            :param: models list of neural networks (instances of the same class) that share the hyper-parameters listed in _stack_key
+        '''
+        if len(models) == 0:
+            raise ValueError ("a model stack needs at least one model")
+        if len (set (_stack_key (model) for model in models)) > 1:
+            raise ValueError ("stacked models must share class, hidden_layer_sizes, activation functions, loss, batch_size, shuffle, early stopping, validation_fraction and dtype")
+        self.models = list (models)
+
+    def _create_weights_views ( self ):
+        '''
+            private method.
+            creates the per-layer views (K, n+1, m) on the stacked parameters buffer self._params,
+            the (K, n, m) connection weights self._coefs and the (K, 1, m) biases self._intercepts
+        '''
+        self._weights = _split_parameters (self._params, self._weights_shapes)
+        self._coefs = [W[:, :-1] for W in self._weights]
+        self._intercepts = [W[:, -1:] for W in self._weights]
+
+    def _hyperparameters_column ( self, values ):
+        '''
+            private method.
+            returns a (K, 1) column with a value for each network in the stack, that can be broadcast over the rows of self._params
+        '''
+        return np.array (values, dtype=self._params.dtype)[:, np.newaxis]
+
+    def _forward_pass ( self, X, workspace=None ):
+        '''
+            private method.
+            feeds all the networks of the stack with a minibatch X.
+            X is either a (n_samples, n_features) matrix shared by the networks or a (K, n_samples, n_features) tensor with a minibatch for each network.
+            returns layer_nets, layer_outputs as BaseNeuralNetwork._forward_pass, with a leading axis K (except for the input X).
+        '''
+        n_samples = X.shape[-2]
+        if workspace is None:
+            workspace = _Workspace (n_samples, self._layer_sizes, backward=False, dtype=self._params.dtype, n_models=len(self._params))
+
+        layer_outputs = [X]
+        layer_nets = [X]
+        n_layers = len(self._weights)
+        first = self.models[0]
+
+        for i in range (n_layers):
+            net = np.matmul (layer_outputs[i], self._coefs[i], out=workspace.nets[i][:, :n_samples])
+            net += self._intercepts[i]
+            layer_nets.append (net)
+
+            activation = first._hidden_activation if i < n_layers-1 else first._output_activation
+            layer_outputs.append ( activation (net, out=workspace.outputs[i][:, :n_samples]) )
+
+        return layer_nets, layer_outputs
+
+    def _backpropagation ( self, layers_nets, layers_outputs, real_outputs, workspace ):
+        '''
+            private method.
+            computes the gradients of the loss of every network of the stack into workspace.gradient (K, n_params),
+            same layout of self._params. See BaseNeuralNetwork._backpropagation.
+        '''
+        n_samples = layers_outputs[0].shape[-2]
+        first = self.models[0]
+        delta_weights = workspace.delta_weights
+
+        #output layer
+        dE = first._loss_derivative (real_outputs, layers_outputs[-1], out=workspace.errors[-1][:, :n_samples])
+        df = first._output_activation_derivative ( layers_outputs[-1], out=workspace.derivatives[-1][:, :n_samples] )
+        deltas = np.multiply (dE, df, out=workspace.deltas[-1][:, :n_samples])
+
+        dW = delta_weights[-1]
+        np.matmul (np.swapaxes (layers_outputs[-2], -1, -2), deltas, out=dW[:, :-1])
+        np.sum (deltas, axis=1, out=dW[:, -1])
+
+        # hidden layers
+        for i in range ( len(layers_outputs)-2, 0, -1 ):
+            dE = np.matmul (deltas, np.swapaxes (self._coefs[i], -1, -2), out=workspace.errors[i-1][:, :n_samples])
+            df = first._hidden_activation_derivative ( layers_outputs[i], out=workspace.derivatives[i-1][:, :n_samples] )
+            deltas = np.multiply (dE, df, out=workspace.deltas[i-1][:, :n_samples])
+            dW = delta_weights[i-1]
+            np.matmul (np.swapaxes (layers_outputs[i-1], -1, -2), deltas, out=dW[:, :-1])
+            np.sum (deltas, axis=1, out=dW[:, -1])
+
+        workspace.gradient /= n_samples
+        return delta_weights
+
+    def _init_workspace ( self, X, y ):
+        '''
+            private method.
+            allocates the buffers used by _do_epoch for the networks currently in the stack
+        '''
+        self._workspace = _Workspace (self.models[0].b_size, self._layer_sizes, dtype=self._params.dtype, n_models=len(self._params))
+        if self.models[0].shuffle:
+            self._workspace.allocate_shuffle_buffers (X, y)
+
+    def _do_epoch ( self, X, y ):
+        '''
+            private method.
+            performs a training epoch of all the networks in the stack, see BaseNeuralNetwork._do_epoch.
+            every network shuffles the dataset with its own random generator.
+        '''
+        workspace = self._workspace
+        models = [self.models[i] for i in self._active]
+        b_size = models[0].b_size
+        n_samples = len(X)
+
+        if models[0].shuffle:
+            for row, model in enumerate (models):
+                indexes = workspace.shuffle_indexes[row]
+                indexes.sort ()
+                model._random_generator.shuffle (indexes)
+                np.take (X, indexes, axis=0, out=workspace.shuffled_X[row])
+                np.take (y, indexes, axis=0, out=workspace.shuffled_y[row])
+            X = workspace.shuffled_X
+            y = workspace.shuffled_y
+
+        n_iterations = n_samples // b_size + (0 if n_samples % b_size == 0 else 1)
+        momentum = self._hyperparameters_column ([model.momentum for model in models])
+        one_minus_momentum = self._hyperparameters_column ([1 - model.momentum for model in models])
+        decay = self._hyperparameters_column ([1 - 2 * model.alpha * (b_size/n_samples) for model in models])
+        eta = self._hyperparameters_column ([model._eta for model in models])
+
+        for b in range(n_iterations):
+
+            start = b_size * b
+            stop = b_size * (b + 1)
+
+            layers_nets, layer_outputs = self._forward_pass (X[..., start:stop, :], workspace)
+            self._backpropagation ( layers_nets, layer_outputs, y[..., start:stop, :], workspace )
+
+            m = self._momentum
+            dW = workspace.gradient
+            m *= momentum
+            dW *= one_minus_momentum
+            m += dW
+
+            self._params *= decay
+            self._params -= np.multiply (eta, m, out=dW)
+
+    def _remove_converged ( self, epoch_no, X, y, n_outputs ):
+        '''
+            private method.
+            copies the final weights of the networks that have converged before the epoch epoch_no into the networks themselves,
+            sets their fitted attributes and removes them from the stack.
+        '''
+        keep = []
+        for row, i in enumerate (self._active):
+            model = self.models[i]
+            if not model._has_converged (epoch_no):
+                keep.append (row)
+                continue
+
+            np.copyto (model._params, self._best_params[row] if model.early_stopping else self._params[row])
+            model.delta_olds = self._momentum[row].copy ()
+
+            model._n_epochs = epoch_no - 1
+            model.n_iter_ = epoch_no
+            # the loss of the restored weights, see BaseNeuralNetwork._restore_checkpoint
+            model.loss_ = model._best_checkpoint_loss if model.early_stopping else model._best_loss
+            model.n_layers_ = len(model.hidden_layer_sizes)
+            model.n_outputs_ = n_outputs
+            model.hidden_activation_ = model.activation
+            if isinstance (model, MLPClassifier):
+                model.classes_ = [0,1]
+
+        if len(keep) == len(self._active):
+            return
+
+        self._active = [self._active[row] for row in keep]
+        self._params = self._params[keep]
+        self._momentum = self._momentum[keep]
+        if self._best_params is not None:
+            self._best_params = self._best_params[keep]
+        self._create_weights_views ()
+        if self._active:
+            self._init_workspace (X, y)
+
+    def fit ( self, X, y ):
+        '''
+            trains all the networks of the stack on the dataset X.
+
+            :param: X input data of shape (n_samples, n_features)
+            :param: y target values for the dataset X. Shape must be (n_samples, n_outputs)
+        '''
+        first = self.models[0]
+        if isinstance (first, MLPClassifier):
+            y = first._check_labels (y)
+        X, y = first._check_fit_datasets (X, y)
+
+        for model in self.models:
+            model._initialize_fit (X, y)
+
+        self._weights_shapes = first._weights_shapes
+        if any (model._weights_shapes != self._weights_shapes for model in self.models):
+            raise ValueError ("stacked models must have weights of the same shapes, got {}".format([model._weights_shapes for model in self.models]))
+        self._layer_sizes = first._layer_sizes ()
+
+        X_validation = None
+        y_validation = None
+
+        if first.early_stopping:
+            # the validation split of the first network is shared by all the networks of the stack
+            X, X_validation, y, y_validation = train_test_split ( X, y, test_size=first.validation_fraction, shuffle=first.shuffle, random_state=first.random_state )
+
+        for model in self.models:
+            model._set_batch_size (len(X))
+
+        # indexes (in self.models) of the networks still in training, the row r of the stacked buffers belongs to self.models[self._active[r]]
+        self._active = list (range (len(self.models)))
+        self._params = np.stack ([model._params for model in self.models])
+        self._momentum = np.zeros_like (self._params)
+        self._best_params = self._params.copy () if first.early_stopping else None
+        self._create_weights_views ()
+        self._init_workspace (X, y)
+
+        epoch_no = 1
+        self._remove_converged (epoch_no, X, y, y.shape[1])
+
+        while self._active:
+
+            for i in self._active:
+                self.models[i]._update_learning_rate (epoch_no)
+
+            self._do_epoch ( X, y )
+
+            if first.early_stopping:
+                _, layer_outputs = self._forward_pass (X_validation)
+                real_outputs = y_validation
+            else:
+                _, layer_outputs = self._forward_pass (X)
+                real_outputs = y
+
+            for row, i in enumerate (self._active):
+                model = self.models[i]
+                avg_loss = model._loss (real_outputs, layer_outputs[-1][row], reduction="sum") / len(real_outputs)
+                model._update_convergence_state (avg_loss)
+                if first.early_stopping and model._checkpoint_improved (epoch_no, avg_loss):
+                    np.copyto (self._best_params[row], self._params[row])
+
+            epoch_no += 1
+            self._remove_converged (epoch_no, X, y, y.shape[1])
+
+        self._workspace = None
+        self._params = None
+        self._momentum = None
+        self._best_params = None
+        self._weights = self._coefs = self._intercepts = None
+
+def stack_groups ( models, max_stack_size=None ):
+    '''
+        splits the models into the groups that can be trained in the same ModelStack, of at most max_stack_size models (None for no limit).
+        Every model that cannot be stacked (see _is_stackable) is a group by itself.
+    '''
+    groups = []
+    stackable = {}
+    for model in models:
+        if _is_stackable (model):
+            stackable.setdefault (_stack_key (model), []).append (model)
+        else:
+            groups.append ([model])
+
+    for group in stackable.values ():
+        stack_size = max_stack_size or len(group)
+        groups += [group[start:start+stack_size] for start in range (0, len(group), stack_size)]
+    return groups
+
+def fit_stacked ( models, X, y, max_stack_size=None ):
+    '''
+        trains all the models on the dataset (X, y).
+        The models that can share a stack (see ModelStack) are trained together, the other ones (and the models with reporting or debug output enabled)
+        are trained one after another with their own fit().
+
+        :param: models list of models
+        :param: X input data of shape (n_samples, n_features)
+        :param: y target values for the dataset X. Shape must be (n_samples, n_outputs)
+        :param: max_stack_size maximum number of networks trained in the same stack, None for no limit
+    '''
+    for group in stack_groups (models, max_stack_size):
+        if len(group) == 1:
+            group[0].fit (X, y)
+        else:
+            ModelStack (group).fit (X, y)
@@ -4,24 +4,204 @@ import random
 from datetime import datetime
 import json
 import os
-import copy
+import inspect
 from utility import CreateLossPlot, CreateAccuracyPlot
+from persistence import write_arrays, read_arrays
 
-from functions import activation_functions, activation_functions_derivatives, loss_functions, loss_functions_derivatives, accuracy_functions, weights_init_functions
+from functions import activation_functions, activation_functions_output_derivatives, loss_functions, loss_functions_derivatives, loss_functions_and_derivatives, accuracy_functions, weights_init_functions
 from sklearn.model_selection import train_test_split
 
 np.seterr (all="raise", under="ignore")
 
+# external readable properties set by the training, saved together with the weights by save_models
+_FITTED_ATTRIBUTES = ["n_iter_", "loss_", "n_layers_", "n_outputs_", "hidden_activation_", "classes_"]
+
+def _weights_shapes ( layer_sizes ):
+    '''
+        private helper.
+        returns the shapes (n+1, m) of the weights matrices (biases included as last row) of a network with the given number of units per layer
+    '''
+    return [(n+1, m) for n,m in zip (layer_sizes[:-1], layer_sizes[1:])]
+
+def _split_parameters ( buffer, shapes ):
+    '''
+        private helper.
+        splits the last axis of a flat parameters buffer into consecutive blocks and returns a list of views on them,
+        each one reshaped as the corresponding weights matrix in shapes.
+        Leading axes of buffer (if any) are kept, e.g. a buffer (K, n_params) gives views (K, n+1, m).
+    '''
+    views = []
+    offset = 0
+    for shape in shapes:
+        size = shape[0] * shape[1]
+        views.append (buffer[..., offset:offset+size].reshape (buffer.shape[:-1] + tuple(shape)))
+        offset += size
+    return views
+
+class _Workspace:
+    '''
+        private class.
+        preallocated buffers for the forward and backward passes of a network, sized once for minibatches of at most max_samples samples.
+        A smaller minibatch (e.g. the last one of an epoch) uses the first rows of every buffer through views, so the training loop does not allocate memory.
+
+        With n_models all the buffers get a leading axis of that size, to hold the passes of a stack of networks with the same architecture (see model_stack.py).
+    '''
+
+    def __init__ ( self, max_samples, layer_sizes, backward=True, dtype=float, n_models=None ):
+        '''
+            :param: max_samples maximum number of samples in a minibatch
+            :param: layer_sizes number of units of each layer: [n_features, hidden layer sizes..., n_outputs]
+            :param: backward if False only the buffers needed by the forward pass are allocated
+            :param: n_models number of stacked networks, None for a single network
+        '''
+        self.max_samples = max_samples
+        self.n_models = n_models
+        lead = () if n_models is None else (n_models,)
+        
+        self.nets = [np.empty ( lead + (max_samples, m), dtype=dtype ) for m in layer_sizes[1:]]
+        self.outputs = [np.empty ( lead + (max_samples, m), dtype=dtype ) for m in layer_sizes[1:]]
+
+        if backward:
+            self.errors = [np.empty ( lead + (max_samples, m), dtype=dtype ) for m in layer_sizes[1:]]
+            self.derivatives = [np.empty ( lead + (max_samples, m), dtype=dtype ) for m in layer_sizes[1:]]
+            self.deltas = [np.empty ( lead + (max_samples, m), dtype=dtype ) for m in layer_sizes[1:]]
+            # the gradient has the same layout of the network parameters: one flat buffer and a (n+1, m) view for each layer
+            shapes = _weights_shapes (layer_sizes)
+            self.gradient = np.empty ( lead + (sum (n*m for n,m in shapes),), dtype=dtype )
+            self.delta_weights = _split_parameters (self.gradient, shapes)
+
+    def allocate_shuffle_buffers ( self, X, y ):
+        '''
+            allocates the buffers that receive a shuffled copy of the training set (X, y) at each epoch
+            (one copy and one permutation per network if n_models is set)
+        '''
+        if self.n_models is None:
+            self.shuffle_indexes = np.arange (len(X))
+            self.shuffled_X = np.empty_like (X)
+            self.shuffled_y = np.empty_like (y)
+        else:
+            self.shuffle_indexes = np.tile (np.arange (len(X)), (self.n_models, 1))
+            self.shuffled_X = np.empty ( (self.n_models,) + X.shape, dtype=X.dtype )
+            self.shuffled_y = np.empty ( (self.n_models,) + y.shape, dtype=y.dtype )
+
+    def allocate_stream_buffers ( self, capacity, n_features, n_outputs, dtype=float ):
+        '''
+            allocates the shuffle buffer of the streaming training (see BaseNeuralNetwork.fit_stream): it holds up to capacity samples,
+            that are shuffled into a second pair of buffers
+        '''
+        self.stream_X = np.empty ( (capacity, n_features), dtype=dtype )
+        self.stream_y = np.empty ( (capacity, n_outputs), dtype=dtype )
+        self.shuffled_X = np.empty_like (self.stream_X)
+        self.shuffled_y = np.empty_like (self.stream_y)
+
+class CompiledPredictor:
+    '''
+        frozen inference plan of a trained network, returned by BaseNeuralNetwork.compile_predictor.
+
+        The weights and biases of every layer are copied once into separate contiguous arrays (later training of the network
+        does not change the predictor) and the outputs of the layers are written into buffers preallocated for max_batch samples,
+        so a prediction only runs the matrix products and the activation functions: no conversion of the weights, no shape checks
+        and no list of the intermediate layers outputs.
+        The inputs are expected to have the right number of features: they are not validated.
+
+        The buffers are shared by all the calls, so a predictor must not be used by many threads at the same time.
+    '''
+
+    def __init__ ( self, weights, hidden_activation, output_activation, max_batch, threshold=None ):
+        '''
+            :param: weights weights matrices of the layers (biases in the last row)
+            :param: hidden_activation, output_activation activation functions of the hidden and output layers
+            :param: max_batch maximum number of samples predicted with a single pass, larger datasets are predicted in chunks of max_batch samples
+            :param: threshold if not None predict() returns the labels 1 (output >= threshold) and 0 instead of the outputs, see predict_proba
+        '''
+        if max_batch < 1:
+            raise ValueError ("max_batch must be a positive integer, got {}".format(max_batch))
+        self.max_batch = max_batch
+        self.threshold = threshold
+        self.dtype = weights[0].dtype
+        self.n_features = weights[0].shape[0] - 1
+        self.n_outputs = weights[-1].shape[1]
+        self._coefs = [np.array (w[:-1], order="C") for w in weights]
+        self._intercepts = [np.array (w[-1]) for w in weights]
+        # the output activation is skipped when it is the identity
+        self._activations = [hidden_activation] * (len(weights) - 1) + [None if output_activation is activation_functions["identity"] else output_activation]
+        # each layer has a single buffer: the activation is computed in place on the net
+        self._buffers = [np.empty ( (max_batch, w.shape[1]), dtype=self.dtype ) for w in weights]
+
+        # single sample: the input of each layer has a trailing 1, so that the net (biases included) is a single vector-matrix product
+        self._weights = [np.array (w, order="C") for w in weights]
+        self._sample_inputs = [np.ones (w.shape[0], dtype=self.dtype) for w in weights]
+        self._sample_outputs = [inp[:-1] for inp in self._sample_inputs[1:]] + [np.empty (self.n_outputs, dtype=self.dtype)]
+
+    def _pass ( self, X, buffers ):
+        '''
+            private method.
+            feeds the layers with a batch X of at most max_batch samples: returns the output layer buffer
+        '''
+        out = X
+        for coef, intercept, activation, buffer in zip (self._coefs, self._intercepts, self._activations, buffers):
+            out = np.matmul (out, coef, out=buffer)
+            out += intercept
+            if activation is not None:
+                activation (out, out=out)
+        return out
+
+    def predict_proba ( self, X, out=None ):
+        '''
+            returns the outputs of the network for the samples X (n_samples, n_features), written into out (n_samples, n_outputs) if given
+        '''
+        X = np.asarray (X, dtype=self.dtype)
+        n_samples = len(X)
+        if n_samples <= self.max_batch and out is None:
+            return self._pass (X, [buffer[:n_samples] for buffer in self._buffers]).copy ()
+        if out is None:
+            out = np.empty ( (n_samples, self.n_outputs), dtype=self.dtype )
+        for start in range (0, n_samples, self.max_batch):
+            end = min (start + self.max_batch, n_samples)
+            out[start:end] = self._pass (X[start:end], [buffer[:end-start] for buffer in self._buffers])
+        return out
+
+    def predict ( self, X, out=None ):
+        '''
+            returns the predictions for the samples X (n_samples, n_features), as predict() of the network:
+            the outputs, or the labels if the predictor has a threshold
+        '''
+        out = self.predict_proba (X, out)
+        if self.threshold is not None:
+            np.greater_equal (out, self.threshold, out=out, casting="unsafe")
+        return out
+
+    def predict_one ( self, x ):
+        '''
+            single-sample fast path: returns the prediction (n_outputs,) for one sample x (n_features,).
+            The result is a buffer of the predictor, overwritten by the next call of predict_one: copy it to keep it.
+        '''
+        self._sample_inputs[0][:-1] = x
+        for inp, w, activation, out in zip (self._sample_inputs, self._weights, self._activations, self._sample_outputs):
+            np.dot (inp, w, out=out)
+            if activation is not None:
+                activation (out, out=out)
+        if self.threshold is not None:
+            np.greater_equal (out, self.threshold, out=out, casting="unsafe")
+        return out
+
+    def __call__ ( self, X ):
+        return self.predict (X)
+
 class BaseNeuralNetwork:
     '''
         implements a multilayer fully-connected feed-forward Neural Network capable of optimizing any given loss through backpropagation over multiple epochs. 
     '''
 
+    # output value from which predict() returns the label 1, None if predict() returns the outputs of the network
+    _threshold = None
+
     def __init__(self, hidden_layer_sizes=(100, ), hidden_activation='relu', output_activation="identity", solver='sgd', alpha=0.0001, batch_size='auto',
                        learning_rate='constant', learning_rate_init=0.001, power_t=0.5, max_iter=200, shuffle=True,
                        random_state=None, tol=0.0001, verbose=False, warm_start=False, momentum=0.9, nesterovs_momentum=True,
                        early_stopping=False, validation_fraction=0.1, beta_1=0.9, beta_2=0.999, epsilon=1e-08, n_iter_no_change=10,
-                       max_fun=15000, loss="squared", weights_init_fun = "random_normal", weights_init_value=0.7 ):
+                       max_fun=15000, loss="squared", weights_init_fun = "random_normal", weights_init_value=0.7, dtype="float64",
+                       loss_evaluation="full", full_evaluation_interval=None, checkpoint_interval=1 ):
 
         '''
             see the report for the (hyper-)parameter documentation and usage
@@ -54,6 +234,19 @@ class BaseNeuralNetwork:
         self.weights_init_value = weights_init_value
         self.weights_init_function = weights_init_functions[weights_init_fun]
 
+        # floating point precision of weights, activations, gradients and momentum: "float64" or "float32"
+        self.dtype = dtype
+        self._check_dtype ()
+
+        # training loss of each epoch: "full" (computed on the whole training set after the epoch) or "accumulated" from the minibatches of the epoch,
+        # with a full evaluation every full_evaluation_interval epochs (if not None)
+        self.loss_evaluation = loss_evaluation
+        self.full_evaluation_interval = full_evaluation_interval
+        self._check_loss_evaluation ()
+
+        # with early stopping the best weights are looked for only every checkpoint_interval epochs
+        self.checkpoint_interval = checkpoint_interval
+
         # fixed parameters
         self.linear_decay_iterations = 100
         self.linear_decay_eta_zero = learning_rate_init / 100
@@ -74,26 +267,48 @@ class BaseNeuralNetwork:
         if solver != "sgd":
             raise ValueError ("Only stochastic gradient descent solver is implemented")
 
-        if hidden_activation not in activation_functions or hidden_activation not in activation_functions_derivatives:
+        if hidden_activation not in activation_functions or hidden_activation not in activation_functions_output_derivatives:
             raise ValueError ("hidden activation function {} not implemented".format(hidden_activation))
         self._hidden_activation = activation_functions[hidden_activation]
-        self._hidden_activation_derivative = activation_functions_derivatives[hidden_activation]
+        self._hidden_activation_derivative = activation_functions_output_derivatives[hidden_activation]
 
-        if output_activation not in activation_functions or output_activation not in activation_functions_derivatives:
+        if output_activation not in activation_functions or output_activation not in activation_functions_output_derivatives:
             raise ValueError ("output activation function {} not implemented".format(output_activation))
         self._output_activation = activation_functions[output_activation]
-        self._output_activation_derivative = activation_functions_derivatives[output_activation]
+        self._output_activation_derivative = activation_functions_output_derivatives[output_activation]
 
-        if loss not in loss_functions or loss not in loss_functions_derivatives:
+        if loss not in loss_functions or loss not in loss_functions_derivatives or loss not in loss_functions_and_derivatives:
             raise ValueError ("loss function {} not implemented".format(loss_functions))
         self._loss = loss_functions[loss]
         self._loss_derivative = loss_functions_derivatives[loss]
+        self._loss_and_derivative = loss_functions_and_derivatives[loss]
         self._loss_fun_name = loss
 
         self._random_generator = np.random.default_rng(random_state)
         
+        # all the weights and biases are stored in the flat buffer self._params, see _allocate_weights
+        self._params = None
         self._weights = None
         self.delta_olds = None
+        self._workspace = None
+
+    def __getstate__ ( self ):
+        '''
+            the per-layer views on self._params are not copied (pickle and deepcopy would turn them into independent arrays),
+            they are rebuilt by __setstate__. The training workspace is not copied either.
+        '''
+        state = self.__dict__.copy ()
+        for attribute in ["_weights", "_coefs", "_intercepts", "_workspace"]:
+            state.pop (attribute, None)
+        return state
+
+    def __setstate__ ( self, state ):
+        self.__dict__.update (state)
+        self._workspace = None
+        if self._params is None:
+            self._weights = None
+        else:
+            self._create_weights_views ()
     
     def get_params (self, deep=True):
         '''
@@ -119,7 +334,11 @@ class BaseNeuralNetwork:
             "validation_fraction": self.validation_fraction,
             "n_iter_no_change": self.n_iter_no_change,
             "weights_init_fun":  self.weights_init_fun,
-            "weights_init_value": self.weights_init_value
+            "weights_init_value": self.weights_init_value,
+            "dtype": self.dtype,
+            "loss_evaluation": self.loss_evaluation,
+            "full_evaluation_interval": self.full_evaluation_interval,
+            "checkpoint_interval": self.checkpoint_interval
         }
     
     def set_params (self, **parameters_dict):
@@ -130,11 +349,20 @@ class BaseNeuralNetwork:
             Example of parameters_dict:
                 params={"hidden_layer_sizes": [15], "alpha": 0., "activation": "relu", "learning_rate": "constant", "learning_rate_init": 0.8}
 
+            raises a ValueError, keeping the previous hyper-parameters, if dtype or loss_evaluation are not supported (as the constructor does)
         '''
-        for param in ["hidden_layer_sizes", "alpha", "n_iter_no_change", "validation_fraction", "early_stopping", "nesterovs_momentum", "momentum", "warm_start", "verbose", "tol", "random_state", "shuffle", "max_iter", "power_t", "learning_rate_init", "learning_rate", "activation", "batch_size", "weights_init_fun", "weights_init_value"  ]:
+        previous = self.get_params ()
+        for param in ["hidden_layer_sizes", "alpha", "n_iter_no_change", "validation_fraction", "early_stopping", "nesterovs_momentum", "momentum", "warm_start", "verbose", "tol", "random_state", "shuffle", "max_iter", "power_t", "learning_rate_init", "learning_rate", "activation", "batch_size", "weights_init_fun", "weights_init_value", "dtype", "loss_evaluation", "full_evaluation_interval", "checkpoint_interval"  ]:
             if param in parameters_dict:
                 setattr (self, param, parameters_dict[param])
- 
+        try:
+            self._check_dtype ()
+            self._check_loss_evaluation ()
+        except ValueError:
+            for param in previous:
+                setattr (self, param, previous[param])
+            raise
+
     def set_weights ( self, weights ):
         '''
             set the weights for the neural network
@@ -174,18 +402,75 @@ class BaseNeuralNetwork:
         '''
         for i in range (len(weights)-1):
             assert weights[i].shape[1] == weights[i+1].shape[0]-1, "weight shapes must be compatible. Got {}".format(list(map (lambda x: x.shape, weights)))
-        self._weights = weights
+        self._allocate_weights ([W.shape for W in weights])
+        for W, new_W in zip (self._weights, weights):
+            np.copyto (W, new_W)
+
+    def _allocate_weights ( self, shapes ):
+        '''
+            private method.
+            allocates a single contiguous buffer self._params for all the weights and biases of the network, 
+            given the shapes (n+1, m) of the weights matrices of each layer. 
+            The weights matrices are views on it, see _create_weights_views.
+        '''
+        self._weights_shapes = [tuple(shape) for shape in shapes]
+        self._params = np.empty ( sum (n*m for n,m in self._weights_shapes), dtype=self._check_dtype() )
+        self._create_weights_views ()
+
+    def _create_weights_views ( self ):
+        '''
+            private method.
+            creates the per-layer views on the parameters buffer self._params:
+             - self._weights[i] (n+1, m) weights of the layer i, the last row are the biases (same format used by set_weights)
+             - self._coefs[i] (n, m) connection weights of the layer i
+             - self._intercepts[i] (m,) biases of the layer i
+        '''
+        self._weights = _split_parameters (self._params, self._weights_shapes)
+        self._coefs = [W[:-1] for W in self._weights]
+        self._intercepts = [W[-1] for W in self._weights]
+
+    def _check_dtype ( self ):
+        '''
+            private method.
+            returns the numpy dtype corresponding to the dtype hyper-parameter or raises an error if it is not a supported floating point type
+        '''
+        try:
+            dtype = np.dtype (self.dtype)
+        except TypeError:
+            raise ValueError ("dtype {} not supported".format(self.dtype))
+        if dtype not in (np.float32, np.float64):
+            raise ValueError ("dtype {} not supported: use float32 or float64".format(self.dtype))
+        return dtype
+
+    def _check_loss_evaluation ( self ):
+        '''
+            private method.
+            raises an error if the loss_evaluation hyper-parameter is not supported
+        '''
+        if self.loss_evaluation not in ("full", "accumulated"):
+            raise ValueError ("loss evaluation {} not supported: use full or accumulated".format(self.loss_evaluation))
+
+    def _accumulates_loss ( self, epoch_no ):
+        '''
+            private method.
+            returns True if the training loss of the epoch epoch_no has to be accumulated from its minibatches (see loss_evaluation) 
+            instead of being computed with a full pass over the training set. The validation loss of early stopping is always computed with a full pass.
+        '''
+        if self.loss_evaluation != "accumulated" or self.early_stopping:
+            return False
+        return not self.full_evaluation_interval or epoch_no % self.full_evaluation_interval != 0
 
     def _check_fit_datasets (self, X, y):
         '''
             private method.
-            Given a dataset (inputs X and labels y) converts them into numpy arrays and checks their shapes are suitable for fitting i.e. if X and y have the same number of items.
+            Given a dataset (inputs X and labels y) converts them into numpy arrays of the configured dtype and checks their shapes are suitable for fitting i.e. if X and y have the same number of items.
             In the case that y is an unidimensional array of shape (n_samples), convert it to a column vector of shape (n_samples, 1)
 
             returns the converted arrays or raises an error if their are not suitable for fitting 
         '''
-        X = np.array (X)
-        y = np.array (y)
+        dtype = self._check_dtype ()
+        X = np.array (X, dtype=dtype)
+        y = np.array (y, dtype=dtype)
         # if y.shape == (n_samples) convert it to a column vector (n_samples, 1)
         if y.ndim == 1:
             y = y[:, np.newaxis]
@@ -259,8 +544,7 @@ class BaseNeuralNetwork:
         '''
         
         predicted = self._predict_internal (self.X_reporting)
-        losses_matrix = self._loss (self.y_reporting, predicted)
-        valid_loss = np.average (np.sum(losses_matrix, axis=1))
+        valid_loss = self._loss (self.y_reporting, predicted, reduction="sum") / len(predicted)
  
         self._last_row  = str(epoch_no) + "\t" + str(train_loss) + "\t" + str(valid_loss)
         
@@ -279,7 +563,7 @@ class BaseNeuralNetwork:
             print ("predictions for y_reporting")
             print (predicted)
             print ("losses matrix")
-            print (losses_matrix)
+            print (self._loss (self.y_reporting, predicted))
             print ("validation loss ({}): {}".format (self._loss_fun_name, valid_loss))
             print ("validation accuracy({}): {}".format (self._report_accuracy_fun_name, valid_accuracy))
             
@@ -291,13 +575,19 @@ class BaseNeuralNetwork:
             private method.
             Initializes the neural network weights matrices with random weights.
         '''
-        self._weights = []
-        for n,m in zip ([n_features]+list(self.hidden_layer_sizes), list(self.hidden_layer_sizes)+[n_outputs]):
+        self._allocate_weights ( _weights_shapes ([n_features]+list(self.hidden_layer_sizes)+[n_outputs]) )
+        for W in self._weights:
             #W = 0.7 * np.random.randn (n+1,m)
-            W = self.weights_init_function(self.weights_init_value, (n+1,m), self._random_generator)
-            self._weights.append (W)
+            np.copyto (W, self.weights_init_function(self.weights_init_value, W.shape, self._random_generator))
+
+    def _layer_sizes ( self ):
+        '''
+            private method.
+            returns the number of units of each layer (including input and output layers) according to the current weights
+        '''
+        return [W.shape[0]-1 for W in self._weights] + [self._weights[-1].shape[1]]
 
-    def _forward_pass ( self, X ):
+    def _forward_pass ( self, X, workspace=None, output=None ):
         '''
             private method.
             feeds the network with a minibatch of samples X (n_samples, n_features)
@@ -308,127 +598,431 @@ class BaseNeuralNetwork:
                 layer_outputs[i] for i=1...n_layers are the outputs of the hidden layer i (n_samples, dim_layer_i)
 
                 in particular, layer_outputs[-1] is the output predicted by the output units 
+
+            if a workspace is given the nets and outputs are written into its buffers (and the returned arrays are views on them),
+            otherwise new arrays are allocated. The outputs of the output layer are written into output, if given.
         '''
         assert X.shape[1] == self._weights[0].shape[0]-1, "wrong number of features {} for first layer weights shape {}".format(X.shape[1], self._weights[0].shape[0]-1)
+        if workspace is None:
+            workspace = _Workspace (len(X), self._layer_sizes(), backward=False, dtype=self._params.dtype)
+
+        n_samples = len(X)
         layer_outputs = [X]
         layer_nets = [X]
+        n_layers = len(self._weights)
         
-        #hidden layers
-        for i in range (len(self._weights)-1):
+        for i in range (n_layers):
             inp = layer_outputs[i]
-           
-            biases = np.ones( (inp.shape[0], 1) )
-            inp_and_biases = np.hstack ( (inp, biases) )
-            
-            net = np.matmul (inp_and_biases, self._weights[i])
-            
+            net = np.matmul (inp, self._coefs[i], out=workspace.nets[i][:n_samples])
+            net += self._intercepts[i]
             layer_nets.append (net)
-            layer_outputs.append ( self._hidden_activation (net) )
-            if self._debug_forward_pass:
-                print ("[DEBUG] layer {}\ninput + bias:\n{}\nweights\n{}\nnet\n{}\noutput\n{}".format(i, inp_and_biases, self._weights[i], net, layer_outputs[-1]))
-        
-        # output layer
-        inp = layer_outputs[-1]
-        biases = np.ones( (inp.shape[0], 1) )
-        inp_and_biases = np.hstack ( (inp, biases) )
-        net = np.matmul (inp_and_biases, self._weights[-1])
-        layer_nets.append (net)
-        layer_outputs.append (self._output_activation (net))
-        
-        if self._debug_forward_pass:
-            print ("[DEBUG] output layer\ninput + bias:\n{}\nweights\n{}\nnet\n{}\noutput\n{}".format(inp_and_biases, self._weights[-1], net, layer_outputs[-1]))
+
+            #hidden layers
+            if i < n_layers-1:
+                layer_outputs.append ( self._hidden_activation (net, out=workspace.outputs[i][:n_samples]) )
+                if self._debug_forward_pass:
+                    print ("[DEBUG] layer {}\ninput:\n{}\nweights (biases in the last row)\n{}\nnet\n{}\noutput\n{}".format(i, inp, self._weights[i], net, layer_outputs[-1]))
+            
+            # output layer
+            else:
+                if output is None:
+                    output = workspace.outputs[i][:n_samples]
+                layer_outputs.append (self._output_activation (net, out=output))
+                if self._debug_forward_pass:
+                    print ("[DEBUG] output layer\ninput:\n{}\nweights (biases in the last row)\n{}\nnet\n{}\noutput\n{}".format(inp, self._weights[i], net, layer_outputs[-1]))
         
         return layer_nets, layer_outputs
 
-    def _backpropagation ( self, layers_nets, layers_outputs, real_outputs ):
+    def _backpropagation ( self, layers_nets, layers_outputs, real_outputs, workspace=None, return_loss=False ):
         '''
             private method.
             Implement a backpropagation step, returning a list of matrices delta_weights of size n_layers+1 
             such that every matrix delta_weights[i] is the gradient of the loss function w.r.t. weights[i] (i.e. the weights that connect layer i to layer i+1)
+
+            if a workspace is given the gradients are written into its buffers: delta_weights are views on the flat buffer workspace.gradient 
+            (with the same layout of self._params), otherwise new arrays are allocated.
+            if return_loss is set returns the pair (delta_weights, sum of the losses of the samples): the losses are computed in the same pass of their derivatives.
         '''
 
         assert len(layers_outputs) == len(layers_nets), "Backpropagation: number of layers outputs and nets must be the same."
         assert len(layers_outputs) == len(self._weights) + 1, "Backpropagation: number of layers outputs must be number of weights matrices + 1"
 
         n_samples = len(layers_outputs[0])
-        delta_weights = []
+        if workspace is None:
+            workspace = _Workspace (n_samples, self._layer_sizes(), dtype=self._params.dtype)
+        
+        delta_weights = workspace.delta_weights
 
         #output layers        
-        dE = self._loss_derivative (real_outputs, layers_outputs[-1])
-        df = self._output_activation_derivative ( layers_nets[-1] )
-        deltas = dE * df
-
-        prev_layer_outputs = layers_outputs[-2]
-        biases = np.ones( (prev_layer_outputs.shape[0], 1) )
-        out_and_biases = np.hstack ( (prev_layer_outputs, biases) )
-        dW = sum ( a[:, np.newaxis]*b for a,b in zip (out_and_biases, deltas) ) / n_samples
+        if return_loss:
+            loss, dE = self._loss_and_derivative (real_outputs, layers_outputs[-1], reduction="sum", out=workspace.errors[-1][:n_samples])
+        else:
+            dE = self._loss_derivative (real_outputs, layers_outputs[-1], out=workspace.errors[-1][:n_samples])
+        # activation derivatives are computed from the outputs of the layers
+        df = self._output_activation_derivative ( layers_outputs[-1], out=workspace.derivatives[-1][:n_samples] )
+        deltas = np.multiply (dE, df, out=workspace.deltas[-1][:n_samples])
 
-        delta_weights.insert (0, dW)
+        # sum over the samples of the outer products between inputs and deltas (weights) and of the deltas (biases)
+        dW = delta_weights[-1]
+        np.matmul (layers_outputs[-2].T, deltas, out=dW[:-1])
+        np.sum (deltas, axis=0, out=dW[-1])
 
         if self._debug_backward_pass:
             print ("[DEBUG] backpropagation output layer\nerror derivative:\n{}\nactivation derivative\n{}".format(dE, df))
             print ("[DEBUG] deltas for this layer (=dE*df)\n{}".format(deltas))
-            print ("[DEBUG] dW\n{}".format(dW))
+            print ("[DEBUG] dW (not divided by n_samples)\n{}".format(dW))
             print ("\n")
         
         # hidden layers
         for i in range ( len(layers_outputs)-2, 0, -1 ):
-            weights = self._weights[i]
-            dE = np.array ( list (map(lambda d: np.matmul(weights,d[:,np.newaxis]).flatten(), deltas )) )
-            # remove dE/do_b where o_b is the bias output
-            dE = dE[:, :-1]
-            df = self._hidden_activation_derivative ( layers_nets[i] )
-            deltas = dE * df
-            prev_layer_outputs = layers_outputs[i-1]
-            biases = np.ones( (prev_layer_outputs.shape[0], 1) )
-            out_and_biases = np.hstack ((prev_layer_outputs, biases))
-            dW = sum ( a[:, np.newaxis]*b for a,b in zip (out_and_biases, deltas) ) / n_samples
-            delta_weights.insert (0, dW)
+            dE = np.matmul (deltas, self._coefs[i].T, out=workspace.errors[i-1][:n_samples])
+            df = self._hidden_activation_derivative ( layers_outputs[i], out=workspace.derivatives[i-1][:n_samples] )
+            deltas = np.multiply (dE, df, out=workspace.deltas[i-1][:n_samples])
+            dW = delta_weights[i-1]
+            np.matmul (layers_outputs[i-1].T, deltas, out=dW[:-1])
+            np.sum (deltas, axis=0, out=dW[-1])
 
             if self._debug_backward_pass:
                 print ("[DEBUG] backpropagation layer {}\nerror derivative:\n{}\nactivation derivative\n{}".format(i, dE, df))
                 print ("[DEBUG] deltas for this layer (=dE*df)\n{}".format(deltas))
-                print ("[DEBUG] dW\n{}".format(dW))
+                print ("[DEBUG] dW (not divided by n_samples)\n{}".format(dW))
                 print ("\n")
 
+        workspace.gradient /= n_samples
 
         assert len(delta_weights) == len (self._weights), "Backpropagation: number of delta_weights and weights are not the same"     
+        if return_loss:
+            return delta_weights, loss
         return delta_weights
 
-    def _do_epoch ( self, X, y ):
+    def _initialize_fit ( self, X, y, keep_weights=False ):
+        '''
+            private method.
+            prepares the network to be trained on the (already checked) dataset X, y:
+            initializes the weights (unless warm_start or keep_weights is set and the network already has weights), the learning rate, the momentum, the activation functions
+            and the state used to detect convergence.
+        '''
+        if self.weights_init_fun not in weights_init_functions:
+            raise ValueError ("weights init. function {} not implemented".format(self.weights_init_fun))
+
+        self.weights_init_function = weights_init_functions[self.weights_init_fun]
+
+        # a new generator at each fit: the same random_state gives the same weights and shuffles (also when it is changed by set_params),
+        # copies of a model with random_state=None do not share the random numbers
+        self._random_generator = np.random.default_rng(self.random_state)
+
+        if not self._weights or not (self.warm_start or keep_weights):
+            self._generate_random_weights (X.shape[1], y.shape[1])
+        elif self._params.dtype != X.dtype:
+            # warm start after a change of dtype: convert the current weights
+            self.set_weights (self._weights)
+
+        self._eta = self.learning_rate_init
+        self.delta_olds = None
+        # number of epochs trained since the initialization: partial_fit continues the learning rate schedule from it
+        self._n_epochs = 0
+
+        if self.activation not in activation_functions or self.activation not in activation_functions_output_derivatives:
+            raise ValueError ("hidden activation function {} not implemented".format(self.activation))
+        self._hidden_activation = activation_functions[self.activation]
+        self._hidden_activation_derivative = activation_functions_output_derivatives[self.activation]
+
+        self._check_loss_evaluation ()
+
+        if not isinstance (self.checkpoint_interval, (int, np.integer)) or self.checkpoint_interval < 1:
+            raise ValueError ("checkpoint interval must be a positive integer, got {}".format(self.checkpoint_interval))
+        # loss of the weights saved as the best ones for early stopping, see _checkpoint_improved
+        self._best_checkpoint_loss = np.inf
+
+        self._best_loss = np.inf
+        # number of epochs since last loss improvement
+        self._loss_not_decreasing_since_epochs = 0
+
+    def _set_batch_size ( self, n_samples ):
+        '''
+            private method.
+            sets the size b_size of the minibatches used to train the network on a dataset of n_samples samples
+        '''
+        if (self.batch_size=='auto'):
+            self.b_size=min(200, n_samples)
+        else:
+            self.b_size=max(1, min(self.batch_size, n_samples))
+
+    def _update_learning_rate ( self, epoch_no ):
+        '''
+            private method.
+            sets the learning rate self._eta for the epoch epoch_no according to the learning_rate schedule ("adaptive" is handled by _update_convergence_state)
+        '''
+        if self.learning_rate == "invscaling":
+            self._eta = self.learning_rate_init / pow (epoch_no, self.power_t )
+
+        if self.learning_rate == "linear":
+            if epoch_no <= self.linear_decay_iterations:
+                alpha_decay = epoch_no / self.linear_decay_iterations
+                self._eta = (1 - alpha_decay) * self.learning_rate_init + alpha_decay * self.linear_decay_eta_zero
+            else:
+                self._eta = self.linear_decay_eta_zero
+
+    def _update_convergence_state ( self, avg_loss ):
+        '''
+            private method.
+            updates the best loss and the number of epochs since its last improvement given the average loss of the last epoch.
+            returns True if the loss improved by more than tol (the caller should then save the current weights as the best ones).
+        '''
+        if avg_loss < self._best_loss - self.tol:
+            self._loss_not_decreasing_since_epochs = 0
+            self._best_loss = avg_loss
+            return True
+
+        self._loss_not_decreasing_since_epochs += 1
+        # with "adaptive" learning rate if the loss does not improve for two consecutive epochs: divide learning rate by 2
+        if self.learning_rate == "adaptive" and self._loss_not_decreasing_since_epochs % 2 == 0:
+            self._eta = self._eta/2
+            if self._debug_epochs:
+                print ("decreasing learning rate")
+        return False
+
+    def _checkpoint_improved ( self, epoch_no, avg_loss ):
+        '''
+            private method.
+            returns True if the weights of the epoch epoch_no have to be saved as the best ones for early stopping:
+            the epoch is a checkpoint (a multiple of checkpoint_interval, or the last epoch of the training) and its loss avg_loss 
+            is lower than the loss of the last saved weights by more than tol.
+            With checkpoint_interval=1 these are the epochs in which the loss improves (see _update_convergence_state).
+            must be called after _update_convergence_state, that decides if epoch_no is the last epoch.
+        '''
+        is_checkpoint = epoch_no % self.checkpoint_interval == 0 or self._has_converged (epoch_no + 1)
+        if not is_checkpoint or not avg_loss < self._best_checkpoint_loss - self.tol:
+            return False
+        self._best_checkpoint_loss = avg_loss
+        return True
+
+    def _save_checkpoint ( self, epoch_no, avg_loss ):
+        '''
+            private method.
+            with early stopping, copies the current weights into the snapshot buffer of the workspace if they are the best ones (see _checkpoint_improved).
+            The buffer is allocated once per training (see _init_workspace): the parameters and the snapshot work as a double buffer, 
+            so saving and restoring the weights never allocates memory.
+        '''
+        if self.early_stopping and self._checkpoint_improved (epoch_no, avg_loss):
+            np.copyto (self._workspace.best_params, self._params)
+
+    def _restore_checkpoint ( self ):
+        '''
+            private method.
+            sets loss_ to the best loss of the training and, with early stopping, restores the weights saved by _save_checkpoint:
+            loss_ is then the validation loss of those weights (higher than the best one if that was not reached at a checkpoint)
+        '''
+        self.loss_ = self._best_loss
+        if self.early_stopping:
+            np.copyto (self._params, self._workspace.best_params)
+            self.loss_ = self._best_checkpoint_loss
+
+    def _has_converged ( self, epoch_no ):
+        '''
+            private method.
+            returns True if the training has to stop before the epoch epoch_no: the maximum number of epochs has been reached
+            or the loss has not improved for n_iter_no_change epochs.
+        '''
+        return epoch_no > self.max_iter or self._loss_not_decreasing_since_epochs >= self.n_iter_no_change
+
+    def _init_workspace ( self, X, y ):
+        '''
+            private method.
+            allocates the buffers used by _do_epoch to train the network on the dataset (X, y) with minibatches of b_size samples
+            (and the snapshot of the best weights with early stopping)
+        '''
+        self._workspace = _Workspace (self.b_size, self._layer_sizes(), dtype=self._params.dtype)
+        if self.shuffle:
+            self._workspace.allocate_shuffle_buffers (X, y)
+        if self.early_stopping:
+            self._workspace.best_params = self._params.copy ()
+
+    def _do_epoch ( self, X, y, accumulate_loss=False ):
         '''
             private method.
             performs a single training step (epoch) in which each sample of the dataset X is used exactly only once.
 
             Optionally splits the dataset X in multiple parts according to the batch_size hyper-parameter,
              then performs several forward and backpropagation passes updating the weights after each pass.
+
+            if accumulate_loss is set returns the average loss of the samples, computed by the backpropagation passes (i.e. before each weights update)
         '''
 
+        workspace = self._workspace
+
         if (self.shuffle):
-            indexes = list (range(len(X)))
+            indexes = workspace.shuffle_indexes
+            indexes.sort ()
             self._random_generator.shuffle (indexes)
-            X = X[indexes]
-            y = y[indexes]
+            X = np.take (X, indexes, axis=0, out=workspace.shuffled_X)
+            y = np.take (y, indexes, axis=0, out=workspace.shuffled_y)
 
+        # momentum buffer, same layout of self._params
         if self.delta_olds is None:
-            self.delta_olds = [np.zeros_like(W) for W in self._weights]
+            self.delta_olds = np.zeros_like (self._params)
 
         n_iterations = len(X) // self.b_size + (0 if len(X) % self.b_size == 0 else 1)
+        # weights decay: W -= 2 * alpha * (b_size/n_samples) * W
+        decay = 1 - 2 * self.alpha * (self.b_size/len(X))
 
+        total_loss = 0
         for b in range(n_iterations):
 
             start = self.b_size * b
             stop = self.b_size * (b + 1)
 
-            layers_nets, layer_outputs = self._forward_pass (X[start:stop])
+            loss = self._minibatch_step (X[start:stop], y[start:stop], decay, accumulate_loss)
+            if accumulate_loss:
+                total_loss += loss
 
-            delta_weights = self._backpropagation ( layers_nets, layer_outputs, y[start:stop] )
-            for W, dW, m in zip (self._weights, delta_weights, self.delta_olds):
-                
-                m *= self.momentum
-                m += (1 - self.momentum) * dW
+        if accumulate_loss:
+            return total_loss / len(X)
+
+    def _minibatch_step ( self, X, y, decay, return_loss=False ):
+        '''
+            private method.
+            performs the forward and backpropagation passes on the minibatch (X, y) and updates the weights with momentum and the weights decay factor decay.
+            if return_loss is set returns the sum of the losses of the minibatch samples (before the update), computed together with the error derivatives.
+        '''
+        workspace = self._workspace
 
-                W -= (self._eta * m) + 2 * (self.alpha * (self.b_size/len(X)) * W)
+        layers_nets, layer_outputs = self._forward_pass (X, workspace)
+
+        loss = None
+        if return_loss:
+            _, loss = self._backpropagation ( layers_nets, layer_outputs, y, workspace, return_loss=True )
+        else:
+            self._backpropagation ( layers_nets, layer_outputs, y, workspace )
+        
+        # the whole update works on the flat buffers of parameters, gradient and momentum
+        m = self.delta_olds
+        dW = workspace.gradient
+        m *= self.momentum
+        dW *= (1 - self.momentum)
+        m += dW
+
+        self._params *= decay
+        # the gradient is not needed anymore: reuse its buffer for eta * m
+        self._params -= np.multiply (self._eta, m, out=dW)
+        return loss
+
+    def _stream_chunks ( self, data, chunk_size, shuffle=False ):
+        '''
+            private method.
+            yields the chunks (X, y) of the streamed dataset data (see fit_stream), converted to the configured dtype (y as a column vector if it is unidimensional).
+            The arrays of a pair (X, y) are read chunk_size samples at a time, the chunks in random order if shuffle is set.
+        '''
+        dtype = self._check_dtype ()
+        if callable (data):
+            chunks = data ()
+        else:
+            X, y = data
+            assert len(X) == len(y), "size of X and y must be the same"
+            starts = np.arange (0, len(X), chunk_size)
+            if shuffle:
+                self._random_generator.shuffle (starts)
+            chunks = ((X[start:start+chunk_size], y[start:start+chunk_size]) for start in starts)
+
+        for X_chunk, y_chunk in chunks:
+            X_chunk = np.asarray (X_chunk, dtype=dtype)
+            y_chunk = np.asarray (y_chunk, dtype=dtype)
+            # if y.shape == (n_samples) convert it to a column vector (n_samples, 1)
+            if y_chunk.ndim == 1:
+                y_chunk = y_chunk[:, np.newaxis]
+            assert len(X_chunk) == len(y_chunk), "size of X and y must be the same"
+            yield X_chunk, y_chunk
+
+    def _do_stream_epoch ( self, data, n_samples, chunk_size, accumulate_loss=False ):
+        '''
+            private method.
+            streaming version of _do_epoch: the chunks of data are copied into the shuffle buffer of the workspace, 
+            that is shuffled and split into minibatches each time it is full (see _train_on_stream_buffer).
+            if accumulate_loss is set returns the average loss of the samples, computed by the backpropagation passes
+        '''
+        workspace = self._workspace
+
+        # momentum buffer, same layout of self._params
+        if self.delta_olds is None:
+            self.delta_olds = np.zeros_like (self._params)
+
+        # weights decay: W -= 2 * alpha * (b_size/n_samples) * W
+        decay = 1 - 2 * self.alpha * (self.b_size/n_samples)
+
+        capacity = len(workspace.stream_X)
+        n_buffered = 0
+        total_loss = 0
+        for X_chunk, y_chunk in self._stream_chunks (data, chunk_size, self.shuffle):
+            offset = 0
+            while offset < len(X_chunk):
+                n_copied = min (capacity - n_buffered, len(X_chunk) - offset)
+                workspace.stream_X[n_buffered:n_buffered+n_copied] = X_chunk[offset:offset+n_copied]
+                workspace.stream_y[n_buffered:n_buffered+n_copied] = y_chunk[offset:offset+n_copied]
+                n_buffered += n_copied
+                offset += n_copied
+                if n_buffered == capacity:
+                    n_buffered, loss = self._train_on_stream_buffer (n_buffered, decay, accumulate_loss=accumulate_loss)
+                    total_loss += loss
+
+        _, loss = self._train_on_stream_buffer (n_buffered, decay, last=True, accumulate_loss=accumulate_loss)
+        total_loss += loss
+
+        if accumulate_loss:
+            return total_loss / n_samples
+
+    def _train_on_stream_buffer ( self, n_buffered, decay, last=False, accumulate_loss=False ):
+        '''
+            private method.
+            shuffles the first n_buffered samples of the shuffle buffer (if shuffle is set) and performs a minibatch step for each b_size of them.
+            The samples that do not fill a minibatch are moved to the beginning of the buffer, to be used with the next chunks,
+            unless last is set (end of the epoch): then they make the last, smaller, minibatch.
+            This way the minibatches are the same of _do_epoch when shuffle is not set.
+
+            returns the number of samples left in the buffer and the sum of the losses of the samples of the minibatches, 
+            computed by their backpropagation passes (0 unless accumulate_loss is set)
+        '''
+        workspace = self._workspace
+        X = workspace.stream_X[:n_buffered]
+        y = workspace.stream_y[:n_buffered]
+        if self.shuffle:
+            indexes = self._random_generator.permutation (n_buffered)
+            X = np.take (X, indexes, axis=0, out=workspace.shuffled_X[:n_buffered])
+            y = np.take (y, indexes, axis=0, out=workspace.shuffled_y[:n_buffered])
+
+        n_iterations = n_buffered // self.b_size
+        if last and n_buffered % self.b_size != 0:
+            n_iterations += 1
+
+        total_loss = 0
+        for b in range(n_iterations):
+
+            start = self.b_size * b
+            stop = self.b_size * (b + 1)
+
+            loss = self._minibatch_step (X[start:stop], y[start:stop], decay, accumulate_loss)
+            if accumulate_loss:
+                total_loss += loss
+
+        n_left = max (0, n_buffered - n_iterations * self.b_size)
+
+        workspace.stream_X[:n_left] = X[n_buffered-n_left:]
+        workspace.stream_y[:n_left] = y[n_buffered-n_left:]
+        return n_left, total_loss
+
+    def _stream_loss ( self, data, chunk_size ):
+        '''
+            private method.
+            returns the average loss of the network on the streamed dataset data, accumulated chunk by chunk
+        '''
+        total_loss = 0
+        n_samples = 0
+        for X_chunk, y_chunk in self._stream_chunks (data, chunk_size):
+            predicted = self._predict_internal (X_chunk)
+            total_loss += self._loss (y_chunk, predicted, reduction="sum")
+            n_samples += len(predicted)
+        if n_samples == 0:
+            raise ValueError ("the streamed dataset has no samples")
+        return total_loss / n_samples
      
     def _predict_internal ( self, X ):
         '''
@@ -437,7 +1031,7 @@ class BaseNeuralNetwork:
         '''
         # for internal usage only, subclasses can reimplement predict() instead
         assert self._weights is not None, "call fit() or set_weights() before predict()"
-        X = np.array (X)
+        X = np.asarray (X, dtype=self._params.dtype)
         _ , layer_outputs = self._forward_pass (X)
         return layer_outputs[-1]
 
@@ -448,6 +1042,33 @@ class BaseNeuralNetwork:
         '''
         return self._predict_internal(X)
 
+    def compile_predictor ( self, max_batch=256 ):
+        '''
+            returns a CompiledPredictor: a frozen copy of the current weights with the buffers for batches of at most max_batch samples preallocated,
+            to predict many small batches (or single samples with predict_one) with the least overhead.
+            Its predict() returns what predict() of the network returns (e.g. the labels for a classifier), predict_proba() the outputs.
+            e.g. predictor = model.compile_predictor (64); y = predictor.predict_one (x)
+        '''
+        assert self._weights is not None, "call fit() or set_weights() before compile_predictor()"
+        return CompiledPredictor (self._weights, self._hidden_activation, self._output_activation, max_batch, self._threshold)
+
+    def save ( self, fname ):
+        '''
+            saves the network (hyper-parameters, weights and fitted properties) into the file fname, see save_models
+        '''
+        save_models (fname, [self])
+
+    @classmethod
+    def load ( cls, fname, mmap=True ):
+        '''
+            returns the network saved into the file fname by save(), see load_models.
+            e.g. model = MLPRegressor.load ("model.ann")
+        '''
+        models, _ = load_models (fname, mmap)
+        if len(models) != 1 or not isinstance (models[0], cls):
+            raise ValueError ("{} does not contain a single {}".format(fname, cls.__name__))
+        return models[0]
+
     def fit ( self, X, y ):
         '''
             trains the network.
@@ -459,31 +1080,16 @@ class BaseNeuralNetwork:
         '''
 
         X, y = self._check_fit_datasets (X,y)
-
-        if self.weights_init_fun not in weights_init_functions:
-            raise ValueError ("weights init. function {} not implemented".format(self.weights_init_fun))
-
-        self.weights_init_function = weights_init_functions[self.weights_init_fun]
-
-        if not self._weights or not self.warm_start:
-            self._generate_random_weights (X.shape[1], y.shape[1])
-
-        self._eta = self.learning_rate_init
+        self._initialize_fit (X, y)
 
         X_validation = None
         y_validation = None
-        self.delta_olds = None
-
-        if self.activation not in activation_functions or self.activation not in activation_functions_derivatives:
-            raise ValueError ("hidden activation function {} not implemented".format(self.activation))
-        self._hidden_activation = activation_functions[self.activation]
-        self._hidden_activation_derivative = activation_functions_derivatives[self.activation]
 
         if self.early_stopping:
             if self._debug_early_stopping:
                 print ("[DEBUG] early stopping: (original) X.shape {} y.shape {} - validation fraction {}".format(X.shape, y.shape, self.validation_fraction))  
             
-            X, X_validation, y, y_validation = train_test_split ( X, y, test_size=self.validation_fraction, shuffle=self.shuffle )
+            X, X_validation, y, y_validation = train_test_split ( X, y, test_size=self.validation_fraction, shuffle=self.shuffle, random_state=self.random_state )
             
             if self._debug_early_stopping:
                 print ("[DEBUG] early stopping (after hold out) X.shape {} y.shape {}".format(X.shape, y.shape))
@@ -495,58 +1101,35 @@ class BaseNeuralNetwork:
 
         epoch_no = 1
 
-        if (self.batch_size=='auto'):
-            self.b_size=min(200, len(X))
-        else:
-            self.b_size=max(1, min(self.batch_size, len(X)))
+        self._set_batch_size (len(X))
+
+        self._init_workspace (X, y)
 
         if self._debug_epochs:
             n_iterations = len(X) // self.b_size + (0 if len(X) % self.b_size == 0 else 1)
             print ("[DEBUG] batch size:", self.b_size)
             print ("[DEBUG] n_iterations per epoch:", n_iterations)
         
-        best_loss = np.inf
-        best_weights = None
-        # number of epochs since last loss improvement
-        loss_not_decreasing_since_epochs = 0
+        while not self._has_converged (epoch_no):
 
-        while epoch_no <= self.max_iter and loss_not_decreasing_since_epochs < self.n_iter_no_change:
+            self._update_learning_rate (epoch_no)
 
-            if self.learning_rate == "invscaling":
-                self._eta = self.learning_rate_init / pow (epoch_no, self.power_t )
-
-            if self.learning_rate == "linear":
-                if epoch_no <= self.linear_decay_iterations:
-                    alpha_decay = epoch_no / self.linear_decay_iterations
-                    self._eta = (1 - alpha_decay) * self.learning_rate_init + alpha_decay * self.linear_decay_eta_zero
-                else:
-                    self._eta = self.linear_decay_eta_zero
-
-            self._do_epoch ( X, y )
+            accumulated_loss = self._do_epoch ( X, y, self._accumulates_loss (epoch_no) )
             
             if self.early_stopping:
                 predicted = self._predict_internal (X_validation)
-                losses_matrix = self._loss (y_validation, predicted)
+                avg_loss = self._loss (y_validation, predicted, reduction="sum") / len(predicted)
+            elif accumulated_loss is not None:
+                avg_loss = accumulated_loss
             else:
                 predicted = self._predict_internal (X)
-                losses_matrix = self._loss (y, predicted)
-                
-            avg_loss = np.average (np.sum(losses_matrix, axis=1))
+                avg_loss = self._loss (y, predicted, reduction="sum") / len(predicted)
 
             if self._debug_epochs:
                 print ("average loss for epoch {}: {}".format(epoch_no, avg_loss))
             
-            if avg_loss < best_loss - self.tol:
-                loss_not_decreasing_since_epochs = 0
-                best_loss = avg_loss
-                best_weights = copy.deepcopy (self._weights)
-            else:
-                loss_not_decreasing_since_epochs += 1
-                # with "adaptive" learning rate if the loss does not improve for two consecutive epochs: divide learning rate by 2
-                if self.learning_rate == "adaptive" and loss_not_decreasing_since_epochs % 2 == 0:
-                    self._eta = self._eta/2
-                    if self._debug_epochs:
-                        print ("decreasing learning rate")
+            self._update_convergence_state (avg_loss)
+            self._save_checkpoint (epoch_no, avg_loss)
 
             if self._do_reporting:
                 train_accuracy = None
@@ -560,12 +1143,14 @@ class BaseNeuralNetwork:
 
             epoch_no += 1
         
-        if self.early_stopping:
-            self.set_weights (best_weights)
+        self._n_epochs = epoch_no - 1
+
+        self._restore_checkpoint ()
+
+        self._workspace = None
 
         # set external-readable properties after fitting
         self.n_iter_ = epoch_no
-        self.loss_ = best_loss
         self.n_layers_ = len(self.hidden_layer_sizes)
         self.n_outputs_ = y.shape[1]
         self.hidden_activation_ = self.activation
@@ -601,74 +1186,40 @@ class BaseNeuralNetwork:
         '''
 
         X, y = self._check_fit_datasets (X,y)
-
-        if self.weights_init_fun not in weights_init_functions:
-            raise ValueError ("weights init. function {} not implemented".format(self.weights_init_fun))
-
-        self.weights_init_function = weights_init_functions[self.weights_init_fun]
-
-        if not self._weights or not self.warm_start:
-            self._generate_random_weights (X.shape[1], y.shape[1])
-
-        self._eta = self.learning_rate_init
+        self._initialize_fit (X, y)
 
         X_validation = None
         y_validation = None
-        self.delta_olds = None
-
-        if self.activation not in activation_functions or self.activation not in activation_functions_derivatives:
-            raise ValueError ("hidden activation function {} not implemented".format(self.activation))
-        self._hidden_activation = activation_functions[self.activation]
-        self._hidden_activation_derivative = activation_functions_derivatives[self.activation]
 
         if self.early_stopping:
-            X, X_validation, y, y_validation = train_test_split ( X, y, test_size=self.validation_fraction, shuffle=self.shuffle )
+            X, X_validation, y, y_validation = train_test_split ( X, y, test_size=self.validation_fraction, shuffle=self.shuffle, random_state=self.random_state )
             
         epoch_no = 1
 
-        if (self.batch_size=='auto'):
-            self.b_size=min(200, len(X))
-        else:
-            self.b_size=max(1, min(self.batch_size, len(X)))
-        
-        best_loss = np.inf
-        best_weights = None
-        # number of epochs since last loss improvement
-        loss_not_decreasing_since_epochs = 0
-
-        while epoch_no <= self.max_iter and loss_not_decreasing_since_epochs < self.n_iter_no_change:
+        self._set_batch_size (len(X))
 
-            if self.learning_rate == "invscaling":
-                self._eta = self.learning_rate_init / pow (epoch_no, self.power_t )
+        self._init_workspace (X, y)
+        
+        while not self._has_converged (epoch_no):
 
-            if self.learning_rate == "linear":
-                if epoch_no <= self.linear_decay_iterations:
-                    alpha_decay = epoch_no / self.linear_decay_iterations
-                    self._eta = (1 - alpha_decay) * self.learning_rate_init + alpha_decay * self.linear_decay_eta_zero
-                else:
-                    self._eta = self.linear_decay_eta_zero
+            self._update_learning_rate (epoch_no)
 
-            self._do_epoch ( X, y )
+            accumulated_loss = self._do_epoch ( X, y, self._accumulates_loss (epoch_no) )
             
             if self.early_stopping:
                 predicted = self._predict_internal (X_validation)
-                losses_matrix = self._loss (y_validation, predicted)
+                avg_loss = self._loss (y_validation, predicted, reduction="sum") / len(predicted)
+            elif accumulated_loss is not None:
+                avg_loss = accumulated_loss
             else:
                 predicted = self._predict_internal (X)
-                losses_matrix = self._loss (y, predicted)
-                
-            avg_loss = np.average (np.sum(losses_matrix, axis=1))
+                avg_loss = self._loss (y, predicted, reduction="sum") / len(predicted)
 
             
-            if avg_loss < best_loss - self.tol:
-                loss_not_decreasing_since_epochs = 0
-                best_loss = avg_loss
-                best_weights = copy.deepcopy (self._weights)
-            else:
-                loss_not_decreasing_since_epochs += 1
-                # with "adaptive" learning rate if the loss does not improve for two consecutive epochs: divide learning rate by 2
-                if self.learning_rate == "adaptive" and loss_not_decreasing_since_epochs % 2 == 0:
-                    self._eta = self._eta/2
+            self._update_convergence_state (avg_loss)
+            self._save_checkpoint (epoch_no, avg_loss)
+
+            self._n_epochs = epoch_no
 
             # set external-readable properties after fitting
             self.n_iter_ = epoch_no
@@ -681,10 +1232,138 @@ class BaseNeuralNetwork:
 
             epoch_no += 1
         
-        self._loss = best_loss
+        self._restore_checkpoint ()
+
+        self._workspace = None
+
+    def partial_fit ( self, X, y ):
+        '''
+        performs a single epoch of training on the dataset X, y (e.g. a batch of new samples), continuing from the current state of the network:
+        the weights, the momentum and the learning rate schedule (each call is an epoch for "invscaling", "linear" and "adaptive") are kept between calls.
+        The first call on a network that has not been trained initializes it (the weights are kept if they have been set with set_weights()).
+        The training workspace is also kept between calls, so that batches of the same size do not allocate memory.
+
+        early_stopping, max_iter and n_iter_no_change are ignored, loss_ is the average loss on X, y after the update (during it with loss_evaluation="accumulated").
+
+        :param: X input data of shape (n_samples, n_features)
+        :param: y target values for the dataset X. Shape must be (n_samples, n_outputs)
+        '''
+        X, y = self._check_fit_datasets (X,y)
+
+        # networks that have not been trained in this process (or have been loaded with load()) have no training state
+        if getattr (self, "_eta", None) is None or self._weights is None:
+            self._initialize_fit (X, y, keep_weights=True)
+        elif self._params.dtype != X.dtype:
+            # the dtype has been changed: convert the current weights and momentum
+            self.set_weights (self._weights)
+            if self.delta_olds is not None:
+                self.delta_olds = self.delta_olds.astype (self._params.dtype)
+        if self.delta_olds is not None and self.delta_olds.shape != self._params.shape:
+            # weights of a different architecture set with set_weights(): the momentum starts again from zero
+            self.delta_olds = None
+
+        epoch_no = self._n_epochs + 1
+
+        self._set_batch_size (len(X))
+
+        workspace = self._workspace
+        if workspace is None or workspace.max_samples < self.b_size or workspace.gradient.shape != self._params.shape or workspace.gradient.dtype != self._params.dtype:
+            workspace = self._workspace = _Workspace (self.b_size, self._layer_sizes(), dtype=self._params.dtype)
+        if self.shuffle and len(getattr (workspace, "shuffle_indexes", ())) != len(X):
+            workspace.allocate_shuffle_buffers (X, y)
+
+        self._update_learning_rate (epoch_no)
+
+        avg_loss = self._do_epoch ( X, y, self._accumulates_loss (epoch_no) )
+
+        if avg_loss is None:
+            predicted = self._predict_internal (X)
+            avg_loss = self._loss (y, predicted, reduction="sum") / len(predicted)
+        # only for the "adaptive" learning rate
+        self._update_convergence_state (avg_loss)
+
+        self._n_epochs = epoch_no
+
+        # set external-readable properties after fitting
+        self.n_iter_ = epoch_no
+        self.loss_ = avg_loss
+        self.n_layers_ = len(self.hidden_layer_sizes)
+        self.n_outputs_ = y.shape[1]
+        self.hidden_activation_ = self.activation
+
+    def fit_stream ( self, data, validation_data=None, n_samples=None, chunk_size=10000, buffer_size=100000 ):
+        '''
+        out-of-core version of fit(X,y): trains the network on a dataset that is read chunk by chunk, with memory bounded by chunk_size and buffer_size.
+        The samples are shuffled within a buffer of buffer_size samples (the chunks of a pair of arrays are also read in random order),
+        the average loss of each epoch is accumulated chunk by chunk over the training set (over validation_data with early_stopping).
+        does not honor debug flags nor writes reports.
+
+        :param: data either a pair (X, y) of arrays, e.g. memory-mapped with np.load (fname, mmap_mode="r"), 
+                or a function returning an iterable of chunks (X, y), e.g. a generator function that reads the dataset from disk (it is called at each epoch)
+        :param: validation_data dataset (in the same formats of data) for early stopping: required if early_stopping is set
+        :param: n_samples number of samples of data if it is a function (otherwise they are counted with an additional pass over the dataset)
+        :param: chunk_size number of samples read at a time from the arrays of data
+        :param: buffer_size size of the shuffle buffer (at least b_size)
+
+        example usage:
+
+        .. code-block:: python
+
+            X = np.load ("X.npy", mmap_mode="r")
+            y = np.load ("y.npy", mmap_mode="r")
+            model.fit_stream ((X, y), chunk_size=50000, buffer_size=500000)
+        '''
+        if self.early_stopping and validation_data is None:
+            raise ValueError ("early stopping needs validation_data in streaming training")
+
+        X_first, y_first = next (iter (self._stream_chunks (data, chunk_size)), (None, None))
+        if X_first is None:
+            raise ValueError ("the streamed training set has no chunks")
+        if n_samples is None:
+            if callable (data):
+                n_samples = sum (len(X_chunk) for X_chunk, _ in self._stream_chunks (data, chunk_size))
+            else:
+                n_samples = len(data[0])
+        if n_samples <= 0:
+            raise ValueError ("the streamed training set has no samples")
+
+        self._initialize_fit (X_first, y_first)
 
+        self._set_batch_size (n_samples)
+
+        self._workspace = _Workspace (self.b_size, self._layer_sizes(), dtype=self._params.dtype)
+        self._workspace.allocate_stream_buffers (max (buffer_size, self.b_size), X_first.shape[1], y_first.shape[1], dtype=self._params.dtype)
         if self.early_stopping:
-            self.set_weights (best_weights)
+            self._workspace.best_params = self._params.copy ()
+
+        loss_data = validation_data if self.early_stopping else data
+
+        epoch_no = 1
+        while not self._has_converged (epoch_no):
+
+            self._update_learning_rate (epoch_no)
+
+            avg_loss = self._do_stream_epoch ( data, n_samples, chunk_size, self._accumulates_loss (epoch_no) )
+
+            if avg_loss is None:
+                avg_loss = self._stream_loss (loss_data, chunk_size)
+
+            self._update_convergence_state (avg_loss)
+            self._save_checkpoint (epoch_no, avg_loss)
+
+            epoch_no += 1
+
+        self._n_epochs = epoch_no - 1
+
+        self._restore_checkpoint ()
+
+        self._workspace = None
+
+        # set external-readable properties after fitting
+        self.n_iter_ = epoch_no
+        self.n_layers_ = len(self.hidden_layer_sizes)
+        self.n_outputs_ = y_first.shape[1]
+        self.hidden_activation_ = self.activation
 
         
 class MLPRegressor (BaseNeuralNetwork):
@@ -695,46 +1374,67 @@ class MLPRegressor (BaseNeuralNetwork):
     def __init__ ( self, hidden_layer_sizes=(100, ), activation='relu', solver='sgd', alpha=0.0001, batch_size='auto', 
                    learning_rate='constant', learning_rate_init=0.001, power_t=0.5, max_iter=200, shuffle=True, random_state=None, 
                    tol=0.0001, verbose=False, warm_start=False, momentum=0.9, nesterovs_momentum=True, early_stopping=False, 
-                   validation_fraction=0.1, beta_1=0.9, beta_2=0.999, epsilon=1e-08, n_iter_no_change=10, max_fun=15000,weights_init_fun="random_normal", weights_init_value=0.7 ):
+                   validation_fraction=0.1, beta_1=0.9, beta_2=0.999, epsilon=1e-08, n_iter_no_change=10, max_fun=15000,weights_init_fun="random_normal", weights_init_value=0.7, dtype="float64",
+                   loss_evaluation="full", full_evaluation_interval=None, checkpoint_interval=1 ):
         
         super().__init__ (hidden_layer_sizes=hidden_layer_sizes, hidden_activation=activation, output_activation="identity", 
                        solver=solver, alpha=alpha, batch_size=batch_size, learning_rate=learning_rate, learning_rate_init=learning_rate_init,
                        power_t=power_t, max_iter=max_iter, shuffle=shuffle, random_state=random_state, tol=tol, verbose=verbose, 
                        warm_start=warm_start, momentum=momentum, nesterovs_momentum=nesterovs_momentum, early_stopping=early_stopping, 
                        validation_fraction=validation_fraction, beta_1=beta_1, beta_2=beta_2, epsilon=epsilon, n_iter_no_change=n_iter_no_change,
-                       max_fun=max_fun, loss="squared", weights_init_fun=weights_init_fun, weights_init_value=weights_init_value)
+                       max_fun=max_fun, loss="squared", weights_init_fun=weights_init_fun, weights_init_value=weights_init_value, dtype=dtype,
+                       loss_evaluation=loss_evaluation, full_evaluation_interval=full_evaluation_interval, checkpoint_interval=checkpoint_interval)
 
 class MLPClassifier (BaseNeuralNetwork):
     '''
         Neural network that solves binary classification tasks by optimizing the Multiclass Logarithmic Loss (Crossentropy) using a normalized tanh activation function for its sole output units.
     '''
 
+    _threshold = 0.5
+
     def __init__ ( self, hidden_layer_sizes=(100, ), activation='relu', output_activation="zero_one_tanh", solver='sgd', alpha=0.0001, batch_size='auto', learning_rate='constant',
                    learning_rate_init=0.001, power_t=0.5, max_iter=200, shuffle=True, random_state=None, tol=0.0001, verbose=False,
                    warm_start=False, momentum=0.9, nesterovs_momentum=True, early_stopping=False, validation_fraction=0.1, beta_1=0.9,
-                   beta_2=0.999, epsilon=1e-08, n_iter_no_change=10, max_fun=15000,weights_init_fun="random_uniform", weights_init_value=0.25 ):
+                   beta_2=0.999, epsilon=1e-08, n_iter_no_change=10, max_fun=15000,weights_init_fun="random_uniform", weights_init_value=0.25, dtype="float64",
+                   loss_evaluation="full", full_evaluation_interval=None, checkpoint_interval=1 ):
         
         super().__init__ (hidden_layer_sizes=hidden_layer_sizes, hidden_activation=activation, output_activation=output_activation, 
                        solver=solver, alpha=alpha, batch_size=batch_size, learning_rate=learning_rate, learning_rate_init=learning_rate_init,
                        power_t=power_t, max_iter=max_iter, shuffle=shuffle, random_state=random_state, tol=tol, verbose=verbose, 
                        warm_start=warm_start, momentum=momentum, nesterovs_momentum=nesterovs_momentum, early_stopping=early_stopping, 
                        validation_fraction=validation_fraction, beta_1=beta_1, beta_2=beta_2, epsilon=epsilon, n_iter_no_change=n_iter_no_change,
-                       max_fun=max_fun, loss="log_loss",weights_init_fun=weights_init_fun, weights_init_value=weights_init_value)
+                       max_fun=max_fun, loss="log_loss",weights_init_fun=weights_init_fun, weights_init_value=weights_init_value, dtype=dtype,
+                       loss_evaluation=loss_evaluation, full_evaluation_interval=full_evaluation_interval, checkpoint_interval=checkpoint_interval)
     
     def fit ( self, X, y ):
         '''
             trains the model using the dataset X of shape (n_samples, n_features) and target labels y.
             The shape of y must be (n_samples, 1) (multilabel output is not supported for classification) and each label must be 0 or 1. 
         '''
+        y = self._check_labels (y)
+        super().fit(X,y)
+
+    def partial_fit ( self, X, y ):
+        '''
+            performs a single epoch of training on the dataset X and target labels y, continuing from the current state of the model (see BaseNeuralNetwork.partial_fit).
+            The shape of y must be (n_samples, 1) and each label must be 0 or 1. 
+        '''
+        y = self._check_labels (y)
+        super().partial_fit(X,y)
+
+    def _check_labels ( self, y ):
+        '''
+            private method.
+            checks that y are labels suitable for binary classification: returns them as a column vector (n_samples, 1) 
+        '''
         y = np.array (y)
         # if y.shape == (n_samples) convert it to a column vector (n_samples, 1)
         if y.ndim == 1:
             y = y[:, np.newaxis]
         assert y.shape[1] == 1, "Multilabel output is not supported for classification"
-        for label in y[:, 0]:
-            assert label == 0 or label == 1, "labels for classification must be either 0 or 1"
+        assert np.all ((y == 0) | (y == 1)), "labels for classification must be either 0 or 1"
         self.classes_ = [0,1]
-        super().fit(X,y)
+        return y
 
     def predict ( self, X ):
         '''
@@ -742,8 +1442,8 @@ class MLPClassifier (BaseNeuralNetwork):
             the returned labels are either 0 or 1 depending on whether the value of the output unit is greater than 0.5 or not.
         '''
         y = self._predict_internal (X)
-        ones = y >= 0.5
-        zeros = y < 0.5
+        ones = y >= self._threshold
+        zeros = y < self._threshold
         y[ones] = 1
         y[zeros] = 0
         return y
@@ -761,3 +1461,68 @@ class MLPClassifier (BaseNeuralNetwork):
             the returned values range in the interval (-inf,1).
         '''
         return np.log( self.predict_proba(X) )
+
+def _model_classes ():
+    '''
+        private helper.
+        returns a dictionary class name -> class of BaseNeuralNetwork and its subclasses
+    '''
+    classes = {}
+    pending = [BaseNeuralNetwork]
+    while pending:
+        cls = pending.pop ()
+        classes[cls.__name__] = cls
+        pending += cls.__subclasses__ ()
+    return classes
+
+def save_models ( fname, models, names=None ):
+    '''
+        saves the trained networks models (with their names, if given) into the file fname, in the binary format of persistence.py: 
+        the header holds the class, the hyper-parameters and the fitted properties of each network, 
+        its flat parameters buffer is stored as an array aligned for memory-mapping.
+    '''
+    descriptions = []
+    for i, model in enumerate (models):
+        assert model._weights is not None, "call fit() or set_weights() before saving a network"
+        descriptions.append ({
+            "class": type(model).__name__,
+            "name": names[i] if names is not None else None,
+            "hyperparameters": model.get_params (),
+            "output_activation": model.out_activation_,
+            "loss": model._loss_fun_name,
+            "weights_shapes": [list(shape) for shape in model._weights_shapes],
+            "fitted": {attribute: getattr (model, attribute) for attribute in _FITTED_ATTRIBUTES if hasattr (model, attribute)}
+        })
+    write_arrays (fname, {"models": descriptions}, [model._params for model in models])
+
+def load_models ( fname, mmap=True ):
+    '''
+        loads the networks saved into the file fname by save_models: returns the pair (list of networks, list of their names).
+
+        with mmap the parameters of the networks are copy-on-write memory maps of the file: loading does not read the weights,
+        and they can still be modified (e.g. trained again with warm_start) without changing the file.
+    '''
+    meta, arrays = read_arrays (fname, mmap)
+    classes = _model_classes ()
+    models = []
+    for description, params in zip (meta["models"], arrays):
+        if description["class"] not in classes:
+            raise ValueError ("unknown network class {} in {}".format(description["class"], fname))
+        cls = classes[description["class"]]
+        arguments = dict (description["hyperparameters"])
+        constructor_parameters = inspect.signature (cls.__init__).parameters
+        if "hidden_activation" in constructor_parameters:
+            arguments["hidden_activation"] = arguments.pop ("activation")
+        for name in ("output_activation", "loss"):
+            if name in constructor_parameters:
+                arguments[name] = description[name]
+        model = cls (**arguments)
+
+        model._weights_shapes = [tuple(shape) for shape in description["weights_shapes"]]
+        model._params = params
+        model._create_weights_views ()
+        for attribute, value in description["fitted"].items ():
+            setattr (model, attribute, value)
+        models.append (model)
+
+    return models, [description["name"] for description in meta["models"]]
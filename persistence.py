@@ -0,0 +1,105 @@
+'''
+    compact binary format for numeric arrays described by a json header, used to save the trained models (see neural_network.save_models).
+
+    layout of a file (integers are little-endian):
+
+        8 bytes         MAGIC
+        uint32          format version
+        uint32          length in bytes of the json header
+        json header     utf-8 encoded: {"meta": ..., "arrays": [{"dtype": "<f8", "shape": [...], "offset": ...}, ...]}
+        arrays data     each array is stored in C order and little-endian, starting at a multiple of ALIGNMENT bytes
+                        (the offsets in the header are relative to the first aligned byte after the header),
+                        so that the arrays can be memory-mapped without copying them.
+'''
+
+import os
+import json
+import struct
+
+import numpy as np
+
+MAGIC = b"ANNMODEL"
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+
+_PREAMBLE = struct.Struct ("<8sII")
+
+def _aligned ( n ):
+    '''
+        private helper.
+        returns the smallest multiple of ALIGNMENT not lower than n
+    '''
+    return (n + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+def _json_default ( value ):
+    '''
+        private helper.
+        converts the numpy scalars (e.g. hyper-parameters drawn by getRandomParams) into python numbers for json
+    '''
+    if isinstance (value, np.generic):
+        return value.item ()
+    raise TypeError ("{} is not json serializable".format(type(value)))
+
+def write_arrays ( fname, meta, arrays ):
+    '''
+        writes the arrays and the json-serializable object meta into the file fname.
+        The file is written under a temporary name and then renamed, so that a reader never sees a partial file.
+    '''
+    arrays = [np.ascontiguousarray (array, dtype=np.asarray (array).dtype.newbyteorder ("<")) for array in arrays]
+    descriptions = []
+    offset = 0
+    for array in arrays:
+        descriptions.append ({"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset})
+        offset = _aligned (offset + array.nbytes)
+    header = json.dumps ({"meta": meta, "arrays": descriptions}, default=_json_default).encode ("utf-8")
+    data_start = _aligned (_PREAMBLE.size + len(header))
+
+    tmpname = "{}.{}.tmp".format(fname, os.getpid())
+    with open (tmpname, "wb") as fout:
+        fout.write (_PREAMBLE.pack (MAGIC, FORMAT_VERSION, len(header)))
+        fout.write (header)
+        for array, description in zip (arrays, descriptions):
+            fout.write (b"\0" * (data_start + description["offset"] - fout.tell ()))
+            fout.write (array.tobytes ())
+    os.replace (tmpname, fname)
+
+def read_arrays ( fname, mmap=True ):
+    '''
+        reads a file written by write_arrays: returns the pair (meta, list of arrays).
+
+        with mmap the arrays are views on a copy-on-write memory map of the file: nothing is read until it is used
+        and the arrays can be modified without changing the file. Otherwise the arrays are read into memory.
+    '''
+    with open (fname, "rb") as fin:
+        preamble = fin.read (_PREAMBLE.size)
+        if len(preamble) < _PREAMBLE.size:
+            raise ValueError ("{} is not a model file".format(fname))
+        magic, version, header_length = _PREAMBLE.unpack (preamble)
+        if magic != MAGIC:
+            raise ValueError ("{} is not a model file".format(fname))
+        if version > FORMAT_VERSION:
+            raise ValueError ("{} has format version {}, this version reads up to {}".format(fname, version, FORMAT_VERSION))
+        header = json.loads (fin.read (header_length).decode ("utf-8"))
+        data_start = _aligned (_PREAMBLE.size + header_length)
+        data_length = max ((description["offset"] + np.dtype (description["dtype"]).itemsize * int (np.prod (description["shape"])) for description in header["arrays"]), default=0)
+
+        if data_length == 0:
+            data = np.empty (0, dtype=np.uint8)
+        elif mmap:
+            data = np.memmap (fin, dtype=np.uint8, mode="c", offset=data_start, shape=(data_length,))
+        else:
+            # a buffer with the same alignment of the file
+            buffer = np.empty (data_length + ALIGNMENT, dtype=np.uint8)
+            start = -buffer.ctypes.data % ALIGNMENT
+            data = buffer[start:start+data_length]
+            fin.seek (data_start)
+            fin.readinto (data)
+
+    arrays = []
+    for description in header["arrays"]:
+        dtype = np.dtype (description["dtype"])
+        nbytes = dtype.itemsize * int (np.prod (description["shape"]))
+        # plain ndarray views: the memory map stays open as their base
+        array = np.asarray (data[description["offset"]:description["offset"]+nbytes]).view (dtype).reshape (description["shape"])
+        arrays.append (array)
+    return header["meta"], arrays
@@ -0,0 +1,177 @@
+
+import os
+import re
+import json
+import math
+import sqlite3
+from pathlib import Path
+
+def readGridSearchFile(filename):
+    '''
+    read a grid search output file: returns the list of pairs (params, perf).
+    every line with a json object is the params of the following result line (a json list): lines that cannot be parsed 
+    (e.g. the last one of a file interrupted while it was written) are skipped, as well as the "*** Best ***" sections 
+    (a file written by many grid searches can have one after the results of each search).
+    '''
+    out = []
+    params = None
+    # number of lines of the current "*** Best ***" section still to skip
+    skip = 0
+    with open(Path(filename)) as infile:
+        for line in infile:
+            if line.startswith("*"):
+                skip = 2
+                continue
+            if skip > 0:
+                skip -= 1
+                continue
+            try:
+                item = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(item, dict):
+                params = item
+            elif isinstance(item, list) and params is not None:
+                out.append ((params, item))
+                params = None
+    
+    return out
+
+class ResultStore:
+    '''
+        append-only store of grid search results on a SQLite database.
+
+        every result is a pair (params, perf) as in the .gsv files: params is the dictionary of the hyper-parameters,
+        perf the list [validation loss, (training loss,) std, n_folds]. Results are indexed by validation loss,
+        so that the best k of them can be retrieved without reading all the others.
+
+        example usage:
+
+        .. code-block:: python
+
+            with ResultStore ("model_selecton_results/results.sqlite") as store:
+                store.import_directory ("model_selecton_results")
+                for params, perf in store.top_k (10, activation="tanh", hidden_layer_sizes=[50, 50]):
+                    print (params, perf)
+    '''
+
+    def __init__ ( self, fname ):
+        '''
+            opens (or creates) the store in the database file fname
+        '''
+        self.fname = fname
+        self._connection = sqlite3.connect (fname)
+        with self._connection:
+            self._connection.execute ("CREATE TABLE IF NOT EXISTS results (id INTEGER PRIMARY KEY, source TEXT, params TEXT, perf TEXT, val_loss REAL)")
+            self._connection.execute ("CREATE INDEX IF NOT EXISTS results_val_loss ON results (val_loss)")
+            self._connection.execute ("CREATE INDEX IF NOT EXISTS results_source ON results (source)")
+            # .gsv files already imported (and the absolute path of their directory): they are imported again only if they change
+            self._connection.execute ("CREATE TABLE IF NOT EXISTS imported_files (source TEXT PRIMARY KEY, mtime REAL, size INTEGER, directory TEXT)")
+            # stores created before the directory was recorded
+            if "directory" not in [column[1] for column in self._connection.execute ("PRAGMA table_info (imported_files)")]:
+                self._connection.execute ("ALTER TABLE imported_files ADD COLUMN directory TEXT")
+
+    def __enter__ ( self ):
+        return self
+
+    def __exit__ ( self, *exc_info ):
+        self.close ()
+
+    def close ( self ):
+        self._connection.close ()
+
+    def __len__ ( self ):
+        return self._connection.execute ("SELECT COUNT(*) FROM results").fetchone ()[0]
+
+    def add ( self, params, perf, source="" ):
+        '''
+            appends the result (params, perf) of a configuration. source is the name of the .gsv file that also contains the result, if any
+        '''
+        self.add_many ([(params, perf)], source)
+
+    def add_many ( self, results, source="" ):
+        '''
+            appends a list of results (params, perf) in a single transaction
+        '''
+        # a nan validation loss is stored as +inf (sqlite would store it as NULL, that sorts before any number)
+        rows = [(source, json.dumps (params, sort_keys=True), json.dumps (list(perf)), math.inf if math.isnan (perf[0]) else perf[0]) for params, perf in results]
+        with self._connection:
+            self._connection.executemany ("INSERT INTO results (source, params, perf, val_loss) VALUES (?, ?, ?, ?)", rows)
+
+    def mark_imported ( self, filename ):
+        '''
+            records that the results of the .gsv file filename are already in the store (in its current version)
+        '''
+        stat = os.stat (filename)
+        with self._connection:
+            self._connection.execute ("INSERT OR REPLACE INTO imported_files (source, mtime, size, directory) VALUES (?, ?, ?, ?)",
+                                      (os.path.basename (filename), stat.st_mtime, stat.st_size, os.path.dirname (os.path.abspath (filename))))
+
+    def import_gsv ( self, filename ):
+        '''
+            imports the results of a legacy .gsv file, unless it has already been imported and has not changed since then
+            (a changed file replaces the results previously imported from it).
+            returns the number of imported results
+        '''
+        source = os.path.basename (filename)
+        stat = os.stat (filename)
+        imported = self._connection.execute ("SELECT mtime, size FROM imported_files WHERE source = ?", (source,)).fetchone ()
+        if imported == (stat.st_mtime, stat.st_size):
+            return 0
+
+        results = readGridSearchFile (filename)
+        with self._connection:
+            self._connection.execute ("DELETE FROM results WHERE source = ?", (source,))
+        self.add_many (results, source)
+        self.mark_imported (filename)
+        return len(results)
+
+    def import_directory ( self, directory, fileprefix="" ):
+        '''
+            imports all the .gsv files in directory whose name starts with fileprefix (see import_gsv)
+            and removes the results of the ones previously imported from directory that have been deleted from it
+            (the results of the files of other directories, or added without a file, are kept).
+            returns the number of imported results
+        '''
+        files = [f for f in sorted (os.listdir (directory)) if f.startswith (fileprefix) and f.endswith (".gsv")]
+
+        sources = self._connection.execute ("SELECT source FROM imported_files WHERE directory = ?", (os.path.abspath (directory),)).fetchall ()
+        deleted = [source for source, in sources if source.startswith (fileprefix) and source not in files]
+        with self._connection:
+            self._connection.executemany ("DELETE FROM results WHERE source = ?", [(source,) for source in deleted])
+            self._connection.executemany ("DELETE FROM imported_files WHERE source = ?", [(source,) for source in deleted])
+
+        return sum (self.import_gsv (os.path.join (directory, f)) for f in files)
+
+    def top_k ( self, k=1, fileprefix=None, **filters ):
+        '''
+            returns the k results (params, perf) with the lowest validation loss, sorted by validation loss.
+
+            :param: fileprefix if given, only the results imported from (or written together with) the .gsv files whose name starts with it are considered
+            :param: filters hyper-parameters values: only the results whose params have those values are considered,
+                    e.g. top_k (10, activation="tanh", hidden_layer_sizes=[50, 50], early_stopping=False)
+        '''
+        conditions = []
+        arguments = []
+        if fileprefix:
+            conditions.append ("substr (source, 1, ?) = ?")
+            arguments += [len(fileprefix), fileprefix]
+        for key, value in filters.items ():
+            if not re.fullmatch (r"\w+", key):
+                raise ValueError ("invalid hyper-parameter name {}".format(key))
+            if value is None:
+                # json_extract returns NULL (never equal to anything) both for null values and for missing keys
+                conditions.append ("json_type (params, '$.{}') = 'null'".format(key))
+                continue
+            conditions.append ("json_extract (params, '$.{}') = ?".format(key))
+            # lists are compared as their compact json text, booleans as the integers 0 and 1
+            if isinstance (value, (list, tuple)):
+                value = json.dumps (list(value), separators=(",", ":"))
+            arguments.append (value)
+
+        query = "SELECT params, perf FROM results"
+        if conditions:
+            query += " WHERE " + " AND ".join (conditions)
+        query += " ORDER BY val_loss, id LIMIT ?"
+        arguments.append (k)
+        return [(json.loads (params), json.loads (perf)) for params, perf in self._connection.execute (query, arguments)]
@@ -1,12 +1,14 @@
 '''
     usage:
-        python run_ensembler.py NUM_CONF
+        python run_ensembler.py NUM_CONF [MODEL_FILE]
     run an ensemble of the best NUM_CONF models on the whole ML-CUP dataset, training the models on the development set (90%) and testing it on the internal test set (10%).
 
     NUM_CONF defaults to 10.
+    if MODEL_FILE is given the trained ensemble is saved into it, or loaded from it (without training) if it already exists.
 '''
 
 import sys
+import os
 import numpy as np
 from neural_network import *
 from utility import ReadData
@@ -56,11 +58,18 @@ def main():
     print ("Xtest.shape", Xtest.shape)
     print ("ytest.shape", ytest.shape)
 
-    ens = Ensembler (models, verbose=True)
+    model_fname = sys.argv[2] if len(sys.argv) > 2 else None
+
+    if model_fname is not None and os.path.exists (model_fname):
+        ens = Ensembler.load (model_fname, verbose=True)
+    else:
+        ens = Ensembler (models, verbose=True)
     
-    # BLOCK 1: report,plot for each model and ensemble vs constituent report
-    # ens.enable_reporting (Xtest, ytest, "internal_test_set", accuracy="euclidean")
-    ens.fit (Xtrain, ytrain)
+        # BLOCK 1: report,plot for each model and ensemble vs constituent report
+        # ens.enable_reporting (Xtest, ytest, "internal_test_set", accuracy="euclidean")
+        ens.fit (Xtrain, ytrain)
+        if model_fname is not None:
+            ens.save (model_fname)
     # ens.write_constituent_vs_ensemble_report (Xtest, ytest, dataset_name="internal_test_set")
     
     # BLOCK 2: final model plot
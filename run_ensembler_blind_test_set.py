@@ -1,12 +1,15 @@
 '''
     usage:
-        python run_ensembler_blind_test_set.py NUM_CONF
+        python run_ensembler_blind_test_set.py NUM_CONF N_JOBS [MODEL_FILE]
     run an ensemble of the best NUM_CONF models on the blind test set, writing the prediction on a csv file.
 
     NUM_CONF defaults to 10.
+    N_JOBS is the number of processes that train the models in parallel (-1 for all the cpus), it defaults to 1.
+    if MODEL_FILE is given the trained ensemble is saved into it, or loaded from it (without training) if it already exists.
 '''
 
 import sys
+import os
 import numpy as np
 from neural_network import *
 from utility import ReadData, ReadBlindData
@@ -53,6 +56,10 @@ def main():
         if (index == (num_conf-1)):
             break
 
+    n_jobs = None
+    if len(sys.argv) > 2:
+        n_jobs = int (sys.argv[2])
+
     
     print ("Xtrain.shape", Xtrain.shape)
     print ("ytrain.shape", ytrain.shape)
@@ -61,10 +68,17 @@ def main():
 
     # ens = DummyModel () 
 
-    ens = Ensembler (models, verbose=True)
-    ens.enable_reporting (Xtrain, ytrain, "whole_dataset", accuracy="euclidean")
+    model_fname = sys.argv[3] if len(sys.argv) > 3 else None
+
+    if model_fname is not None and os.path.exists (model_fname):
+        ens = Ensembler.load (model_fname, verbose=True, n_jobs=n_jobs)
+    else:
+        ens = Ensembler (models, verbose=True, n_jobs=n_jobs)
+        ens.enable_reporting (Xtrain, ytrain, "whole_dataset", accuracy="euclidean")
 
-    ens.fit (Xtrain, ytrain)
+        ens.fit (Xtrain, ytrain)
+        if model_fname is not None:
+            ens.save (model_fname)
     predicted = ens.predict (Xtest)
     
     with open (_OUT_FNAME, "w") as fout:
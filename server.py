@@ -0,0 +1,306 @@
+'''
+    usage:
+        python server.py MODEL_FILE [PORT [MAX_LATENCY_MS [MAX_BATCH_SIZE]]]
+    serves the predictions of the network (or ensemble of networks) saved into MODEL_FILE (see neural_network.save_models) over HTTP on localhost.
+
+    PORT defaults to 8000.
+    concurrent requests are answered by a single forward pass of the model on batches of at most MAX_BATCH_SIZE samples (default 64):
+    a batch waits at most MAX_LATENCY_MS milliseconds (default 2) for other samples after its first one.
+
+    API:
+        POST /predict   {"x": [features...]} -> {"y": [outputs...]}, or {"X": [[features...], ...]} -> {"Y": [[outputs...], ...]}
+        GET  /stats     latency percentiles (ms), throughput and batching counters
+'''
+
+import sys
+import json
+import time
+import queue
+import threading
+import collections
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import numpy as np
+
+from neural_network import load_models
+from ensembler import Ensembler
+
+class _Request:
+    '''
+        private class.
+        a batch of samples waiting for its predictions
+    '''
+
+    def __init__ ( self, X ):
+        self.X = X
+        self.result = None
+        self.error = None
+        self.arrival = time.perf_counter ()
+        self.done = threading.Event ()
+
+class MicroBatcher:
+    '''
+        coalesces the samples of concurrent predict() calls into batches: a worker thread runs a single model.predict() for each batch
+        and hands every caller its rows of the result.
+
+        A batch starts with the first waiting request and collects the following ones until it has max_batch_size samples
+        or max_latency seconds have passed since the arrival of the first one.
+        The latency of each request (from its arrival to its result) is recorded for the statistics.
+    '''
+
+    def __init__ ( self, model, max_batch_size=64, max_latency=0.002, n_latencies=10000 ):
+        '''
+            :param: model a trained model (a network or an Ensembler)
+            :param: max_batch_size maximum number of samples of a batch (a larger request is a batch by itself)
+            :param: max_latency maximum time in seconds a batch waits for other requests after its first one
+            :param: n_latencies number of latencies of the last requests used for the percentiles
+        '''
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.n_features = _n_features (model)
+        # only the worker thread predicts: it can use the preallocated buffers of a compiled predictor
+        self._predict = model.compile_predictor (max_batch_size).predict if hasattr (model, "compile_predictor") else model.predict
+        self._requests = queue.Queue ()
+        self._latencies = collections.deque (maxlen=n_latencies)
+        self._lock = threading.Lock ()
+        self._n_requests = 0
+        self._n_samples = 0
+        self._n_batches = 0
+        self._start_time = time.perf_counter ()
+        # the numpy floating point error handling is per-thread: the worker uses the one of the creator
+        self._errstate = np.geterr ()
+        self._worker = threading.Thread (target=self._run, daemon=True)
+        self._worker.start ()
+
+    def predict ( self, X ):
+        '''
+            returns the predictions of the model for the samples X (n_samples, n_features), computed together with the ones of the concurrent calls
+        '''
+        X = np.asarray (X, dtype=float)
+        if X.ndim != 2 or X.shape[1] != self.n_features:
+            raise ValueError ("expected samples with {} features, got shape {}".format(self.n_features, X.shape))
+        request = _Request (X)
+        self._requests.put (request)
+        request.done.wait ()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def close ( self ):
+        '''
+            stops the worker thread after the requests already waiting
+        '''
+        self._requests.put (None)
+        self._worker.join ()
+
+    def _next_batch ( self ):
+        '''
+            private method.
+            waits for the first request of a batch and collects the following ones (see the class documentation).
+            returns the list of requests, None if the batcher has been closed
+        '''
+        first = self._requests.get ()
+        if first is None:
+            return None
+        batch = [first]
+        n_samples = len(first.X)
+        deadline = first.arrival + self.max_latency
+        while n_samples < self.max_batch_size:
+            timeout = deadline - time.perf_counter ()
+            try:
+                request = self._requests.get (timeout=timeout) if timeout > 0 else self._requests.get_nowait ()
+            except queue.Empty:
+                break
+            if request is None:
+                # close() after this batch
+                self._requests.put (None)
+                break
+            batch.append (request)
+            n_samples += len(request.X)
+        return batch
+
+    def _run ( self ):
+        '''
+            private method.
+            body of the worker thread: a forward pass of the model for each batch
+        '''
+        with np.errstate (**self._errstate):
+            while True:
+                batch = self._next_batch ()
+                if batch is None:
+                    return
+                try:
+                    Y = self._predict (np.concatenate ([request.X for request in batch]))
+                    start = 0
+                    for request in batch:
+                        request.result = Y[start:start+len(request.X)]
+                        start += len(request.X)
+                except Exception as error:
+                    for request in batch:
+                        request.error = error
+
+                now = time.perf_counter ()
+                with self._lock:
+                    self._n_batches += 1
+                    for request in batch:
+                        self._latencies.append (now - request.arrival)
+                        self._n_requests += 1
+                        self._n_samples += len(request.X)
+                for request in batch:
+                    request.done.set ()
+
+    def stats ( self ):
+        '''
+            returns a dictionary with the counters of the served requests, samples and batches, the throughput (requests and samples per second since the creation)
+            and the 50th and 99th percentiles of the latency of the last requests in milliseconds
+        '''
+        with self._lock:
+            latencies = np.array (self._latencies)
+            n_requests, n_samples, n_batches = self._n_requests, self._n_samples, self._n_batches
+        elapsed = time.perf_counter () - self._start_time
+        return {
+            "requests": n_requests,
+            "samples": n_samples,
+            "batches": n_batches,
+            "avg_batch_size": n_samples / n_batches if n_batches else 0,
+            "requests_per_second": n_requests / elapsed,
+            "samples_per_second": n_samples / elapsed,
+            "latency_p50_ms": float (np.percentile (latencies, 50)) * 1000 if len(latencies) else None,
+            "latency_p99_ms": float (np.percentile (latencies, 99)) * 1000 if len(latencies) else None,
+        }
+
+def _n_features ( model ):
+    '''
+        private helper.
+        returns the number of input features of a trained network or Ensembler of networks
+    '''
+    if isinstance (model, Ensembler):
+        model = model.models[0]
+    return model._weights[0].shape[0] - 1
+
+class _PredictionHandler (BaseHTTPRequestHandler):
+    '''
+        private class.
+        handles the HTTP requests of a PredictionServer (self.server)
+    '''
+
+    # persistent connections: a client can send many requests without connecting again
+    protocol_version = "HTTP/1.1"
+
+    def _send_json ( self, code, obj ):
+        '''
+            private method.
+            sends the response with status code and the json encoding of obj
+        '''
+        body = json.dumps (obj).encode ("utf-8")
+        self.send_response (code)
+        self.send_header ("Content-Type", "application/json")
+        self.send_header ("Content-Length", str(len(body)))
+        self.end_headers ()
+        self.wfile.write (body)
+
+    def do_POST ( self ):
+        if self.path != "/predict":
+            self._send_json (404, {"error": "unknown path {}".format(self.path)})
+            return
+        try:
+            request = json.loads (self.rfile.read (int (self.headers.get ("Content-Length", 0))))
+            if "x" in request:
+                self._send_json (200, {"y": self.server.batcher.predict ([request["x"]])[0].tolist ()})
+            else:
+                self._send_json (200, {"Y": self.server.batcher.predict (request["X"]).tolist ()})
+        except (ValueError, KeyError, TypeError) as error:
+            self._send_json (400, {"error": str(error)})
+        except Exception as error:
+            # e.g. a FloatingPointError of the network on huge inputs: the client gets an error instead of a dropped connection
+            self._send_json (500, {"error": "{}: {}".format(type(error).__name__, error)})
+
+    def do_GET ( self ):
+        if self.path != "/stats":
+            self._send_json (404, {"error": "unknown path {}".format(self.path)})
+            return
+        self._send_json (200, self.server.batcher.stats ())
+
+    def log_message ( self, format, *args ):
+        # no log line for each request
+        pass
+
+class PredictionServer (ThreadingHTTPServer):
+    '''
+        HTTP server of the predictions of a trained model (see the API at the beginning of this file),
+        every connection is handled by its own thread and the concurrent samples are predicted in batches by a MicroBatcher.
+
+        example usage:
+
+        .. code-block:: python
+
+            server = PredictionServer (Ensembler.load ("ensemble.ann"), port=8000, max_latency=0.001)
+            server.start ()
+            ...
+            server.stop ()
+    '''
+
+    daemon_threads = True
+    # many clients connect at the same time: the default backlog (5) would refuse some of them
+    request_queue_size = 128
+
+    def __init__ ( self, model, host="127.0.0.1", port=8000, max_batch_size=64, max_latency=0.002 ):
+        '''
+            :param: model a trained model (a network or an Ensembler)
+            :param: port TCP port, 0 for any free port (see self.server_address)
+            :param: max_batch_size, max_latency see MicroBatcher
+        '''
+        super().__init__ ((host, port), _PredictionHandler)
+        self.batcher = MicroBatcher (model, max_batch_size, max_latency)
+        self._thread = None
+
+    def start ( self ):
+        '''
+            serves the requests on a background thread
+        '''
+        self._thread = threading.Thread (target=self.serve_forever, daemon=True)
+        self._thread.start ()
+
+    def stop ( self ):
+        '''
+            stops serving the requests and closes the server
+        '''
+        if self._thread is not None:
+            self.shutdown ()
+            self._thread.join ()
+        self.server_close ()
+        self.batcher.close ()
+
+def load_model ( fname ):
+    '''
+        returns the model saved into the file fname: the network, or an Ensembler (with fused predictions) if the file contains many networks
+    '''
+    models, names = load_models (fname)
+    if len(models) == 1:
+        return models[0]
+    return Ensembler (models, names, predict_backend="fused")
+
+def main ():
+    if len(sys.argv) < 2:
+        print (__doc__)
+        exit ()
+
+    model = load_model (sys.argv[1])
+    port = int (sys.argv[2]) if len(sys.argv) > 2 else 8000
+    max_latency = float (sys.argv[3]) / 1000 if len(sys.argv) > 3 else 0.002
+    max_batch_size = int (sys.argv[4]) if len(sys.argv) > 4 else 64
+
+    server = PredictionServer (model, port=port, max_batch_size=max_batch_size, max_latency=max_latency)
+    print ("serving {} on http://{}:{}".format(sys.argv[1], *server.server_address))
+    try:
+        server.serve_forever ()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print (json.dumps (server.batcher.stats ()))
+        server.server_close ()
+        server.batcher.close ()
+
+if __name__ == "__main__":
+    main()
@@ -18,6 +18,11 @@ def main ():
     if len(sys.argv) > 3:
         folder = sys.argv[3]
 
+    # number of folds trained in parallel
+    n_jobs = None
+    if len(sys.argv) > 4:
+        n_jobs = int (sys.argv[4])
+
     fileprefix = ""
 
     results = getBestRes (fileprefix, folder, n_best)
@@ -35,7 +40,7 @@ def main ():
                 predicted = nn.predict (Xtrain)
                 loss = _euclidean_loss (ytrain, predicted)
                 '''
-                res=cross_val(nn,Xtrain, ytrain,_euclidean_loss,5)
+                res=cross_val(nn,Xtrain, ytrain,_euclidean_loss,5,n_jobs=n_jobs)
                 perf.insert(1, res[1])
         
             json.dump(params, outt)
@@ -6,15 +6,41 @@
 '''
 
 import unittest
+import copy
+import tempfile
+import contextlib
 
 import numpy as np
 import os
 
 from neural_network import *
+from neural_network import _Workspace
 from utility import *
+from utility import _cached_arrays
 from functions import *
+from model_stack import ModelStack
+from ensembler import Ensembler
+from server import PredictionServer
 
 import time
+import json
+import threading
+import urllib.request
+import urllib.error
+
+@contextlib.contextmanager
+def _temporary_working_directory ():
+    '''
+    runs the block in a new temporary working directory: the reports of the searches are not written into grid_reports/ of the repository
+    (and each test finds only its own ones)
+    '''
+    cwd = os.getcwd ()
+    with tempfile.TemporaryDirectory () as directory:
+        os.chdir (directory)
+        try:
+            yield directory
+        finally:
+            os.chdir (cwd)
 
 class DummyModel:
 
@@ -109,7 +135,398 @@ class TestNeuralNetwork (unittest.TestCase):
                        [ .53075072,  .61904912  ]])
         ]
         self.assertTrue (np.allclose (n._weights, expected_weights), "Wrong weights after one step of backpropagation")
-    
+
+    def test_backpropagation_gradients ( self ):
+        # the gradients computed on a minibatch must match the finite differences of the average loss
+        n = BaseNeuralNetwork ( hidden_layer_sizes=(4,3), hidden_activation="tanh", output_activation="logistic", random_state=42 )
+        generator = np.random.default_rng (42)
+        n.set_weights ([ generator.standard_normal (shape) for shape in [(3,4), (5,3), (4,2)] ])
+        X = generator.standard_normal ((7, 2))
+        y = generator.random ((7, 2))
+
+        def average_loss ():
+            return loss_functions["squared"] (y, n.predict (X), reduction="sum") / len(X)
+
+        layers_nets, layers_outputs = n._forward_pass (X)
+        delta_weights = n._backpropagation (layers_nets, layers_outputs, y)
+        eps = 1e-6
+        for W, dW in zip (n._weights, delta_weights):
+            numerical_dW = np.zeros_like (W)
+            for index in np.ndindex (W.shape):
+                original = W[index]
+                W[index] = original + eps
+                loss_plus = average_loss ()
+                W[index] = original - eps
+                loss_minus = average_loss ()
+                W[index] = original
+                numerical_dW[index] = (loss_plus - loss_minus) / (2 * eps)
+            self.assertTrue (np.allclose (dW, numerical_dW, atol=1e-7), "backpropagation gradients differ from finite differences")
+
+    def test_workspace_ragged_minibatch ( self ):
+        # a minibatch smaller than the workspace must give the same results of freshly allocated arrays
+        n = BaseNeuralNetwork ( hidden_layer_sizes=(4,3), hidden_activation="relu", random_state=42 )
+        generator = np.random.default_rng (42)
+        n.set_weights ([ generator.standard_normal (shape) for shape in [(3,4), (5,3), (4,2)] ])
+        X = generator.standard_normal ((3, 2))
+        y = generator.standard_normal ((3, 2))
+
+        layers_nets, layers_outputs = n._forward_pass (X)
+        expected_predictions = layers_outputs[-1].copy ()
+        expected_delta_weights = [dW.copy () for dW in n._backpropagation (layers_nets, layers_outputs, y)]
+
+        workspace = _Workspace (10, n._layer_sizes ())
+        layers_nets, layers_outputs = n._forward_pass (X, workspace)
+        delta_weights = n._backpropagation (layers_nets, layers_outputs, y, workspace)
+
+        self.assertTrue (np.allclose (layers_outputs[-1], expected_predictions), "wrong forward pass with workspace")
+        self.assertTrue (np.shares_memory (layers_outputs[-1], workspace.outputs[-1]), "forward pass does not use the workspace buffers")
+        for dW, expected_dW in zip (delta_weights, expected_delta_weights):
+            self.assertTrue (np.allclose (dW, expected_dW), "wrong backpropagation with workspace")
+
+    def test_flat_parameters ( self ):
+        # weights matrices, connection weights and biases are views on a single contiguous buffer, also after a deepcopy
+        weights = [ np.arange (12.).reshape (3,4), np.arange (10.).reshape (5,2) ]
+        n = MLPRegressor ( hidden_layer_sizes=(4,) )
+        n.set_weights (weights)
+        self.assertEqual (n._params.shape, (22,), "wrong size of the parameters buffer")
+
+        for model in [n, copy.deepcopy (n)]:
+            for W, expected_W, coefs, intercepts in zip (model._weights, weights, model._coefs, model._intercepts):
+                self.assertTrue (np.array_equal (W, expected_W), "wrong weights")
+                self.assertTrue (np.array_equal (coefs, expected_W[:-1]), "wrong connection weights")
+                self.assertTrue (np.array_equal (intercepts, expected_W[-1]), "wrong biases")
+                for view in [W, coefs, intercepts]:
+                    self.assertTrue (np.shares_memory (view, model._params), "weights are not views on the parameters buffer")
+
+        X = np.random.randn (10, 2)
+        n.fit (X, np.random.randn (10, 2))
+        self.assertTrue (np.shares_memory (n._weights[0], n._params), "weights are not views on the parameters buffer after fit")
+
+    def test_float32_precision ( self ):
+        # training in float32 must follow the same loss curve of float64 training (up to a tolerance) on the cup and monks datasets
+        X_cup, y_cup, _, _ = ReadData("cup/ML-CUP19-TR.csv", 0.90)
+        X_monks, y_monks, _, _ = readMonk("monks/monks-1.train")
+        if len(X_cup) == 0 or len(X_monks) == 0:
+            self.skipTest("training data not accessible")
+
+        def loss_curve (model, X, y):
+            return np.array ([trained_model.loss_ for trained_model in model.fit_iterator (X, y)])
+
+        for dtype in ["float64", "float32"]:
+            regressor = MLPRegressor (hidden_layer_sizes=(20,20), activation="tanh", batch_size=10, learning_rate_init=0.005, random_state=1, max_iter=20, dtype=dtype)
+            classifier = MLPClassifier (hidden_layer_sizes=(10,), activation="relu", batch_size=1, learning_rate_init=0.1, momentum=0.5, random_state=1, max_iter=20, dtype=dtype)
+            cup_curve = loss_curve (regressor, X_cup, y_cup)
+            monks_curve = loss_curve (classifier, X_monks, y_monks)
+
+            self.assertEqual (regressor.get_params()["dtype"], dtype, "wrong parameter returned by get_params()")
+            self.assertEqual (regressor._params.dtype, dtype, "weights are not stored with the requested dtype")
+            self.assertEqual (regressor.predict (X_cup).dtype, dtype, "predictions are not computed with the requested dtype")
+            if dtype == "float64":
+                cup_curve_float64, monks_curve_float64 = cup_curve, monks_curve
+
+        self.assertTrue (np.allclose (cup_curve, cup_curve_float64, rtol=1e-3), "float32 loss curve on the cup dataset is too different from float64 one")
+        self.assertTrue (np.allclose (monks_curve, monks_curve_float64, rtol=1e-3), "float32 loss curve on the monks dataset is too different from float64 one")
+
+    def test_fit_stream ( self ):
+        X = np.random.randn (300, 4)
+        y = np.stack ((X[:,0] * X[:,1], np.sin (X[:,2])), axis=-1)
+
+        # without shuffling the streamed minibatches are the same of fit, whatever the chunks and the buffer size
+        n = MLPRegressor (hidden_layer_sizes=(10,), batch_size=16, shuffle=False, random_state=1, max_iter=10)
+        n.fit (X, y)
+        for chunk_size, buffer_size in [(50, 120), (7, 10), (300, 1000)]:
+            streamed = MLPRegressor (hidden_layer_sizes=(10,), batch_size=16, shuffle=False, random_state=1, max_iter=10)
+            streamed.fit_stream ((X, y), chunk_size=chunk_size, buffer_size=buffer_size)
+            self.assertTrue (np.array_equal (streamed._params, n._params), "streaming training different from fit")
+            self.assertAlmostEqual (streamed.loss_, n.loss_)
+
+        with tempfile.TemporaryDirectory () as directory:
+            np.save (directory + "/X.npy", X)
+            np.save (directory + "/y.npy", y)
+            X_mmap = np.load (directory + "/X.npy", mmap_mode="r")
+            y_mmap = np.load (directory + "/y.npy", mmap_mode="r")
+            n = MLPRegressor (hidden_layer_sizes=(10,), batch_size=16, random_state=1, max_iter=30, learning_rate_init=0.01)
+            n.fit_stream ((X_mmap, y_mmap), chunk_size=50, buffer_size=100)
+            self.assertLess (n.loss_, np.mean (np.sum (y**2, axis=1)) / 2, "the streamed training did not learn")
+            del X_mmap, y_mmap
+
+        def chunks ():
+            for start in range (0, len(X), 64):
+                yield X[start:start+64], y[start:start+64]
+        n = MLPRegressor (hidden_layer_sizes=(10,), batch_size=16, random_state=1, max_iter=30, early_stopping=True)
+        self.assertRaises (ValueError, n.fit_stream, chunks)
+        n.fit_stream (chunks, validation_data=(X[:50], y[:50]))
+        self.assertEqual (n.predict (X).shape, y.shape)
+
+        # empty datasets (arrays, generators without chunks or with empty chunks, validation sets) are errors, not StopIteration
+        n = MLPRegressor (hidden_layer_sizes=(10,), batch_size=16, random_state=1, max_iter=3)
+        self.assertRaises (ValueError, n.fit_stream, (X[:0], y[:0]))
+        self.assertRaises (ValueError, n.fit_stream, lambda: iter (()))
+        self.assertRaises (ValueError, n.fit_stream, lambda: iter ([(X[:0], y[:0])]))
+        n = MLPRegressor (hidden_layer_sizes=(10,), batch_size=16, random_state=1, max_iter=3, early_stopping=True)
+        self.assertRaises (ValueError, n.fit_stream, (X, y), validation_data=(X[:0], y[:0]))
+
+    def test_partial_fit ( self ):
+        X = np.random.randn (200, 4)
+        y = np.stack ((X[:,0] * X[:,1], np.sin (X[:,2])), axis=-1)
+
+        # without shuffling, k calls on the whole dataset are the same of k epochs of fit (learning rate schedule included)
+        n = MLPRegressor (hidden_layer_sizes=(10,), batch_size=16, shuffle=False, random_state=1, max_iter=5, n_iter_no_change=100, learning_rate="invscaling")
+        n.fit (X, y)
+        incremental = MLPRegressor (hidden_layer_sizes=(10,), batch_size=16, shuffle=False, random_state=1, learning_rate="invscaling")
+        for _ in range (5):
+            incremental.partial_fit (X, y)
+        self.assertTrue (np.array_equal (incremental._params, n._params), "partial_fit different from fit")
+        self.assertEqual (incremental.n_iter_, 5)
+
+        # partial_fit after fit continues the learning rate schedule from the last epoch of fit (also with fit_iterator)
+        for learning_rate in ["invscaling", "linear"]:
+            longer = MLPRegressor (hidden_layer_sizes=(10,), batch_size=16, shuffle=False, random_state=1, max_iter=6, n_iter_no_change=100, learning_rate=learning_rate)
+            longer.fit (X, y)
+            continued = MLPRegressor (hidden_layer_sizes=(10,), batch_size=16, shuffle=False, random_state=1, max_iter=5, n_iter_no_change=100, learning_rate=learning_rate)
+            continued.fit (X, y)
+            continued.partial_fit (X, y)
+            self.assertTrue (np.array_equal (continued._params, longer._params), "partial_fit after fit different from one more epoch of fit")
+            continued = MLPRegressor (hidden_layer_sizes=(10,), batch_size=16, shuffle=False, random_state=1, max_iter=5, n_iter_no_change=100, learning_rate=learning_rate)
+            for _ in continued.fit_iterator (X, y):
+                pass
+            continued.partial_fit (X, y)
+            self.assertTrue (np.array_equal (continued._params, longer._params), "partial_fit after fit_iterator different from one more epoch of fit")
+
+        # the weights and the momentum of a trained model are kept
+        weights = n._params.copy ()
+        momentum = n.delta_olds.copy ()
+        n.partial_fit (X[:10], y[:10])
+        self.assertFalse (np.array_equal (n._params, weights), "partial_fit did not update the weights")
+        self.assertLess (np.max (np.abs (n._params - weights)), 0.1, "partial_fit must not initialize the weights again")
+        self.assertFalse (np.array_equal (n.delta_olds, momentum))
+
+        c = MLPClassifier (hidden_layer_sizes=(5,), random_state=1)
+        for start in range (0, 200, 20):
+            c.partial_fit (X[start:start+20], X[start:start+20, 0] > 0)
+        self.assertEqual (c.predict (X).shape, (200, 1))
+        self.assertRaises (AssertionError, c.partial_fit, X[:10], np.full (10, 2))
+
+    def test_accumulated_loss ( self ):
+        X = np.random.randn (200, 4)
+        y = np.stack ((X[:,0] * X[:,1], np.sin (X[:,2])), axis=-1)
+
+        losses = {}
+        for loss_evaluation, interval in [("full", None), ("accumulated", None), ("accumulated", 1), ("accumulated", 3)]:
+            n = MLPRegressor (hidden_layer_sizes=(10,), batch_size=16, random_state=1, max_iter=8, n_iter_no_change=100, loss_evaluation=loss_evaluation, full_evaluation_interval=interval)
+            losses[loss_evaluation, interval] = np.array ([trained.loss_ for trained in n.fit_iterator (X, y)])
+            if loss_evaluation == "full":
+                weights = n._params.copy ()
+            # the evaluation of the loss does not change the training
+            self.assertTrue (np.array_equal (n._params, weights), "the accumulated loss changed the training")
+
+        self.assertTrue (np.array_equal (losses["accumulated", 1], losses["full", None]), "full evaluation at every epoch must give the full loss")
+        self.assertTrue (np.array_equal (losses["accumulated", 3][2::3], losses["full", None][2::3]), "every third epoch must be evaluated on the whole training set")
+        self.assertFalse (np.array_equal (losses["accumulated", None][1:], losses["full", None][1:]))
+
+        # the accumulated loss of an epoch is the loss of each minibatch before its update: with a single minibatch it is the loss before the epoch
+        n = MLPRegressor (hidden_layer_sizes=(10,), batch_size=200, shuffle=False, random_state=1, max_iter=1, loss_evaluation="accumulated")
+        n.fit (X, y)
+        expected = MLPRegressor (hidden_layer_sizes=(10,), random_state=1)
+        expected._initialize_fit (X, y)
+        self.assertAlmostEqual (n.loss_, loss_functions["squared"] (y, expected.predict (X), reduction="sum") / len(X))
+
+        self.assertRaises (ValueError, MLPRegressor, loss_evaluation="sometimes")
+
+    def test_checkpoint_interval ( self ):
+        X = np.random.randn (300, 4)
+        y = np.stack ((X[:,0] * X[:,1], np.sin (X[:,2])), axis=-1)
+
+        for interval in [1, 4]:
+            n = MLPRegressor (hidden_layer_sizes=(10,), batch_size=16, random_state=1, max_iter=30, early_stopping=True, learning_rate_init=0.05, checkpoint_interval=interval)
+            validation_losses = [trained.loss_ for trained in n.fit_iterator (X, y)]
+            _, X_validation, _, y_validation = train_test_split (X, y, test_size=n.validation_fraction, shuffle=True, random_state=1)
+            restored_loss = loss_functions["squared"] (y_validation, n.predict (X_validation), reduction="sum") / len(X_validation)
+            # the restored weights are the ones of the best checkpoint epoch (the last epoch is always a checkpoint), loss_ is their loss
+            self.assertAlmostEqual (restored_loss, min (validation_losses[interval-1::interval] + validation_losses[-1:]), msg="wrong weights restored with checkpoint_interval={}".format(interval))
+            self.assertAlmostEqual (n.loss_, restored_loss, msg="loss_ is not the loss of the restored weights with checkpoint_interval={}".format(interval))
+
+        # training stopped before the first checkpoint: the weights of the last epoch are restored, not the initial ones
+        n = MLPRegressor (hidden_layer_sizes=(10,), batch_size=16, random_state=1, max_iter=4, early_stopping=True, learning_rate_init=0.05, checkpoint_interval=5)
+        validation_losses = []
+        for trained in n.fit_iterator (X, y):
+            validation_losses.append (trained.loss_)
+            last_weights = trained._params.copy ()
+        self.assertTrue (np.array_equal (n._params, last_weights), "the weights of the last epoch must be restored")
+        self.assertEqual (n.loss_, validation_losses[-1])
+        n.fit (X, y)
+        self.assertTrue (np.array_equal (n._params, last_weights), "the weights of the last epoch must be restored by fit")
+
+        self.assertRaises (ValueError, MLPRegressor (checkpoint_interval=0).fit, X, y)
+
+    def test_save_load ( self ):
+        X = np.random.randn (50, 4)
+        y = np.stack ((X[:,0] * X[:,1], np.sin (X[:,2])), axis=-1)
+
+        with tempfile.TemporaryDirectory () as directory:
+            for dtype in ["float64", "float32"]:
+                n = MLPRegressor (hidden_layer_sizes=(10, 5), activation="tanh", random_state=1, max_iter=5, dtype=dtype)
+                n.fit (X, y)
+                n.save (directory + "/regressor.ann")
+                for mmap in [True, False]:
+                    loaded = MLPRegressor.load (directory + "/regressor.ann", mmap=mmap)
+                    self.assertTrue (np.array_equal (loaded.predict (X), n.predict (X)), "wrong predictions of the loaded network")
+                    self.assertEqual (loaded._params.dtype, np.dtype (dtype))
+                    self.assertEqual ((loaded.loss_, loaded.n_iter_, loaded.activation), (n.loss_, n.n_iter_, "tanh"))
+                    self.assertEqual (loaded._params.ctypes.data % 64, 0, "the weights are not aligned")
+
+            # the memory-mapped weights are copy-on-write: training the loaded network does not change the file
+            loaded.partial_fit (X, y)
+            self.assertTrue (np.array_equal (MLPRegressor.load (directory + "/regressor.ann")._params, n._params))
+
+            c = MLPClassifier (hidden_layer_sizes=(5,), random_state=1, max_iter=5)
+            c.fit (X, X[:,0] > 0)
+            c.save (directory + "/classifier.ann")
+            loaded = MLPClassifier.load (directory + "/classifier.ann")
+            self.assertTrue (np.array_equal (loaded.predict_proba (X), c.predict_proba (X)))
+            self.assertRaises (ValueError, MLPRegressor.load, directory + "/classifier.ann")
+
+            ens = Ensembler ([MLPRegressor (hidden_layer_sizes=(5,), random_state=i, max_iter=5) for i in range (3)], models_names=["a", "b", "c"])
+            ens.fit (X, y)
+            ens.save (directory + "/ensemble.ann")
+            loaded = Ensembler.load (directory + "/ensemble.ann")
+            self.assertEqual (loaded.names, ["a", "b", "c"])
+            self.assertTrue (np.array_equal (loaded.predict (X), ens.predict (X)), "wrong predictions of the loaded ensemble")
+
+            with open (directory + "/not_a_model.ann", "wb") as fout:
+                fout.write (b"not a model file")
+            self.assertRaises (ValueError, MLPRegressor.load, directory + "/not_a_model.ann")
+
+    def test_compile_predictor ( self ):
+        X = np.random.randn (50, 4)
+        y = np.stack ((X[:,0] * X[:,1], np.sin (X[:,2])), axis=-1)
+        n = MLPRegressor (hidden_layer_sizes=(10, 5), activation="tanh", random_state=1, max_iter=5)
+        n.fit (X, y)
+        # batches larger than max_batch are predicted in chunks
+        predictor = n.compile_predictor (max_batch=16)
+        self.assertTrue (np.allclose (predictor.predict (X), n.predict (X), rtol=0, atol=1e-12), "wrong predictions of the compiled predictor")
+        for i in range (5):
+            self.assertTrue (np.allclose (predictor.predict_one (X[i]), n.predict (X[i:i+1])[0], rtol=0, atol=1e-12), "wrong single-sample prediction")
+
+        # the predictor is frozen: further training of the network does not change it
+        expected = predictor.predict (X)
+        n.partial_fit (X, y)
+        self.assertTrue (np.array_equal (predictor.predict (X), expected))
+
+        c = MLPClassifier (hidden_layer_sizes=(5,), random_state=1, max_iter=5)
+        c.fit (X, X[:,0] > 0)
+        predictor = c.compile_predictor ()
+        self.assertTrue (np.array_equal (predictor.predict (X), c.predict (X)))
+        self.assertTrue (np.allclose (predictor.predict_proba (X), c.predict_proba (X), rtol=0, atol=1e-12))
+
+    def test_fused_ensemble ( self ):
+        X = np.random.randn (300, 4)
+        y = np.stack ((X[:,0] * X[:,1], np.sin (X[:,2])), axis=-1)
+        # two groups of networks with different activation functions and a network with another architecture
+        models = [MLPRegressor (hidden_layer_sizes=(10, 5), activation=["tanh", "logistic"][i % 2], random_state=i, max_iter=5) for i in range (6)]
+        models.append (MLPRegressor (hidden_layer_sizes=(8,), random_state=6, max_iter=5))
+        ens = Ensembler (models)
+        ens.fit (X, y)
+        fused = Ensembler (models, predict_backend="fused")
+        for n_samples in [1, 7, 300]:
+            self.assertTrue (np.allclose (fused.predict (X[:n_samples]), ens.predict (X[:n_samples]), rtol=0, atol=1e-12), "wrong predictions of the fused ensemble")
+        self.assertEqual (sorted (len(group.indexes) for group in fused._fused_groups), [1, 3, 3])
+
+        # fit() takes a new snapshot of the weights
+        fused.fit (X, y)
+        self.assertTrue (np.allclose (fused.predict (X), Ensembler (models).predict (X), rtol=0, atol=1e-12))
+
+        classifiers = [MLPClassifier (hidden_layer_sizes=(5,), random_state=i, max_iter=5) for i in range (3)]
+        ens = Ensembler (classifiers)
+        ens.fit (X, X[:,0] > 0)
+        self.assertTrue (np.array_equal (Ensembler (classifiers, predict_backend="fused").predict (X), ens.predict (X)))
+
+    def test_prediction_server ( self ):
+        X = np.random.randn (40, 4)
+        y = np.stack ((X[:,0] * X[:,1], np.sin (X[:,2])), axis=-1)
+        ens = Ensembler ([MLPRegressor (hidden_layer_sizes=(5,), random_state=i, max_iter=5) for i in range (3)])
+        ens.fit (X, y)
+
+        server = PredictionServer (ens, port=0, max_latency=0.005)
+        server.start ()
+        url = "http://{}:{}".format(*server.server_address)
+        def post ( obj ):
+            request = urllib.request.Request (url + "/predict", data=json.dumps (obj).encode (), headers={"Content-Type": "application/json"})
+            with urllib.request.urlopen (request) as response:
+                return json.loads (response.read ())
+        try:
+            # concurrent single-sample requests are predicted in batches, with the same results of predict
+            Y = [None] * len(X)
+            def client ( indices ):
+                for i in indices:
+                    Y[i] = post ({"x": X[i].tolist ()})["y"]
+            clients = [threading.Thread (target=client, args=(range (k, len(X), 8),)) for k in range (8)]
+            for c in clients:
+                c.start ()
+            for c in clients:
+                c.join ()
+            self.assertTrue (np.allclose (Y, ens.predict (X), rtol=0, atol=1e-12), "wrong predictions of the server")
+            self.assertTrue (np.allclose (post ({"X": X[:5].tolist ()})["Y"], ens.predict (X[:5]), rtol=0, atol=1e-12))
+
+            with self.assertRaises (urllib.error.HTTPError) as context:
+                post ({"x": [1, 2]})
+            self.assertEqual (context.exception.code, 400)
+            # errors of the network (here an overflow) are internal server errors
+            with self.assertRaises (urllib.error.HTTPError) as context:
+                post ({"x": [1e308] * 4})
+            self.assertEqual (context.exception.code, 500)
+            self.assertIn ("error", json.loads (context.exception.read ()))
+
+            with urllib.request.urlopen (url + "/stats") as response:
+                stats = json.loads (response.read ())
+            self.assertEqual ((stats["requests"], stats["samples"]), (len(X) + 2, len(X) + 6))
+            self.assertLessEqual (stats["batches"], stats["requests"])
+            self.assertIsNotNone (stats["latency_p99_ms"])
+        finally:
+            server.stop ()
+
+    def test_model_stack ( self ):
+        # networks trained in a stack must stop at the same epoch and get the same weights of networks trained one by one
+        X = np.random.randn (60, 3)
+        y = np.c_[np.sin (X[:,0]), X[:,1] * X[:,2]]
+        hyperparameters = [ (0.0001, 0.9, "constant", 30), (0.001, 0.5, "invscaling", 20), (0., 0., "linear", 40), (0.01, 0.7, "adaptive", 25) ]
+        models = [ MLPRegressor (hidden_layer_sizes=(8,6), activation="tanh", alpha=alpha, momentum=momentum, learning_rate=learning_rate, learning_rate_init=0.01,
+                                 max_iter=max_iter, n_iter_no_change=3, batch_size=16, random_state=i) for i, (alpha, momentum, learning_rate, max_iter) in enumerate(hyperparameters) ]
+        sequential_models = copy.deepcopy (models)
+        for model in sequential_models:
+            model.fit (X, y)
+
+        ModelStack (models).fit (X, y)
+        for model, sequential_model in zip (models, sequential_models):
+            self.assertEqual (model.n_iter_, sequential_model.n_iter_, "stacked model stopped at a different epoch")
+            self.assertAlmostEqual (model.loss_, sequential_model.loss_, msg="wrong loss for the stacked model")
+            self.assertTrue (np.allclose (model._params, sequential_model._params, rtol=1e-10, atol=1e-12), "wrong weights for the stacked model")
+
+        with self.assertRaises (ValueError):
+            ModelStack ( [MLPRegressor (hidden_layer_sizes=(8,)), MLPRegressor (hidden_layer_sizes=(6,))] )
+
+        ensemble = Ensembler ( [MLPClassifier (hidden_layer_sizes=(5,), max_iter=10, random_state=i) for i in range(3)], stacked=True )
+        ensemble.fit (X, X[:,0] > 0)
+        self.assertEqual (ensemble.predict (X).shape, (60, 1), "wrong shape of the stacked ensemble predictions")
+
+    def test_ensembler_parallel ( self ):
+        # constituent models trained on a process pool must get the same weights they get with a serial fit
+        X = np.random.randn (40, 3)
+        y = X[:,:2] ** 2
+        serial_ensemble = Ensembler ( [MLPRegressor (hidden_layer_sizes=(5,), alpha=0.001*i, max_iter=20, random_state=i) for i in range(4)] )
+        serial_ensemble.fit (X, y)
+        expected_predictions = serial_ensemble.predict (X)
+
+        for stacked, predict_backend in [(False, "thread"), (True, "process")]:
+            models = [MLPRegressor (hidden_layer_sizes=(5,), alpha=0.001*i, max_iter=20, random_state=i) for i in range(4)]
+            ensemble = Ensembler (models, stacked=stacked, n_jobs=2, predict_backend=predict_backend)
+            ensemble.fit (X, y)
+            for model, serial_model in zip (models, serial_ensemble.models):
+                self.assertEqual (model.n_iter_, serial_model.n_iter_, "wrong number of epochs of a model trained in parallel")
+                self.assertTrue (np.allclose (model._params, serial_model._params), "wrong weights of a model trained in parallel")
+                self.assertTrue (np.shares_memory (model._weights[0], model._params), "weights are not views on the parameters buffer")
+            self.assertTrue (np.allclose (ensemble.predict (X), expected_predictions), "wrong predictions of the parallel ensemble")
+
     def test_get_params (self):
         c = MLPClassifier (hidden_layer_sizes=(10,10), activation="tanh", alpha=1, batch_size=200, max_iter=300)
         r = MLPRegressor (hidden_layer_sizes=(20,20), activation="relu", random_state=1, momentum=2, early_stopping=True)
@@ -152,6 +569,13 @@ class TestNeuralNetwork (unittest.TestCase):
         self.assertEqual (regressor_params["momentum"], 2, "wrong parameter returned by get_params()")
         self.assertEqual (regressor_params["early_stopping"], False, "wrong parameter returned by get_params()")
 
+        # invalid values are refused as in the constructor and leave the previous hyper-parameters
+        self.assertRaises (ValueError, MLPRegressor, dtype="bogus")
+        self.assertRaises (ValueError, r.set_params, alpha=0.5, dtype="bogus")
+        self.assertRaises (ValueError, r.set_params, dtype=np.int32)
+        self.assertRaises (ValueError, r.set_params, loss_evaluation="sometimes")
+        self.assertEqual (r.get_params (), regressor_params, "set_params() with an invalid value changed the parameters")
+
     # TEST convergence on classification case (Xnor)
     @unittest.skip ("too instable")
     def test_classification(self):
@@ -274,7 +698,8 @@ class TestNeuralNetwork (unittest.TestCase):
         {'alpha': [0.0001, 0.001, 0.01], 'learning_rate': ['adaptive'], 'learning_rate_init': [0.02, 0.1, 0.2], 'momentum': [0.3, 0.8]},
         ]
 
-        GridSearchCV(n, params, data, labels, accuracy_functions["euclidean"], 2)
+        with _temporary_working_directory ():
+            GridSearchCV(n, params, data, labels, accuracy_functions["euclidean"], 2)
 
         self.assertEqual (len(n.fit_log), 72, "fit was not called 72 times")
         self.assertEqual (len(n.predict_log), 144, "predict was not called 144 times")
@@ -292,12 +717,230 @@ class TestNeuralNetwork (unittest.TestCase):
         {'alpha': [0.0001, 0.001, 0.01], 'learning_rate': ['adaptive'], 'learning_rate_init': [0.02, 0.1, 0.2], 'momentum': [0.3, 0.8]},
         ]
 
-        GridSearchCV(n, params, data, labels, accuracy_functions["euclidean"], 2)
+        with _temporary_working_directory ():
+            GridSearchCV(n, params, data, labels, accuracy_functions["euclidean"], 2)
 
         self.assertLessEqual (len(n.fit_log), 72, "fit was called more than 72 times")
         self.assertLessEqual (len(n.predict_log), 144, "predict was called more than 144 times")
 
-    
+    def test_cross_val_parallel ( self ):
+        # folds trained in parallel by threads or processes must give the same results of the serial cross validation
+        X = np.random.randn (50, 3)
+        y = X[:,0] - 2 * X[:,1]
+        n = MLPRegressor (hidden_layer_sizes=(5,), max_iter=20, random_state=1)
+        serial_result = cross_val (n, X, y, accuracy_functions["euclidean"], 5)
+        for backend in ["thread", "process"]:
+            parallel_result = cross_val (n, X, y, accuracy_functions["euclidean"], 5, n_jobs=3, backend=backend)
+            self.assertEqual (parallel_result[3], 5, "wrong number of folds with backend {}".format(backend))
+            self.assertTrue (np.allclose (parallel_result, serial_result), "wrong cross validation results with backend {}".format(backend))
+
+    def test_grid_search_parallel ( self ):
+        # the parallel grid search must give the results of the serial one, written in the grid order, and report the failing configurations
+        X = np.random.randn (40, 3)
+        y = X[:,0] - 2 * X[:,1]
+        n = MLPRegressor (hidden_layer_sizes=(5,), max_iter=20, random_state=1)
+        params = [ {'alpha': [0., 0.01], 'learning_rate_init': [0.01, 0.05], 'activation': ['relu', 'not_implemented']} ]
+
+        with _temporary_working_directory ():
+            serial_results, serial_idx_min = GridSearchCV (copy.deepcopy (n), copy.deepcopy (params), X, y, accuracy_functions["euclidean"], 2, write_best=False)
+        with _temporary_working_directory ():
+            parallel_results, parallel_idx_min = GridSearchCV (n, copy.deepcopy (params), X, y, accuracy_functions["euclidean"], 2, write_best=False, n_jobs=2)
+            # the reports of the parallel search are the only ones in its working directory
+            fname, = [f for f in os.listdir ("grid_reports") if f.endswith (".gsv")]
+            self.assertEqual ([p for p, _ in readGridSearchFile ("grid_reports/" + fname)], [p for p, _ in parallel_results], "wrong order of the .gsv file")
+            with open ("grid_reports/" + fname[:-len(".gsv")] + ".err") as errin:
+                self.assertEqual (len(errin.readlines ()), 4, "errors not written in the .err file")
+
+        self.assertEqual (len(parallel_results), 4, "the configurations with a not implemented activation function must fail")
+        self.assertEqual (parallel_idx_min, serial_idx_min, "wrong best configuration")
+        for (serial_p, serial_res), (parallel_p, parallel_res) in zip (serial_results, parallel_results):
+            self.assertEqual (parallel_p, serial_p, "results not in the grid order")
+            self.assertTrue (np.allclose (parallel_res, serial_res), "parallel and serial results are different")
+
+        for n_jobs in [0, 1.5]:
+            self.assertRaises (ValueError, GridSearchCV, n, params, X, y, accuracy_functions["euclidean"], 2, n_jobs=n_jobs)
+            self.assertRaises (ValueError, cross_val, n, X, y, accuracy_functions["euclidean"], 2, n_jobs=n_jobs)
+
+    def test_grid_search_stacked ( self ):
+        # the stacked grid search must give the results of the serial one, training the configurations with the same architecture in stacks
+        X = np.random.randn (40, 3)
+        y = X[:,0] - 2 * X[:,1]
+        n = MLPRegressor (hidden_layer_sizes=(5,), max_iter=20, random_state=1)
+        params = [ {'alpha': [0., 0.01], 'learning_rate_init': [0.01, 0.05], 'momentum': [0.5, 0.9], 'activation': ['relu', 'not_implemented']} ]
+
+        stacked_fits = []
+        original_fit = ModelStack.fit
+        def counting_fit ( stack, X, y ):
+            original_fit (stack, X, y)
+            stacked_fits.append (len(stack.models))
+
+        with _temporary_working_directory ():
+            serial_results, serial_idx_min = GridSearchCV (copy.deepcopy (n), copy.deepcopy (params), X, y, accuracy_functions["euclidean"], 2, write_best=False)
+        with _temporary_working_directory ():
+            ModelStack.fit = counting_fit
+            try:
+                stacked_results, stacked_idx_min = GridSearchCV (n, copy.deepcopy (params), X, y, accuracy_functions["euclidean"], 2, write_best=False, stacked=True)
+            finally:
+                ModelStack.fit = original_fit
+            fname, = [f for f in os.listdir ("grid_reports") if f.endswith (".gsv")]
+            self.assertEqual ([p for p, _ in readGridSearchFile ("grid_reports/" + fname)], [p for p, _ in stacked_results], "wrong order of the .gsv file")
+
+        self.assertEqual (stacked_fits, [8, 8], "the configurations with the relu activation must be trained in a stack in each fold (and only once)")
+        self.assertEqual (len(stacked_results), 8, "the configurations with a not implemented activation function must fail")
+        self.assertEqual (stacked_idx_min, serial_idx_min, "wrong best configuration")
+        for (serial_p, serial_res), (stacked_p, stacked_res) in zip (serial_results, stacked_results):
+            self.assertEqual (stacked_p, serial_p, "results not in the grid order")
+            self.assertTrue (np.allclose (stacked_res, serial_res), "stacked and serial results are different")
+
+    def test_grid_search_resume ( self ):
+        # an interrupted grid search must evaluate only the remaining configurations and give the same results of an uninterrupted one
+        X = np.random.randn (40, 3)
+        y = X[:,0] - 2 * X[:,1]
+        params = [ {'alpha': [0., 0.01], 'learning_rate_init': [0.01, 0.05], 'activation': ['relu', 'not_implemented']} ]
+        ledger_fname = "grid_reports/MLPRegressor.ledger"
+
+        # the grid search writes its reports and ledger into the working directory: a temporary one leaves the real ledger alone
+        with _temporary_working_directory ():
+            def grid_search ():
+                n = MLPRegressor (hidden_layer_sizes=(5,), max_iter=20, early_stopping=True, random_state=1)
+                return GridSearchCV (n, copy.deepcopy (params), X, y, accuracy_functions["euclidean"], 2, write_best=False, resume=True)
+
+            expected_results, expected_idx_min = grid_search ()
+            with open (ledger_fname) as ledger:
+                records = ledger.readlines ()
+            self.assertEqual (len(records), 8, "every configuration (failed ones included) must be recorded in the ledger")
+
+            # interruption while writing the fourth record
+            with open (ledger_fname, "w") as ledger:
+                ledger.writelines (records[:3])
+                ledger.write (records[3][:20])
+
+            results, idx_min = grid_search ()
+            self.assertEqual (json.dumps (results), json.dumps (expected_results), "results of the resumed grid search are different")
+            self.assertEqual (idx_min, expected_idx_min, "wrong best configuration")
+            with open (ledger_fname) as ledger:
+                self.assertEqual (len(ledger.readlines ()), 8, "only the configurations missing from the ledger must be evaluated")
+
+            grid_search ()
+            with open (ledger_fname) as ledger:
+                self.assertEqual (len(ledger.readlines ()), 8, "configurations already in the ledger must not be evaluated again")
+
+            # the serial search leaves the hyper-parameters of the model unchanged: a second search on the same model resumes from the ledger
+            n = MLPRegressor (hidden_layer_sizes=(5,), max_iter=20, early_stopping=True, random_state=1, alpha=0.1)
+            params = [ {'alpha': [0., 0.01], 'learning_rate_init': [0.01, 0.05]} ]
+            GridSearchCV (n, params, X, y, accuracy_functions["euclidean"], 2, write_best=False, resume=True)
+            self.assertEqual ((n.alpha, n.learning_rate_init), (0.1, 0.001), "the grid search changed the hyper-parameters of the model")
+            GridSearchCV (n, params, X, y, accuracy_functions["euclidean"], 2, write_best=False, resume=True)
+            with open (ledger_fname) as ledger:
+                self.assertEqual (len(ledger.readlines ()), 12, "the second search on the same model must not evaluate the configurations again")
+
+    def test_successive_halving ( self ):
+        X = np.random.randn (60, 3)
+        y = X[:,0] - 2 * X[:,1]
+        n = MLPRegressor (hidden_layer_sizes=(5,), max_iter=8, random_state=1)
+        params = [ {'learning_rate_init': [0.001, 0.01, 0.05], 'activation': ['relu', 'tanh', 'not_implemented']} ]
+
+        # the reports of the searches are written into a temporary working directory
+        with _temporary_working_directory ():
+            results, idx_min = SuccessiveHalvingSearch (n, params, X, y, accuracy_functions["euclidean"], min_epochs=2, eta=2, random_state=0)
+            self.assertEqual (len(results), 6, "the configurations with a not implemented activation function must fail")
+            self.assertEqual (idx_min, np.argmin ([perf[0] for _, perf in results]), "wrong best configuration")
+            for p, perf in results:
+                self.assertEqual (len(perf), 4, "wrong format of the results")
+
+            fname, = [f for f in os.listdir ("grid_reports") if f.endswith (".gsv")]
+            self.assertEqual (sorted (map (json.dumps, readGridSearchFile ("grid_reports/" + fname))), sorted (map (json.dumps, results)), "wrong results in the .gsv file")
+
+            # brackets of 9, 5 and 3 configurations starting from 1, 3 and 9 epochs
+            params = [ {'learning_rate_init': [0.001, 0.05], 'momentum': [0., 0.9]} ]
+            results, idx_min = HyperbandSearch (n, params, X, y, accuracy_functions["euclidean"], max_epochs=9, eta=3, random_state=0)
+            self.assertEqual (len(results), 17, "wrong number of configurations in the hyperband brackets")
+
+    def test_result_store ( self ):
+        with tempfile.TemporaryDirectory () as directory:
+            # legacy report: results without the training loss, an interrupted record and the best result
+            with open (directory + "/MLPRegressor_1.gsv", "w") as outt:
+                outt.write ('{"activation": "tanh", "hidden_layer_sizes": [50, 50], "early_stopping": false}\n[1.5, 0.1, 5]\n')
+                outt.write ('{"activation": "relu", "hidden_layer_sizes": [10], "early_stopping": true}\n[0.5, 0.2, 0.1, 5]\n')
+                outt.write ('{"activation": "tanh", "hidden_layer_sizes": [10], "early_stopping": false}\n[NaN, 0.2, 0.1, 5]\n')
+                outt.write ('{"activation": "relu", "hidden_la\n')
+                outt.write ('*** Best ***\n{"activation": "relu", "hidden_layer_sizes": [10], "early_stopping": true}\n[0.5, 0.2, 0.1, 5]\n')
+            with open (directory + "/other.gsv", "w") as outt:
+                outt.write ('{"activation": "tanh", "hidden_layer_sizes": [10], "early_stopping": false}\n[0.1, 0.2, 0.1, 5]\n')
+            with open (directory + "/MLPRegressor_2.gsv", "w") as outt:
+                outt.write ('{"activation": "tanh", "hidden_layer_sizes": [10], "early_stopping": false, "batch_size": null}\n[2.5, 0.2, 0.1, 5]\n')
+
+            with ResultStore (directory + "/results.sqlite") as store:
+                self.assertEqual (store.import_directory (directory, "MLP"), 4, "wrong number of imported results")
+                self.assertEqual (store.import_directory (directory, "MLP"), 0, "unchanged files must not be imported again")
+                self.assertEqual ([perf for _, perf in store.top_k (5, batch_size=None)], [[2.5, 0.2, 0.1, 5]], "wrong null filter")
+                os.remove (directory + "/MLPRegressor_2.gsv")
+                store.import_directory (directory, "MLP")
+                self.assertEqual (len(store), 3, "the results of a deleted file must be removed")
+                self.assertEqual (store.top_k (5, batch_size=None), [])
+                best = [perf[0] for _, perf in store.top_k (3)]
+                self.assertEqual (best[:2], [0.5, 1.5], "wrong order of the results")
+                self.assertTrue (np.isnan (best[2]), "nan losses must be the worst ones")
+                self.assertEqual (store.top_k (5, activation="tanh", hidden_layer_sizes=[50, 50]), [({"activation": "tanh", "hidden_layer_sizes": [50, 50], "early_stopping": False}, [1.5, 0.1, 5])])
+                self.assertEqual (len(store.top_k (5, early_stopping=True)), 1, "wrong boolean filter")
+
+            self.assertEqual (getBestRes ("", directory, 1), [({"activation": "tanh", "hidden_layer_sizes": [10], "early_stopping": False}, [0.1, 0.2, 0.1, 5])], "wrong best result")
+            self.assertEqual (getBestRes ("MLP", directory, 1, activation="tanh")[0][1], [1.5, 0.1, 5], "wrong best result for the prefix and the filter")
+
+            # the grid search adds its results to the store (here the one of getBestRes, with the reports written into another directory)
+            X = np.random.randn (30, 3)
+            y = X[:,0] - 2 * X[:,1]
+            n = MLPRegressor (hidden_layer_sizes=(5,), max_iter=5, random_state=1)
+            params = [ {'learning_rate_init': [0.001, 0.01], 'activation': ['relu', 'not_implemented']} ]
+            with ResultStore (directory + "/results.sqlite") as store:
+                n_results = len(store)
+                with _temporary_working_directory ():
+                    results, idx_min = GridSearchCV (n, params, X, y, accuracy_functions["euclidean"], 2, write_best=False, store=store)
+                    fname, = [f for f in os.listdir ("grid_reports") if f.endswith (".gsv")]
+                    self.assertEqual (len(store), n_results + 2, "the results of the grid search must be in the store")
+                    self.assertEqual (json.dumps (store.top_k (1, fname)), json.dumps ([results[idx_min]]), "wrong best result of the grid search")
+                    self.assertEqual (store.import_gsv ("grid_reports/" + fname), 0, "the .gsv file of the grid search must not be imported again")
+                    self.assertEqual (len(store), n_results + 2, "duplicated results in the store")
+
+                # the lookups on directory do not remove the results of the files of other directories
+                getBestRes ("", directory, 1)
+                self.assertEqual (len(store), n_results + 2, "results of another directory removed from the store")
+
+    def test_dataset_cache ( self ):
+        # the cached datasets must be equal to the parsed ones (and the dev/test split the same):
+        # the first call can build the cache, the second one loads it
+        for _ in range (2):
+            data, labels, testdata, testlabels = ReadData("cup/ML-CUP19-TR.csv", 0.75)
+            expected = ReadData("cup/ML-CUP19-TR.csv", 0.75, cache=False)
+            if len(expected[0]) == 0:
+                self.skipTest("training data not accessible")
+            for array, expected_array in zip ((data, labels, testdata, testlabels), expected):
+                self.assertTrue (np.array_equal (array, expected_array), "cached dataset different from the parsed one")
+        for array, expected_array in zip (readMonk("monks/monks-1.train"), readMonk("monks/monks-1.train", cache=False)):
+            self.assertTrue (np.array_equal (array, expected_array), "cached monk dataset different from the parsed one")
+
+        with tempfile.TemporaryDirectory () as directory:
+            fname = directory + "/data.csv"
+            parsed = []
+            def parse (path):
+                parsed.append (path)
+                return (np.loadtxt (path, delimiter=",", ndmin=2),)
+            with open (fname, "w") as outt:
+                outt.write ("1,2\n3,4\n")
+            for _ in range (2):
+                data, = _cached_arrays (fname, ("data",), parse)
+            self.assertEqual (len(parsed), 1, "the cached dataset must not be parsed again")
+            self.assertTrue (np.array_equal (data, [[1, 2], [3, 4]]))
+            # same content with a different mtime
+            os.utime (fname, (0, 0))
+            data, = _cached_arrays (fname, ("data",), parse)
+            self.assertEqual (len(parsed), 1, "a file with the same content must not be parsed again")
+            with open (fname, "w") as outt:
+                outt.write ("5,6\n7,8\n")
+            data, = _cached_arrays (fname, ("data",), parse)
+            self.assertEqual (len(parsed), 2, "a changed file must be parsed again")
+            self.assertTrue (np.array_equal (data, [[5, 6], [7, 8]]), "stale dataset cache")
+
     def test_regressor ( self ):
         # network that learns to compute a nonlinear function on its inputs
         n = MLPRegressor (hidden_layer_sizes=(50, 50,), learning_rate_init=0.01, momentum=0.9, alpha=0.00,)
@@ -502,7 +1145,30 @@ class TestFunctions (unittest.TestCase):
         self.helper_test_functions ("zero_one_tanh'", activation_functions_derivatives["zero_one_tanh"], 
                 [-16, -10, -5, -1, -0.5, -0.1, 0, 0.1, 0.5, 1, 5, 10, 16], 
                 [0, 0, 0.00009079, 0.20998717, 0.39322387, 0.49503315, 0.5, 0.49503315, 0.39322387, 0.20998717, 0.00009079, 0, 0])
-    
+
+    def test_activation_functions_on_arrays (self):
+        # whole-array evaluation (also in place through the out parameter) must give the same results of the element-wise one
+        X = np.array ([[-16, -10, -5, -1, -0.5, -0.1, 0],
+                       [ 0.1, 0.5, 1, 5, 10, 16, -800]])
+        for fname in activation_functions:
+            for functions in (activation_functions, activation_functions_derivatives):
+                fun = functions[fname]
+                expected = np.array ([[fun (x) for x in row] for row in X])
+                self.assertTrue (np.allclose (fun (X), expected), "{} gives wrong results on arrays".format(fname))
+                buffer = X.copy ()
+                result = fun (buffer, out=buffer)
+                self.assertIs (result, buffer, "{} does not write the result in the out buffer".format(fname))
+                self.assertTrue (np.allclose (buffer, expected), "{} gives wrong results in place".format(fname))
+
+    def test_activation_functions_output_derivatives (self):
+        # derivatives computed from the outputs of the activation functions must be the same of the ones computed from their inputs
+        X = np.array ([[-16, -10, -5, -1, -0.5, -0.1, 0],
+                       [ 0.1, 0.5, 1, 5, 10, 16, -800]])
+        for fname in activation_functions:
+            expected = activation_functions_derivatives[fname] (X)
+            derivatives = activation_functions_output_derivatives[fname] (activation_functions[fname] (X))
+            self.assertTrue (np.allclose (derivatives, expected), "wrong {} derivatives computed from the outputs".format(fname))
+
     def test_squared_loss (self):
         true = [[0,  0],  [1,   1],  [2,   2],  [3,3], [4,   4],  [5,5],   [ 6, 6], [7,  7]  ]
         pred = [[1,  1],  [2,   2],  [3,   3],  [3,3], [3,   5],  [5,6],   [ 0,-6], [8, 10]  ]
@@ -535,6 +1201,21 @@ class TestFunctions (unittest.TestCase):
         losses_der = loss_functions_derivatives["log_loss"] (true, pred)
         self.assertTrue ( np.allclose (losses_der, exp), "wrong log losses derivatives" )
 
+    def test_loss_and_derivative (self):
+        true = [[0,  0],  [1,   1],  [0,   1],  [1,0], [0,   0],  [1,1],   [ 0, 1], [1,  0]  ]
+        pred = [[1,  0],  [0.2, 0.8],[0.5, 0.5],[1,0], [0.1, 0.3],[0,0.6], [ 0, 1], [0.9, 0.4]]
+
+        for loss in loss_functions:
+            losses, derivatives = loss_functions_and_derivatives[loss] (true, pred)
+            self.assertTrue ( np.allclose (losses, loss_functions[loss] (true, pred)), "wrong {} losses in fused loss and derivative".format(loss) )
+            self.assertTrue ( np.array_equal (derivatives, loss_functions_derivatives[loss] (true, pred)), "wrong {} derivatives in fused loss and derivative".format(loss) )
+
+            out = np.empty ((8, 2))
+            total_loss, derivatives = loss_functions_and_derivatives[loss] (true, pred, reduction="sum", out=out)
+            self.assertIs (derivatives, out)
+            self.assertAlmostEqual ( total_loss, np.sum (losses), msg="wrong {} summed loss in fused loss and derivative".format(loss) )
+            self.assertAlmostEqual ( loss_functions[loss] (true, pred, reduction="sum"), np.sum (losses), msg="wrong {} summed loss".format(loss) )
+
     def test_euclidean_loss (self):
         true = np.array ([[0,  0],  [1,   1],  [2,   2],  [3,3], [4,   4],  [5,5],   [ 6, 6], [7,  7]  ])
         pred = np.array ([[1,  1],  [2,   2],  [3,   3],  [3,3], [3,   5],  [5,6],   [ 0,-6], [8, 10]  ])
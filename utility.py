@@ -10,83 +10,166 @@ from functions import *
 import pickle
 import pprint
 from datetime import datetime
-import heapq
 import json
 import tqdm
+import copy
+import traceback
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from sklearn.model_selection import train_test_split
+from result_store import ResultStore, readGridSearchFile
 
 #_DISABLE_TQDM = True
 _DISABLE_TQDM = False
    
-def readMonk(filename, devfraction = 1, shuffle = False):
+# version of the format of the datasets cache: caches with a different version are rebuilt
+_DATASET_CACHE_VERSION = 1
+
+def _file_digest(path):
+    '''
+    returns the sha1 hex digest of the content of the file path
     '''
-    used to read monk datasets performing one-hot encoding
+    digest = hashlib.sha1()
+    with open(path, "rb") as infile:
+        for chunk in iter(lambda: infile.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _cached_arrays(path, names, parse):
+    '''
+    returns the tuple of arrays parsed from the file path by parse(path), one for each name in names.
+
+    the arrays are saved in the cache directory .<file name>.cache next to the file (a .npy file for each array and meta.json, 
+    that records the cache version and the size, mtime and sha1 of the parsed file): while the file does not change, 
+    later calls memory-map them (copy-on-write) instead of parsing the file again. 
+    A file with the same content but a different mtime (e.g. after a checkout) keeps using the cache.
+    '''
+    path = Path(path)
+    cache_dir = path.parent / ("." + path.name + ".cache")
+    stat = os.stat(path)
+    sha1 = None
+
+    try:
+        with open(cache_dir / "meta.json") as infile:
+            meta = json.load(infile)
+        if meta["version"] == _DATASET_CACHE_VERSION and meta["arrays"] == list(names) and meta["size"] == stat.st_size:
+            if meta["mtime"] != stat.st_mtime:
+                sha1 = _file_digest(path)
+            if sha1 is None or sha1 == meta["sha1"]:
+                arrays = tuple(np.asarray(np.load(cache_dir / (name + ".npy"), mmap_mode="c")) for name in names)
+                if sha1 is not None:
+                    meta["mtime"] = stat.st_mtime
+                    _write_cache_meta(cache_dir, meta)
+                return arrays
+    except (OSError, ValueError, KeyError):
+        pass
+
+    arrays = parse(path)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        # the meta file is written last: an interrupted write leaves an invalid cache, that is rebuilt
+        for name, array in zip(names, arrays):
+            tmpname = cache_dir / "{}.npy.{}.tmp".format(name, os.getpid())
+            with open(tmpname, "wb") as outfile:
+                np.save(outfile, array)
+            os.replace(tmpname, cache_dir / (name + ".npy"))
+        meta = {"version": _DATASET_CACHE_VERSION, "arrays": list(names), "size": stat.st_size, "mtime": stat.st_mtime, "sha1": sha1 or _file_digest(path)}
+        _write_cache_meta(cache_dir, meta)
+    except OSError:
+        # read-only directory: the dataset is parsed at every call
+        pass
+    return arrays
+
+def _write_cache_meta(cache_dir, meta):
+    '''
+    atomically writes the meta file of the datasets cache in cache_dir
+    '''
+    tmpname = cache_dir / "meta.json.{}.tmp".format(os.getpid())
+    with open(tmpname, "w") as outfile:
+        json.dump(meta, outfile)
+    os.replace(tmpname, cache_dir / "meta.json")
+
+# offsets of the one-hot encodings of the 6 attributes of the monk datasets (attribute values start from 1)
+_MONK_ONE_HOT_OFFSETS = np.array([-1, 2, 5, 7, 10, 14])
+
+def _parse_monk(path):
+    '''
+    parses a monk dataset file: returns the one-hot encoded data and the labels
+    '''
+    # 1. class: 0, 1 
+    # 2. a1:    1, 2, 3
+    # 3. a2:    1, 2, 3
+    # 4. a3:    1, 2
+    # 5. a4:    1, 2, 3
+    # 6. a5:    1, 2, 3, 4
+    # 7. a6:    1, 2
+    # 8. Id:    (A unique symbol for each instance)
+    rows = np.loadtxt(path, usecols=range(7), dtype=int, ndmin=2)
+    labels = rows[:, 0]
+    data = np.zeros((len(rows), 17))
+    data[np.arange(len(rows))[:, np.newaxis], rows[:, 1:] + _MONK_ONE_HOT_OFFSETS] = 1
+    return data, labels
+
+def _parse_cup(path):
+    '''
+    parses the cup training set: returns the data (20 columns) and the labels (2 columns)
+    '''
+    # Id, 20 data, 2 label
+    rows = np.loadtxt(path, delimiter=",", comments="#", usecols=range(1, 23), ndmin=2)
+    return rows[:, :20], rows[:, 20:]
+
+def _parse_cup_blind(path):
+    '''
+    parses the cup blind test set: returns the ids and the data (20 columns)
+    '''
+    # Id, 20 data
+    ids = np.loadtxt(path, delimiter=",", comments="#", usecols=0, dtype=int, ndmin=1)
+    data = np.loadtxt(path, delimiter=",", comments="#", usecols=range(1, 21), ndmin=2)
+    return ids, data
+
+def readMonk(filename, devfraction = 1, shuffle = False, cache = True):
+    '''
+    used to read monk datasets performing one-hot encoding.
+    the parsed dataset is cached (see _cached_arrays) unless cache is False
     '''
     dir_path = os.path.dirname(os.path.realpath(__file__))
+    path = Path(dir_path + '/' + filename)
     
-    data = []
-    labels = []
     try:
-        with open(Path(dir_path + '/' + filename)) as infile:
-            reader = csv.reader(infile, delimiter=" ")
-            '''
-            1. class: 0, 1 
-            2. a1:    1, 2, 3
-            3. a2:    1, 2, 3
-            4. a3:    1, 2
-            5. a4:    1, 2, 3
-            6. a5:    1, 2, 3, 4
-            7. a6:    1, 2
-            8. Id:    (A unique symbol for each instance)
-            '''
-            for row in reader:
-                label = int(row[1])
-
-                rowdata = np.zeros(17)
-                rowdata[int(row[2]) - 1] = 1
-                rowdata[int(row[3]) + 2] = 1
-                rowdata[int(row[4]) + 5] = 1
-                rowdata[int(row[5]) + 7] = 1
-                rowdata[int(row[6]) + 10] = 1
-                rowdata[int(row[7]) + 14] = 1
-
-                data.append(rowdata)
-                labels.append(label)
-
-            data = np.array (data)
-            labels = np.array (labels)
-
-            if (shuffle):
-                indexes = list (range(len(data)))
-                random.shuffle(indexes)
-                data = data [ indexes ]
-                labels = labels [ indexes ]
-
-            if  0 < devfraction < 1:
-                n = int(devfraction*len(data))
-                return data[:n], labels[:n], data[n:], labels[n:]
-
-            return data, labels, [], []
+        if cache:
+            data, labels = _cached_arrays(path, ("data", "labels"), _parse_monk)
+        else:
+            data, labels = _parse_monk(path)
+
+        if (shuffle):
+            indexes = list (range(len(data)))
+            random.shuffle(indexes)
+            data = data [ indexes ]
+            labels = labels [ indexes ]
+
+        if  0 < devfraction < 1:
+            n = int(devfraction*len(data))
+            return data[:n], labels[:n], data[n:], labels[n:]
+
+        return data, labels, [], []
 
     except IOError:
         print('File ' + str(Path(dir_path)) + '/' + filename + ' not accessible')
         return [], [], [], []
 
-def ReadData(filename, devfraction):
+def ReadData(filename, devfraction, cache = True):
     '''
-    used to read cup dataset
+    used to read cup dataset.
+    the parsed dataset is cached (see _cached_arrays) unless cache is False
     '''
     dir_path = os.path.dirname(os.path.realpath(__file__))
+    path = Path(dir_path + '/' + filename)
     
     try:
-        with open(Path(dir_path + '/' + filename)) as infile:
-            reader = csv.reader(infile, delimiter=",")
-            labels = []
-            data = []
-            for row in reader:
-                if row[0][0] != '#':
-                    # Id, 20 data, 2 label
-                    labels.append([float(row[21]), float(row[22])])
-                    data.append([float(x) for x in row[1:21]])
+        if cache:
+            data, labels = _cached_arrays(path, ("data", "labels"), _parse_cup)
+        else:
+            data, labels = _parse_cup(path)
 
         n = int(devfraction*len(data))
 
@@ -96,117 +179,539 @@ def ReadData(filename, devfraction):
         print('File ' + str(Path(dir_path)) + '/' + filename + ' not accessible')
         return [], [], [], []
 
-def ReadBlindData(filename):
+def ReadBlindData(filename, cache = True):
     '''
-    used to read blind data of the cup
+    used to read blind data of the cup.
+    the parsed dataset is cached (see _cached_arrays) unless cache is False
     '''
     dir_path = os.path.dirname(os.path.realpath(__file__))
+    path = Path(dir_path + '/' + filename)
     
     try:
-        with open(Path(dir_path + '/' + filename)) as infile:
-            reader = csv.reader(infile, delimiter=",")
-            ids = []
-            data = []
-            for row in reader:
-                if row[0][0] != '#':
-                    # Id, 20 data
-                    ids.append(int(row[0]))
-                    data.append([float(x) for x in row[1:21]])
-        
-        return ids, data
+        if cache:
+            return _cached_arrays(path, ("ids", "data"), _parse_cup_blind)
+        return _parse_cup_blind(path)
 
     except IOError:
         print('File ' + str(Path(dir_path)) + '/' + filename + ' not accessible')
         return [], [], [], []
 
-def cross_val(model, data, labels, loss_function, folds=5):
+def _reseed_worker():
     '''
-    performs a cross validation on the model with the data, labels and loss function provided as input
-    returns average loss on validation, average loss on training, standard deviation, number of folds in which the validation actually succeeded
+    reseeds the global random generators of a worker process, that would otherwise share their state with the other (forked) workers
+    '''
+    np.random.seed()
+    random.seed()
+
+def _cross_val_splits(data, labels, folds):
+    '''
+    yields for each fold the tuple (training data, training labels, validation data, validation labels)
     '''
     X_tr_folds = np.array_split(data, folds)
     y_tr_folds = np.array_split(labels, folds)
-    losses = []
-    losses_train = []
-
-    for i in tqdm.tqdm(range(folds), desc="k-fold crossval", disable=_DISABLE_TQDM):
+    for i in range(folds):
         tr_data, test_data = np.concatenate(X_tr_folds[:i] + X_tr_folds[i+1:]), X_tr_folds[i]
         tr_labels, testlabels = np.concatenate(y_tr_folds[:i] + y_tr_folds[i+1:]), y_tr_folds[i]
-        
+        yield tr_data, tr_labels, test_data, testlabels
+
+def _cross_val_fold(model, tr_data, tr_labels, test_data, testlabels, loss_function, errstate=None):
+    '''
+    trains the model on a fold and returns the losses on its validation and training sets.
+    errstate is the numpy floating point error handling to use (it is per-thread, a thread worker would otherwise use numpy defaults)
+    '''
+    with np.errstate(**(errstate or np.geterr())):
         model.fit(tr_data, tr_labels)
-        result = model.predict(test_data)
-        loss = loss_function (testlabels, result)
+        return _fold_losses(model, tr_data, tr_labels, test_data, testlabels, loss_function)
+
+def _fold_losses(model, tr_data, tr_labels, test_data, testlabels, loss_function):
+    '''
+    returns the losses of the model, already trained on a fold, on its validation and training sets
+    '''
+    result = model.predict(test_data)
+    loss = loss_function (testlabels, result)
 
-        result_train = model.predict(tr_data)
-        loss_train = loss_function (tr_labels, result_train)
+    result_train = model.predict(tr_data)
+    loss_train = loss_function (tr_labels, result_train)
 
-        if loss is np.nan:
-            raise ValueError ("loss is nan")
+    if loss is np.nan:
+        raise ValueError ("loss is nan")
 
-        losses.append ( loss )
-        losses_train.append(loss_train)
+    return loss, loss_train
+
+def _cross_val_result(results):
+    '''
+    returns the result of a cross validation (see cross_val) from the list of the pairs (validation loss, training loss) of its folds
+    '''
+    losses = [loss for loss, _ in results]
+    losses_train = [loss_train for _, loss_train in results]
 
     if len(losses) != 0:
-        return np.mean (losses), np.mean (loss_train), np.std(losses), len(losses)
+        return np.mean (losses), np.mean (losses_train), np.std(losses), len(losses)
     else:
         return 0, 0, 0, 0
 
+def _check_n_jobs(n_jobs):
+    '''
+    raises an error if n_jobs is not a number of parallel workers: None, a positive integer or a negative one (all the cpus)
+    '''
+    if n_jobs is not None and (not isinstance(n_jobs, (int, np.integer)) or n_jobs == 0):
+        raise ValueError ("n_jobs must be None, a positive integer or -1 (all the cpus), got {}".format(n_jobs))
+
+def cross_val(model, data, labels, loss_function, folds=5, n_jobs=None, backend="thread"):
+    '''
+    performs a cross validation on the model with the data, labels and loss function provided as input
+    returns average loss on validation, average loss on training, standard deviation, number of folds in which the validation actually succeeded
+
+    with n_jobs > 1 (or -1 for all the cpus) the folds are trained in parallel, each one on a deep copy of model, 
+    by a pool of threads (backend="thread") or processes (backend="process", model and loss_function must be picklable);
+    otherwise they are trained one after another on model itself.
+    '''
+    _check_n_jobs(n_jobs)
+    splits = _cross_val_splits(data, labels, folds)
+
+    if n_jobs is None or n_jobs == 1:
+        results = [_cross_val_fold(model, *split, loss_function) for split in tqdm.tqdm(splits, total=folds, desc="k-fold crossval", disable=_DISABLE_TQDM)]
+    else:
+        max_workers = None if n_jobs < 0 else n_jobs
+        if backend == "thread":
+            executor = ThreadPoolExecutor(max_workers=max_workers)
+        elif backend == "process":
+            executor = ProcessPoolExecutor(max_workers=max_workers, initializer=_reseed_worker)
+        else:
+            raise ValueError ("cross validation backend {} not implemented".format(backend))
+        with executor:
+            futures = [executor.submit(_cross_val_fold, copy.deepcopy(model), *split, loss_function, np.geterr()) for split in splits]
+            results = [future.result() for future in futures]
+
+    return _cross_val_result(results)
+
+def _cross_val_stacked(models, data, labels, loss_function, folds=5):
+    '''
+    cross validates all the models on the same folds: in each fold the networks with the same architecture and minibatches 
+    are trained together by model_stack.fit_stacked (in a ModelStack), the other models one after another.
+    returns the list of the outcomes of the models: (True, cross validation result, see cross_val) or (False, traceback of the exception raised by the model).
+    if the stacked training of a group raises an exception, its models are trained again one after another, so that only the failing ones get the error
+    '''
+    # imported here: model_stack imports neural_network, that imports this module
+    from model_stack import fit_stacked, stack_groups
+
+    results = [[] for _ in models]
+    errors = [None] * len(models)
+    indexes = {id(model): i for i, model in enumerate(models)}
+    for tr_data, tr_labels, test_data, testlabels in tqdm.tqdm(_cross_val_splits(data, labels, folds), total=folds, desc="k-fold crossval", disable=_DISABLE_TQDM):
+        trained = []
+        for group in stack_groups([model for model, error in zip(models, errors) if error is None]):
+            try:
+                fit_stacked(group, tr_data, tr_labels)
+                trained += group
+            except Exception:
+                if len(group) == 1:
+                    errors[indexes[id(group[0])]] = traceback.format_exc()
+                    continue
+                # train the models of the failed stack one after another to find the failing ones
+                for model in group:
+                    try:
+                        model.fit(tr_data, tr_labels)
+                        trained.append(model)
+                    except Exception:
+                        errors[indexes[id(model)]] = traceback.format_exc()
+
+        for model in trained:
+            try:
+                results[indexes[id(model)]].append(_fold_losses(model, tr_data, tr_labels, test_data, testlabels, loss_function))
+            except Exception:
+                errors[indexes[id(model)]] = traceback.format_exc()
+
+    return [(True, _cross_val_result(result)) if error is None else (False, error) for result, error in zip(results, errors)]
+
 ##########################
 # GRID SEARCH FUNCTIONS  #
 ##########################
-def GridSearchCV(model, params, data, labels, loss, folds=5, uniquefile=False, write_best=True):
+
+# state of a grid search worker process: the model, the dataset, the loss function and the cross validation settings
+_grid_search_worker_state = None
+
+# number of configurations cross validated together by a stacked grid search: their results are written (and recorded in the ledger) after each group
+_GRID_SEARCH_STACK_SIZE = 32
+
+def _configured_model(model, p, attribm):
     '''
-    performs a grid search on the parameters provided as input through cross validation 
+    returns a copy of model with the hyper-parameters p (the ones in attribm, the attributes of model)
     '''
-    os.makedirs ("grid_reports", exist_ok=True)
+    model = copy.deepcopy(model)
+    for k in p.keys():
+        if k in attribm:
+            setattr(model, k, p[k])
+    return model
 
-    # print ("[DEBUG] testing parameters {}".format(params))
+def _init_grid_search_worker(model, data, labels, loss, folds, cv_n_jobs, cv_backend):
+    '''
+    initializes a grid search worker process: stores the data shared by all the configurations, sent only once to each worker,
+    and reseeds the global random generators (a forked worker would otherwise share their state with the others)
+    '''
+    global _grid_search_worker_state
+    _grid_search_worker_state = (model, data, labels, loss, folds, cv_n_jobs, cv_backend)
+    _reseed_worker()
+
+def _evaluate_configuration(p):
+    '''
+    cross validates a fresh copy of the model with the hyper-parameters p, inside a grid search worker process
+    returns the pair (True, cross validation result) or (False, traceback of the exception raised by the configuration)
+    '''
+    model, data, labels, loss, folds, cv_n_jobs, cv_backend = _grid_search_worker_state
+    model = _configured_model(model, p, dir(model))
+    try:
+        return True, cross_val(model, data, labels, loss, folds, cv_n_jobs, cv_backend)
+    except Exception:
+        return False, traceback.format_exc()
 
+def _grid_search_filename(model, uniquefile):
+    '''
+    returns the name (without extension) of the report files of a search on model and the mode to open the .gsv file:
+    a file per model class to which the results are appended if uniquefile is set, a new file with the current timestamp otherwise
+    '''
+    os.makedirs ("grid_reports", exist_ok=True)
     timestamp = datetime.today().isoformat().replace(':','_')
-    openmode = ''
     if (uniquefile):
-        filename = "grid_reports/" + model.__class__.__name__
-        openmode = 'a'
+        return "grid_reports/" + model.__class__.__name__, 'a'
+    return "grid_reports/" + model.__class__.__name__ + "_" + timestamp, 'w'
+
+def _write_best_result(outt, resList, write_best):
+    '''
+    returns the index of the result with the lowest validation loss in resList (-1 if it is empty)
+    and, if write_best is set, writes it at the end of the .gsv file outt
+    '''
+    idx_min = -1
+    if len(resList) > 0:
+        # print ("[DEBUG] list:", resList, len(resList))
+        idx_min = np.argmin([it[1][0] for it in resList])
+        # print ("[DEBUG] best idx:", idx_min)
+        
+    if idx_min>=0 and write_best:
+        print("*** Best ***", file=outt)
+        json.dump(resList[idx_min][0], outt)
+        print (file=outt)
+        json.dump(resList[idx_min][1], outt)
+        print (file=outt)            
+
+    return idx_min
+
+def _write_grid_search_result(outt, filename, p, outcome, store=None):
+    '''
+    writes the outcome of the configuration p: the result of a successful configuration is appended to the .gsv file outt 
+    as a single write (a crash can only truncate the last record) and, if given, to the ResultStore store; 
+    the error of a failed one to the file filename.err
+    '''
+    success, res = outcome
+    if success:
+        outt.write(json.dumps(p) + "\n" + json.dumps(res) + "\n")
+        outt.flush()
+        if store is not None:
+            store.add(p, res, source=os.path.basename(filename) + ".gsv")
     else:
-        filename = "grid_reports/" + model.__class__.__name__ + "_" + timestamp
-        openmode = 'w'
+        with open(filename + ".err", 'a') as errout:
+            print(json.dumps({"params": p, "error": res}), file=errout)
+
+def _array_digest(*arrays):
+    '''
+    returns the sha1 hex digest of the content, shape and type of the given arrays
+    '''
+    digest = hashlib.sha1()
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        digest.update(str((array.shape, array.dtype.str)).encode())
+        digest.update(array.tobytes())
+    return digest.hexdigest()
+
+def _grid_search_key(model_name, model_params, p, data_digest, folds, loss):
+    '''
+    returns the key that identifies the evaluation of the configuration p in the grid search ledger: 
+    the sha1 of the model class and parameters, of p, of the dataset, of the number of folds and of the loss function
+    '''
+    description = json.dumps([model_name, model_params, p, data_digest, folds, loss.__module__ + "." + loss.__qualname__], sort_keys=True, default=str)
+    return hashlib.sha1(description.encode()).hexdigest()
+
+def _read_ledger(fname):
+    '''
+    reads a grid search ledger: returns a dictionary {key: outcome} of the configurations already evaluated.
+    a truncated last line (the previous run was interrupted while writing it) is removed from the file
+    '''
+    evaluated = {}
+    if not os.path.exists(fname):
+        return evaluated
+    with open(fname, 'rb+') as infile:
+        content = infile.read()
+        if not content.endswith(b"\n"):
+            infile.truncate(content.rfind(b"\n") + 1)
+        for line in content.splitlines(keepends=True):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if "error" in record:
+                evaluated[record["key"]] = False, record["error"]
+            else:
+                evaluated[record["key"]] = True, record["result"]
+    return evaluated
+
+def _append_ledger(fname, key, p, outcome):
+    '''
+    records the outcome of the configuration p in the grid search ledger, as a single flushed line
+    '''
+    success, res = outcome
+    record = {"key": key, "params": p, ("result" if success else "error"): res}
+    with open(fname, 'a') as ledger:
+        ledger.write(json.dumps(record) + "\n")
+
+def GridSearchCV(model, params, data, labels, loss, folds=5, uniquefile=False, write_best=True, n_jobs=None, cv_n_jobs=None, cv_backend="thread", resume=False, store=None, stacked=False):
+    '''
+    performs a grid search on the parameters provided as input through cross validation 
+
+    with n_jobs > 1 (or -1 for all the cpus) the configurations are cross validated in parallel by a pool of processes, 
+    each one on a fresh copy of model (which, as well as loss, must be picklable); otherwise they are evaluated one after another on model itself:
+    each configuration is set on the original hyper-parameters of model, that are restored at the end of the search.
+    the results are written in the .gsv file in the same order of the grid, the errors raised by the configurations 
+    are written in a .err file with the same name.
+    cv_n_jobs and cv_backend are passed to cross_val to train the folds of each configuration in parallel.
+
+    with stacked (and without n_jobs) the configurations are cross validated _GRID_SEARCH_STACK_SIZE at a time, each one on a copy of model:
+    in each fold the networks of the group that differ only by scalar hyper-parameters (alpha, momentum, learning rate, ...) are trained together
+    in a ModelStack (see model_stack.py), the other ones one after another. cv_n_jobs and cv_backend are ignored.
+
+    with resume, every evaluated configuration (successful or failed) is recorded in the ledger grid_reports/<model class>.ledger,
+    keyed by the hash of the model parameters (before the search), the configuration, the dataset, the folds and the loss function.
+    the configurations found in the ledger are not evaluated again: their recorded outcome is used instead 
+    (and written in the .gsv file, unless uniquefile is set: the file of the interrupted run already contains it).
+
+    if a ResultStore is given as store, the results are also added to it (as they are written in the .gsv file, see result_store.py).
+    '''
+    # print ("[DEBUG] testing parameters {}".format(params))
+    _check_n_jobs(n_jobs)
+    _check_n_jobs(cv_n_jobs)
+
+    filename, openmode = _grid_search_filename(model, uniquefile)
+    if store is not None and openmode == 'a' and os.path.exists(filename + ".gsv"):
+        # the results already in the file must be in the store before the new ones are added
+        store.import_gsv(filename + ".gsv")
 
     with open(filename + ".gsv", openmode, buffering=1) as outt:
         attribm = (dir(model))
         grid = GetParGrid(params, attribm)
-        resList = []
-        for p in tqdm.tqdm(grid, desc="grid search", disable=True):
-            for k in p.keys():
-                if k in attribm:
-                    setattr(model, k, p[k])
-            
+        # outcome of each configuration of the grid: (True, (avg, std, n_successful_folds)) or (False, error)
+        outcomes = [None] * len(grid)
+
+        # configurations whose outcome is read from the ledger: they are written in the .gsv file only if it is a new one
+        resumed = set()
+        if resume:
+            ledger_fname = "grid_reports/" + model.__class__.__name__ + ".ledger"
+            model_params = model.get_params() if hasattr(model, "get_params") else {}
+            data_digest = _array_digest(data, labels)
+            keys = [_grid_search_key(model.__class__.__name__, model_params, p, data_digest, folds, loss) for p in grid]
+            evaluated = _read_ledger(ledger_fname)
+            for i, key in enumerate(keys):
+                if key in evaluated:
+                    outcomes[i] = evaluated[key]
+                    if openmode == 'a':
+                        resumed.add(i)
+
+        if stacked and (n_jobs is None or n_jobs == 1):
+            pending = [i for i, outcome in enumerate(outcomes) if outcome is None]
+            n_written = 0
+            for start in range(0, len(pending) + 1, _GRID_SEARCH_STACK_SIZE):
+                group = pending[start:start+_GRID_SEARCH_STACK_SIZE]
+                if group:
+                    models = [_configured_model(model, grid[i], attribm) for i in group]
+                    for i, outcome in zip(group, _cross_val_stacked(models, data, labels, loss, folds)):
+                        outcomes[i] = outcome
+                        if resume:
+                            _append_ledger(ledger_fname, keys[i], grid[i], outcome)
+                # write the results in the order of the grid, as in the parallel search
+                while n_written < len(grid) and outcomes[n_written] is not None:
+                    if n_written not in resumed:
+                        _write_grid_search_result(outt, filename, grid[n_written], outcomes[n_written], store)
+                    n_written += 1
+        elif n_jobs is None or n_jobs == 1:
+            # original values of the hyper-parameters changed by the grid: each configuration changes only its own ones
+            # (as in the parallel search and in the keys of the ledger) and model is left as it was
+            original = {k: getattr(model, k) for p in grid for k in p.keys() if k in attribm}
+            try:
+                for i, p in enumerate(tqdm.tqdm(grid, desc="grid search", disable=True)):
+                    if outcomes[i] is None:
+                        for k, value in original.items():
+                            setattr(model, k, value)
+                        for k in p.keys():
+                            if k in attribm:
+                                setattr(model, k, p[k])
+
+                        try:
+                            outcomes[i] = True, cross_val(model,data,labels,loss,folds,cv_n_jobs,cv_backend)
+                        except Exception:
+                            outcomes[i] = False, traceback.format_exc()
+                        if resume:
+                            _append_ledger(ledger_fname, keys[i], p, outcomes[i])
+                    if i not in resumed:
+                        _write_grid_search_result(outt, filename, p, outcomes[i], store)
+            finally:
+                for k, value in original.items():
+                    setattr(model, k, value)
+        else:
+            max_workers = None if n_jobs < 0 else n_jobs
+            with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_grid_search_worker, initargs=(model, data, labels, loss, folds, cv_n_jobs, cv_backend)) as executor:
+                futures = {executor.submit(_evaluate_configuration, p): i for i, p in enumerate(grid) if outcomes[i] is None}
+                # the results arrive out of order: write them as soon as all the previous configurations have been written
+                # (None: first write the configurations at the beginning of the grid read from the ledger)
+                n_written = 0
+                for future in itertools.chain([None], as_completed(futures)):
+                    if future is not None:
+                        i = futures[future]
+                        try:
+                            outcomes[i] = future.result()
+                        except Exception:
+                            # e.g. a worker process terminated abruptly
+                            outcomes[i] = False, traceback.format_exc()
+                        if resume:
+                            _append_ledger(ledger_fname, keys[i], grid[i], outcomes[i])
+                    while n_written < len(grid) and outcomes[n_written] is not None:
+                        if n_written not in resumed:
+                            _write_grid_search_result(outt, filename, grid[n_written], outcomes[n_written], store)
+                        n_written += 1
+
+        resList = [[p, res] for p, (success, res) in zip(grid, outcomes) if success]
+        idx_min = _write_best_result(outt, resList, write_best)
+
+    if store is not None:
+        # the store already contains all the results of the .gsv file
+        store.mark_imported(filename + ".gsv")
+
+    return resList, idx_min
+           
+def _successive_halving(model, grid, X_train, y_train, X_valid, y_valid, loss, min_epochs, max_epochs, eta, outt, filename):
+    '''
+    runs successive halving on the configurations of grid (see SuccessiveHalvingSearch), writing the results in the .gsv file outt 
+    and the errors in filename.err. returns the list of results [p, perf] of the configurations that did not fail, in the grid order
+    '''
+    attribm = (dir(model))
+    outcomes = [None] * len(grid)
+    # configurations still in the search: their models, fit_iterator() generators, number of epochs and whether they have converged
+    survivors = []
+    models = {}
+    iterators = {}
+    epochs = {}
+    converged = {}
+
+    for i, p in enumerate(grid):
+        models[i] = copy.deepcopy(model)
+        for k in p.keys():
+            if k in attribm:
+                setattr(models[i], k, p[k])
+        iterators[i] = models[i].fit_iterator(X_train, y_train)
+        epochs[i] = 0
+        converged[i] = False
+        survivors.append(i)
+
+    rung_epochs = min(min_epochs, max_epochs)
+    while survivors:
+        for i in list(survivors):
             try:
-                # res = (avg, std, n_successful_folds)
-                res=cross_val(model,data,labels,loss,folds)
-                resList.append([p, res])
-                json.dump(p, outt)
-                print (file=outt)
-                json.dump(res, outt)
-                print (file=outt)
-            except Exception as e:
-                # print ("ignoring parameters {} because: {}".format(p, e))
-                pass
-
-        idx_min = -1
-        if len(resList) > 0:
-            # print ("[DEBUG] list:", resList, len(resList))
-            idx_min = np.argmin([it[1][0] for it in resList])
-            # print ("[DEBUG] best idx:", idx_min)
-            
-        if idx_min>=0 and write_best:
-            print("*** Best ***", file=outt)
-            json.dump(resList[idx_min][0], outt)
-            print (file=outt)
-            json.dump(resList[idx_min][1], outt)
-            print (file=outt)            
+                while not converged[i] and epochs[i] < rung_epochs:
+                    try:
+                        next(iterators[i])
+                        epochs[i] += 1
+                    except StopIteration:
+                        converged[i] = True
+                valid_loss = loss(y_valid, models[i].predict(X_valid))
+                train_loss = loss(y_train, models[i].predict(X_train))
+                if np.isnan(valid_loss):
+                    raise ValueError ("loss is nan")
+                outcomes[i] = True, [valid_loss, train_loss, 0, 1]
+            except Exception:
+                outcomes[i] = False, traceback.format_exc()
+                survivors.remove(i)
+                _write_grid_search_result(outt, filename, grid[i], outcomes[i])
+                del models[i], iterators[i]
+
+        if rung_epochs >= max_epochs or len(survivors) <= 1 or all(converged[i] for i in survivors):
+            break
+
+        # keep the best 1/eta of the configurations, the others are written and release their buffers
+        ranking = sorted(survivors, key=lambda i: (outcomes[i][1][0], i))
+        n_kept = max(1, len(survivors) // eta)
+        for i in sorted(ranking[n_kept:]):
+            _write_grid_search_result(outt, filename, grid[i], outcomes[i])
+            iterators[i].close()
+            del models[i], iterators[i]
+        survivors = sorted(ranking[:n_kept])
+        rung_epochs = min(rung_epochs * eta, max_epochs)
+
+    for i in survivors:
+        _write_grid_search_result(outt, filename, grid[i], outcomes[i])
+        iterators[i].close()
+
+    return [[p, res] for p, (success, res) in zip(grid, outcomes) if success]
+
+def SuccessiveHalvingSearch(model, params, data, labels, loss, min_epochs=10, max_epochs=None, eta=3, validation_fraction=0.2, random_state=None, uniquefile=False, write_best=True):
+    '''
+    performs a multi-fidelity search on the parameters provided as input (same format of GridSearchCV) by successive halving:
+    all the configurations are trained for min_epochs epochs, then only the best 1/eta of them (by loss on a validation set) 
+    are trained up to eta times more epochs, and so on until max_epochs (default: model.max_iter) or until a single configuration is left.
+    a configuration that converges before the end of a rung keeps competing with its final loss.
+
+    each configuration is trained on a copy of model through fit_iterator(), on a hold out split of the data 
+    (a validation_fraction of it, drawn with random_state, is the validation set).
+    the results are written in the .gsv format of GridSearchCV as soon as a configuration is discarded, with the losses of its last rung:
+    [validation loss, training loss, 0, 1] (the standard deviation is 0 over the single hold out split).
+    the errors raised by the configurations are written in a .err file with the same name.
+
+    returns the list of results (in the grid order) and the index of the best one, as GridSearchCV
+    '''
+    if eta < 2:
+        raise ValueError ("successive halving needs eta >= 2, got {}".format(eta))
+    if max_epochs is None:
+        max_epochs = model.max_iter
+
+    X_train, X_valid, y_train, y_valid = train_test_split(np.asarray(data), np.asarray(labels), test_size=validation_fraction, random_state=random_state)
+    filename, openmode = _grid_search_filename(model, uniquefile)
+
+    with open(filename + ".gsv", openmode, buffering=1) as outt:
+        grid = GetParGrid(params, dir(model))
+        resList = _successive_halving(model, grid, X_train, y_train, X_valid, y_valid, loss, min_epochs, max_epochs, eta, outt, filename)
+        idx_min = _write_best_result(outt, resList, write_best)
 
         return resList, idx_min
-           
+
+def HyperbandSearch(model, params, data, labels, loss, max_epochs=None, eta=3, validation_fraction=0.2, random_state=None, uniquefile=False, write_best=True):
+    '''
+    performs a Hyperband search: several runs (brackets) of successive halving on configurations drawn at random from params 
+    (same format of getRandomParams), from many configurations starting with few epochs to few configurations trained for max_epochs
+    (default: model.max_iter). Every bracket uses about the same number of epochs in total.
+    See SuccessiveHalvingSearch for the validation split and the results file: all the brackets write in the same .gsv file.
+
+    returns the list of results and the index of the best one, as GridSearchCV
+    '''
+    if eta < 2:
+        raise ValueError ("hyperband needs eta >= 2, got {}".format(eta))
+    if max_epochs is None:
+        max_epochs = model.max_iter
+    # the most aggressive bracket starts from max_epochs / eta**s_max epochs (at least 1)
+    s_max = 0
+    while eta ** (s_max + 1) <= max_epochs:
+        s_max += 1
+
+    X_train, X_valid, y_train, y_valid = train_test_split(np.asarray(data), np.asarray(labels), test_size=validation_fraction, random_state=random_state)
+    filename, openmode = _grid_search_filename(model, uniquefile)
+
+    with open(filename + ".gsv", openmode, buffering=1) as outt:
+        attribm = dir(model)
+        resList = []
+        for s in range(s_max, -1, -1):
+            n_configurations = int(np.ceil((s_max + 1) / (s + 1) * eta ** s))
+            min_epochs = max(1, max_epochs // eta ** s)
+            grid = GetParGrid([random_params for i in range(n_configurations) for random_params in getRandomParams(params)], attribm)
+            resList += _successive_halving(model, grid, X_train, y_train, X_valid, y_valid, loss, min_epochs, max_epochs, eta, outt, filename)
+        idx_min = _write_best_result(outt, resList, write_best)
+
+        return resList, idx_min
+
 def getRandomParams(params):
     '''
     get random parameters on a set of hyper-parameters provided as list of lists of dictionaries
@@ -253,36 +758,18 @@ def GetParGrid(params, attribm):
                     res.append(par)
     return res
 
-def readGridSearchFile(filename):
-    '''
-    read a grid search output file
+def getBestRes(fileprefix, directory, k=1, **filters):
     '''
-    out = []
-    params = {}
-    perf_tuple = (0,0,0)
-    with open(Path(filename)) as infile:
-        for lineno, line in enumerate(infile):
-            if line.startswith("*"):
-                return out
-            elif lineno % 2 == 0:
-                params = json.loads(line)
-            else:
-                perf_tuple = json.loads(line)
-                out.append ((params, perf_tuple))
-    
-    return out
+        retrieves the best `k` results from all the gridSearch report files in `directory` whose name starts with `fileprefix`.
+        only the results whose parameters have the values in `filters` (e.g. activation="tanh") are considered.
 
-def getBestRes(fileprefix, directory, k=1):
+        the results are read from the ResultStore `directory`/results.sqlite, that is created if it does not exist: the report files are imported into it 
+        only when they are new or changed, and the results of the report files deleted from `directory` are removed from it 
+        (the results added to the same database by GridSearchCV with the reports written into another directory are kept).
     '''
-        retrieves the best `k` results from all the gridSearch report files in `directory` whose name starts with `fileprefix`
-    '''
-    best_so_far = []
-    for f in os.listdir(directory):
-        if f.startswith(fileprefix) and f.endswith(".gsv"):
-            results = readGridSearchFile( directory + "/" + f) 
-            best_so_far = heapq.nsmallest (k, results+best_so_far, key=lambda x: x[1])
-
-    return best_so_far
+    with ResultStore(os.path.join(directory, "results.sqlite")) as store:
+        store.import_directory(directory, fileprefix)
+        return store.top_k(k, fileprefix, **filters)
 
 ##########################
 #     PLOT FUNCTIONS     #